@@ -0,0 +1,379 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Any, Callable
+
+import torch
+import transformers
+from src import utils
+from src.backends import MockBackend, TransformersBackend
+from src.chunking import chunk_docs
+from src.utils import (
+    ec_prompt_1_generate,
+    ec_prompt_1_parse,
+    ec_prompt_1_postprocess,
+    ec_prompt_1_preprocess,
+    ec_prompt_2_postprocess,
+    ec_prompt_setup,
+    ee_postprocess,
+    ee_prompt_setup,
+    load_test_docs,
+    qwen_gen,
+    qwen_gen_batch,
+)
+
+from .tiny import build_corpus, build_tiny_model
+
+# Metrics where a larger value is better, everything else should shrink
+HIGHER_IS_BETTER = {"items_per_sec", "tokens_per_sec"}
+COMPARED_METRICS = (
+    "items_per_sec",
+    "tokens_per_sec",
+    "p50_ms",
+    "p95_ms",
+    "peak_rss_mb",
+)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class GenerateRecorder:
+    # Records wall time and new tokens of every model.generate call
+    def __init__(self, model: transformers.PreTrainedModel) -> None:
+        self.generate = model.generate
+        self.latencies = []
+        self.new_tokens = 0
+        model.generate = self
+
+    def __call__(self, *args, **kwargs) -> torch.LongTensor:
+        input_ids = kwargs["input_ids"] if "input_ids" in kwargs else args[0]
+        start_time = time.perf_counter()
+        output_ids = self.generate(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - start_time)
+        self.new_tokens += output_ids.numel() - input_ids.numel()
+        return output_ids
+
+    def reset(self) -> None:
+        self.latencies = []
+        self.new_tokens = 0
+
+
+def time_stage(
+    recorder: GenerateRecorder | None,
+    num_items: int,
+    run: Callable[[], Any],
+    repeats: int = 1,
+) -> dict[str, float]:
+    # Short CPU-only stages keep the best of several runs to damp noise
+    seconds = float("inf")
+    for _ in range(repeats):
+        if recorder is not None:
+            recorder.reset()
+        start_time = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start_time)
+    result = {
+        "items": num_items,
+        "seconds": round(seconds, 4),
+        "items_per_sec": round(num_items / seconds, 3),
+    }
+    if recorder is not None:
+        result.update(
+            {
+                "calls": len(recorder.latencies),
+                "new_tokens": recorder.new_tokens,
+                "tokens_per_sec": round(recorder.new_tokens / seconds, 1),
+                "p50_ms": round(percentile(recorder.latencies, 0.5) * 1000, 2),
+                "p95_ms": round(percentile(recorder.latencies, 0.95) * 1000, 2),
+            }
+        )
+    result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return result
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict[str, Any]:
+    model_dir = os.path.join(args.workdir, f"model_{args.hidden_size}x{args.layers}")
+    data_dir = os.path.join(args.workdir, f"data_{args.docs}x{args.doc_words}")
+    build_tiny_model(
+        model_dir,
+        args.example_dir,
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+    )
+    build_corpus(data_dir, args.example_dir, args.docs, args.doc_words)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # The shared generation settings are read at call time
+    utils.GENERATION_KWARGS["max_new_tokens"] = args.max_new_tokens
+
+    # Loaded on the CPU, without accelerate's device placement
+    backend = TransformersBackend(model_dir, device_map=None)
+    tokenizer, model = backend.tokenizer, backend.model
+    recorder = GenerateRecorder(model)
+    mock = MockBackend()
+    test_docs = load_test_docs(data_dir, args.subset)
+    results = {}
+
+    ee_template, ee_kwargs = ee_prompt_setup("1", args.subset, data_dir, "")
+    ee_prompts = [
+        ee_template.format(**ee_kwargs, title=doc["title"], text=doc["text"])
+        for doc in test_docs
+    ]
+
+    def run_qwen_gen() -> None:
+        for doc in test_docs[: args.sequential_docs]:
+            qwen_gen(
+                ee_template,
+                tokenizer,
+                model,
+                **ee_kwargs,
+                title=doc["title"],
+                text=doc["text"],
+            )
+
+    results["qwen_gen"] = time_stage(
+        recorder, min(args.sequential_docs, len(test_docs)), run_qwen_gen
+    )
+    results["ee_batch"] = time_stage(
+        recorder,
+        len(ee_prompts),
+        lambda: qwen_gen_batch(
+            ee_prompts, tokenizer, model, batch_size=args.batch_size
+        ),
+    )
+    if args.max_chunk_tokens:
+        # Same documents split into windows, items are still documents
+        chunks = chunk_docs(
+            test_docs, backend.token_spans, args.max_chunk_tokens, args.chunk_overlap
+        )
+        chunk_prompts = [
+            ee_template.format(**ee_kwargs, title=chunk["title"], text=chunk["text"])
+            for chunk in chunks
+        ]
+        results["ee_chunked"] = time_stage(
+            recorder,
+            len(test_docs),
+            lambda: qwen_gen_batch(
+                chunk_prompts, tokenizer, model, batch_size=args.batch_size
+            ),
+        )
+        results["ee_chunked"]["chunks"] = len(chunks)
+
+    # Classification runs on well-formed extraction output
+    ee_contents = {
+        doc["id"]: mock.respond(prompt) for doc, prompt in zip(test_docs, ee_prompts)
+    }
+    ec1_template, _ = ec_prompt_setup("1", args.subset, data_dir, args.example_dir)
+    entities_with_description = ec_prompt_1_preprocess(ee_contents)
+    results["ec_prompt_1"] = time_stage(
+        recorder,
+        len(entities_with_description.splitlines()),
+        lambda: ec_prompt_1_generate(
+            args.subset,
+            entities_with_description,
+            ec1_template,
+            backend,
+            batch_size=args.batch_size,
+        ),
+    )
+    ec2_template, ec2_kwargs = ec_prompt_setup(
+        "2", args.subset, data_dir, args.example_dir
+    )
+    ec2_prompts = [
+        ec2_template.format(
+            **ec2_kwargs,
+            title=doc["title"],
+            text=doc["text"],
+            entities="\n".join(utils.ee_content2entities(ee_contents[doc["id"]])),
+        )
+        for doc in test_docs
+    ]
+    results["ec_prompt_2"] = time_stage(
+        recorder,
+        len(ec2_prompts),
+        lambda: backend.generate(ec2_prompts, batch_size=args.batch_size),
+    )
+
+    # Postprocessing on a larger corpus of mock responses
+    num_copies = -(-args.postprocess_docs // len(test_docs))
+    many_ee_contents = {
+        f"{doc_id}_{copy}": content
+        for copy in range(num_copies)
+        for doc_id, content in ee_contents.items()
+    }
+    lines = ec_prompt_1_preprocess(many_ee_contents).splitlines()
+    ec1_responses = [
+        mock.respond(ec1_template.format(list_of_entities_with_description=line))
+        for line in lines
+    ]
+    ec2_contents = {
+        f"{doc_id}_{copy}": mock.respond(prompt)
+        for copy in range(num_copies)
+        for doc_id, prompt in zip(ee_contents, ec2_prompts)
+    }
+    results["ee_postprocess"] = time_stage(
+        None,
+        len(many_ee_contents),
+        lambda: ee_postprocess(many_ee_contents),
+        repeats=5,
+    )
+    results["ec_prompt_1_preprocess"] = time_stage(
+        None,
+        len(many_ee_contents),
+        lambda: ec_prompt_1_preprocess(many_ee_contents, dedup=True),
+        repeats=5,
+    )
+    results["ec_prompt_1_postprocess"] = time_stage(
+        None,
+        len(lines),
+        lambda: ec_prompt_1_postprocess(ec_prompt_1_parse(lines, ec1_responses)[0]),
+        repeats=5,
+    )
+    results["ec_prompt_2_postprocess"] = time_stage(
+        None,
+        len(ec2_contents),
+        lambda: ec_prompt_2_postprocess(ec2_contents),
+        repeats=5,
+    )
+
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "command"},
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare_results(
+    baseline: dict[str, Any], candidate: dict[str, Any], threshold: float
+) -> list[str]:
+    regressions = []
+    print(
+        f"{'stage':<24} {'metric':<14} {'baseline':>12} {'candidate':>12} {'change':>8}"
+    )
+    for stage, base in baseline["results"].items():
+        if stage not in candidate["results"]:
+            continue
+        new = candidate["results"][stage]
+        for metric in COMPARED_METRICS:
+            if not base.get(metric) or metric not in new:
+                continue
+            change = (new[metric] - base[metric]) / base[metric]
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = "REGRESSION" if worse > threshold else ""
+            print(
+                f"{stage:<24} {metric:<14} {base[metric]:>12} {new[metric]:>12} "
+                f"{change:>+8.1%} {flag}"
+            )
+            if flag:
+                regressions.append(f"{stage} {metric}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="throughput and latency benchmarks on a tiny random Qwen3 model"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny model and synthetic corpora are built once",
+    )
+    run_parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    run_parser.add_argument(
+        "--output", "-o", default=None, help="path to the JSON result file"
+    )
+    run_parser.add_argument(
+        "--subset", choices=["engineering", "scholarly"], default="engineering"
+    )
+    run_parser.add_argument(
+        "--docs", type=int, default=16, help="number of synthetic test documents"
+    )
+    run_parser.add_argument(
+        "--doc_words", type=int, default=200, help="average words per document"
+    )
+    run_parser.add_argument(
+        "--sequential_docs",
+        type=int,
+        default=8,
+        help="number of documents timed one by one with qwen_gen",
+    )
+    run_parser.add_argument(
+        "--postprocess_docs",
+        type=int,
+        default=2000,
+        help="number of mock responses fed to the postprocessors",
+    )
+    run_parser.add_argument("--batch_size", "-b", type=int, default=4)
+    run_parser.add_argument("--max_new_tokens", type=int, default=32)
+    run_parser.add_argument(
+        "--max_chunk_tokens",
+        type=int,
+        default=0,
+        help="also time extraction on documents split into windows of this size",
+    )
+    run_parser.add_argument("--chunk_overlap", type=int, default=64)
+    run_parser.add_argument("--hidden_size", type=int, default=64)
+    run_parser.add_argument("--layers", type=int, default=2)
+    run_parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="flag regressions between two result files"
+    )
+    compare_parser.add_argument("baseline", help="path to the baseline result file")
+    compare_parser.add_argument("candidate", help="path to the new result file")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change counted as a regression",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = run_benchmarks(args)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w") as fout:
+                fout.write(text + "\n")
+        print(text)
+    elif args.command == "compare":
+        baseline = json.load(open(args.baseline))
+        candidate = json.load(open(args.candidate))
+        regressions = compare_results(baseline, candidate, args.threshold)
+        if regressions:
+            sys.exit(f"{len(regressions)} regressions: " + ", ".join(regressions))
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import torch
+from src import utils
+from src.telemetry import Telemetry
+from src.utils import qwen_gen
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from .tiny import build_tiny_model, synthetic_text
+
+
+def build_assisted_models(
+    model_dir: str, sharpness: float, draft_layers: int
+) -> tuple[str, str]:
+    # A random model spreads its probability over the whole vocabulary, so a
+    # draft would hardly ever guess its next token. Scaling the tied embeddings
+    # sharpens the logits the way training does, and the draft is the target's
+    # first layers, like a small model distilled from it
+    target_dir = f"{model_dir}_sharp{sharpness:g}"
+    draft_dir = f"{target_dir}_draft{draft_layers}"
+    if os.path.exists(os.path.join(draft_dir, "config.json")):
+        return target_dir, draft_dir
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=torch.float32)
+    with torch.no_grad():
+        model.model.embed_tokens.weight.mul_(sharpness)
+    model.save_pretrained(target_dir)
+    tokenizer.save_pretrained(target_dir)
+    model.model.layers = model.model.layers[:draft_layers]
+    model.config.num_hidden_layers = draft_layers
+    model.save_pretrained(draft_dir)
+    tokenizer.save_pretrained(draft_dir)
+    return target_dir, draft_dir
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="assisted decoding with a draft model against plain decoding"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny models are built once",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument("--prompts", type=int, default=8)
+    parser.add_argument("--prompt_words", type=int, default=100)
+    parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--draft_layers", type=int, default=2)
+    parser.add_argument(
+        "--sharpness",
+        type=float,
+        default=3.0,
+        help="embedding scale of the target, higher makes the draft agree more",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+    args = parser.parse_args()
+
+    model_dir = os.path.join(args.workdir, f"model_{args.hidden_size}x{args.layers}")
+    build_tiny_model(
+        model_dir,
+        args.example_dir,
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+    )
+    target_dir, draft_dir = build_assisted_models(
+        model_dir, args.sharpness, args.draft_layers
+    )
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    utils.GENERATION_KWARGS["max_new_tokens"] = args.max_new_tokens
+    tokenizer = AutoTokenizer.from_pretrained(target_dir)
+    model = AutoModelForCausalLM.from_pretrained(target_dir, torch_dtype=torch.float32)
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_dir, torch_dtype=torch.float32
+    )
+
+    rng = random.Random(args.seed)
+    texts = [synthetic_text(rng, args.prompt_words) for _ in range(args.prompts)]
+    metrics_path = os.path.join(args.workdir, "assisted_metrics.jsonl")
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    telemetry = Telemetry(metrics_path)
+
+    outputs, seconds = {}, {}
+    for name, assistant_model in (("plain", None), ("assisted", draft_model)):
+        start_time = time.perf_counter()
+        outputs[name] = [
+            qwen_gen(
+                "{text}",
+                tokenizer,
+                model,
+                telemetry=telemetry,
+                tags={"variant": name},
+                assistant_model=assistant_model,
+                text=text,
+            )
+            for text in texts
+        ]
+        seconds[name] = time.perf_counter() - start_time
+    # Greedy decoding, drafts must only change the speed
+    assert outputs["plain"] == outputs["assisted"]
+
+    with open(metrics_path) as f:
+        records = [json.loads(line) for line in f]
+    print(
+        f"{args.prompts} prompts x {args.max_new_tokens} tokens, "
+        f"{args.layers}-layer target, {args.draft_layers}-layer draft"
+    )
+    print(f"{'decoding':<10} {'seconds':>8} {'tok/s':>8} {'accepted':>9}")
+    for name in ("plain", "assisted"):
+        group = [record for record in records if record["variant"] == name]
+        new_tokens = sum(record["new_tokens"] for record in group)
+        draft_tokens = sum(record.get("draft_tokens", 0) for record in group)
+        acceptance = (
+            f"{sum(record['accepted_tokens'] for record in group) / draft_tokens:.1%}"
+            if draft_tokens
+            else "-"
+        )
+        print(
+            f"{name:<10} {seconds[name]:>8.2f} {new_tokens / seconds[name]:>8.1f} "
+            f"{acceptance:>9}"
+        )
+    print(f"Speedup {seconds['plain'] / seconds['assisted']:.2f}x, identical outputs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import time
+
+from src import utils
+from src.backends import TransformersBackend
+from src.joint import qwen_gen_joint
+from src.quantization import set_threads
+from src.telemetry import Telemetry
+from src.utils import (
+    ec_prompt_setup,
+    ee_content2entities,
+    ee_prompt_setup,
+    load_test_docs,
+    qwen_gen_batch,
+)
+
+from .tiny import build_corpus, build_tiny_model
+
+
+def run(args: argparse.Namespace) -> None:
+    model_dir = os.path.join(args.workdir, f"model_{args.hidden_size}x{args.layers}")
+    data_dir = os.path.join(args.workdir, f"data_{args.docs}x{args.doc_words}")
+    build_tiny_model(
+        model_dir,
+        args.example_dir,
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+    )
+    build_corpus(data_dir, args.example_dir, args.docs, args.doc_words)
+    set_threads(args.threads, None)
+    utils.GENERATION_KWARGS["max_new_tokens"] = args.max_new_tokens
+    backend = TransformersBackend(model_dir, device_map=None)
+    tokenizer, model = backend.tokenizer, backend.model
+
+    docs = load_test_docs(data_dir, args.subset)
+    ee_template, ee_kwargs = ee_prompt_setup("1", args.subset, data_dir, "")
+    ec_template, ec_kwargs = ec_prompt_setup(
+        "2", args.subset, data_dir, args.example_dir
+    )
+    metrics_path = os.path.join(args.workdir, "joint_metrics.jsonl")
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    telemetry = Telemetry(metrics_path)
+
+    # Two scripts: extraction, then a classification prompt repeating the
+    # document. One document at a time like the joint flow, so only the
+    # reused cache differs
+    seconds = {}
+    start_time = time.perf_counter()
+    ee_contents = qwen_gen_batch(
+        [
+            ee_template.format(**ee_kwargs, title=doc["title"], text=doc["text"])
+            for doc in docs
+        ],
+        tokenizer,
+        model,
+        batch_size=1,
+        telemetry=telemetry,
+        tags=[{"variant": "ee"}] * len(docs),
+    )
+    qwen_gen_batch(
+        [
+            ec_template.format(
+                **ec_kwargs,
+                title=doc["title"],
+                text=doc["text"],
+                entities="\n".join(ee_content2entities(content)),
+            )
+            for doc, content in zip(docs, ee_contents)
+        ],
+        tokenizer,
+        model,
+        batch_size=1,
+        telemetry=telemetry,
+        tags=[{"variant": "ec"}] * len(docs),
+    )
+    seconds["two-script"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    joint_ee_contents, _, saved_tokens = qwen_gen_joint(
+        docs,
+        ee_template,
+        ee_kwargs,
+        ec_template,
+        ec_kwargs,
+        tokenizer,
+        model,
+        telemetry=telemetry,
+        ee_tags=[{"variant": "joint-ee"}] * len(docs),
+        ec_tags=[{"variant": "joint-ec"}] * len(docs),
+    )
+    seconds["joint"] = time.perf_counter() - start_time
+    # The extraction turn is the same prompt either way
+    assert joint_ee_contents == ee_contents
+
+    with open(metrics_path) as f:
+        records = [json.loads(line) for line in f]
+    print(
+        f"{len(docs)} documents x {args.doc_words} words, "
+        f"{args.max_new_tokens} tokens per turn, "
+        f"{args.hidden_size}x{args.layers} model"
+    )
+    print(f"{'flow':<12} {'seconds':>8} {'ec prefill tok':>15} {'ec prefill s':>13}")
+    for name, variant in (("two-script", "ec"), ("joint", "joint-ec")):
+        group = [record for record in records if record["variant"] == variant]
+        print(
+            f"{name:<12} {seconds[name]:>8.2f} "
+            f"{sum(record['prompt_tokens'] for record in group):>15} "
+            f"{sum(record['prefill_seconds'] for record in group):>13.2f}"
+        )
+    print(
+        f"Saved {sum(saved_tokens)} prefill tokens, per document "
+        + ", ".join(map(str, saved_tokens))
+    )
+
+
+def entity_labels(content: str) -> dict[str, str]:
+    # Entity to term or type, from the lines ec_prompt_2_postprocess accepts
+    labels = {}
+    for line in content.splitlines():
+        fields = line.strip().split("|||")
+        if len(fields) == 2 and fields[1].lower() in ("term", "type"):
+            labels[fields[0].lower()] = fields[1].lower()
+    return labels
+
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def compare(args: argparse.Namespace) -> None:
+    print(
+        f"{'subset':<12} {'docs':>5} {'same':>5} {'shared':>7} {'same label':>11} "
+        f"{'terms J':>8} {'types J':>8}"
+    )
+    for subset in ("engineering", "scholarly"):
+        paths = [
+            os.path.join(output_dir, subset, "contents.json")
+            for output_dir in (args.baseline, args.candidate)
+        ]
+        if not all(os.path.exists(path) for path in paths):
+            continue
+        baseline, candidate = (json.load(open(path)) for path in paths)
+        doc_ids = [doc_id for doc_id in baseline if doc_id in candidate]
+        shared = same_label = 0
+        entities = {"baseline": {}, "candidate": {}}
+        for doc_id in doc_ids:
+            baseline_labels = entity_labels(baseline[doc_id])
+            candidate_labels = entity_labels(candidate[doc_id])
+            both = baseline_labels.keys() & candidate_labels.keys()
+            shared += len(both)
+            same_label += sum(
+                baseline_labels[name] == candidate_labels[name] for name in both
+            )
+            for name, outputs in (
+                ("baseline", baseline_labels),
+                ("candidate", candidate_labels),
+            ):
+                for entity, label in outputs.items():
+                    entities[name].setdefault(label, set()).add(entity)
+        overlaps = [
+            jaccard(
+                entities["baseline"].get(label, set()),
+                entities["candidate"].get(label, set()),
+            )
+            for label in ("term", "type")
+        ]
+        print(
+            f"{subset:<12} {len(doc_ids):>5} "
+            f"{sum(baseline[doc_id] == candidate[doc_id] for doc_id in doc_ids):>5} "
+            f"{shared:>7} {same_label / shared if shared else 1.0:>11.1%} "
+            f"{overlaps[0]:>8.3f} {overlaps[1]:>8.3f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="joint extraction and classification against the two-script flow"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser(
+        "run", help="prefill tokens and time of both flows on a tiny model"
+    )
+    run_parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny model and synthetic corpora are built once",
+    )
+    run_parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    run_parser.add_argument(
+        "--subset", choices=["engineering", "scholarly"], default="engineering"
+    )
+    run_parser.add_argument("--docs", type=int, default=8)
+    run_parser.add_argument("--doc_words", type=int, default=600)
+    run_parser.add_argument("--max_new_tokens", type=int, default=32)
+    run_parser.add_argument("--hidden_size", type=int, default=512)
+    run_parser.add_argument("--layers", type=int, default=4)
+    run_parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="agreement of the EC Prompt 2 outputs of two pipeline runs"
+    )
+    compare_parser.add_argument(
+        "baseline", help="output directory of a run without --joint"
+    )
+    compare_parser.add_argument(
+        "candidate", help="output directory of a run with --joint"
+    )
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
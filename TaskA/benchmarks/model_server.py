@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from src.model_server import ModelServerBackend
+
+from .tiny import build_corpus, build_tiny_model
+
+
+def wait_for_server(server: subprocess.Popen, path: str, timeout: float) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"The model server exited with {server.returncode}")
+        try:
+            ModelServerBackend.connect(path).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    sys.exit(f"The model server did not listen on {path} within {timeout}s")
+
+
+def read_outputs(output_dir: str) -> dict[str, str]:
+    outputs = {}
+    for subset in ("engineering", "scholarly"):
+        with open(os.path.join(output_dir, subset, "contents.json")) as f:
+            outputs.update(json.load(f))
+    return outputs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="repeated extraction runs with and without the model server"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny model and synthetic corpora are built once",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument("--docs", type=int, default=8)
+    parser.add_argument("--doc_words", type=int, default=200)
+    parser.add_argument("--batch_size", "-b", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=20)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument(
+        "--runs", type=int, default=3, help="script runs timed one after another"
+    )
+    parser.add_argument(
+        "--clients", type=int, default=3, help="script runs started together"
+    )
+    args = parser.parse_args()
+
+    model_dir = os.path.join(args.workdir, f"model_{args.hidden_size}x{args.layers}")
+    data_dir = os.path.join(args.workdir, f"data_{args.docs}x{args.doc_words}")
+    build_tiny_model(
+        model_dir,
+        args.example_dir,
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+    )
+    build_corpus(data_dir, args.example_dir, args.docs, args.doc_words)
+    run_dir = os.path.join(args.workdir, "model_server")
+    socket_path = os.path.join(run_dir, "model_server.sock")
+    os.makedirs(run_dir, exist_ok=True)
+    script_args = [
+        "1",
+        "-d",
+        data_dir,
+        "-m",
+        model_dir,
+        "--device",
+        "cpu",
+        "-b",
+        str(args.batch_size),
+        "--no_cache",
+        "--max_new_tokens",
+        str(args.max_new_tokens),
+        "--model_server",
+        socket_path,
+    ]
+
+    def run_script(name: str, *extra_args: str) -> subprocess.Popen:
+        output_dir = os.path.join(run_dir, name)
+        return subprocess.Popen(
+            [sys.executable, "entity_extraction.py", *script_args, "-o", output_dir]
+            + list(extra_args),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+
+    def timed_runs(name: str, *extra_args: str) -> float:
+        start_time = time.perf_counter()
+        for run in range(args.runs):
+            script = run_script(f"{name}_{run}", *extra_args)
+            script.communicate()
+            if script.returncode != 0:
+                sys.exit(f"{name} run {run} failed")
+        return (time.perf_counter() - start_time) / args.runs
+
+    seconds = {"in process": timed_runs("local", "--no_model_server")}
+    start_time = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "src.model_server",
+            "-m",
+            model_dir,
+            "--device",
+            "cpu",
+            "--max_new_tokens",
+            str(args.max_new_tokens),
+            "--socket",
+            socket_path,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_server(server, socket_path, timeout=300)
+        server_seconds = time.perf_counter() - start_time
+        seconds["model server"] = timed_runs("server")
+
+        # Concurrent runs, whose prompts the server merges into shared batches
+        metrics_path = os.path.join(run_dir, "metrics.jsonl")
+        if os.path.exists(metrics_path):
+            os.remove(metrics_path)
+        scripts = [
+            run_script(f"client_{client}", "--metrics", metrics_path)
+            for client in range(args.clients)
+        ]
+        used_server = [
+            "Using the model server" in script.communicate()[0] for script in scripts
+        ]
+        if any(script.returncode != 0 for script in scripts):
+            sys.exit("A concurrent run failed")
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(f"{'runs':<14} {'seconds/run':>12}")
+    for name, value in seconds.items():
+        print(f"{name:<14} {value:>12.2f}")
+    print(f"Model server started in {server_seconds:.2f}s, once")
+
+    with open(metrics_path) as f:
+        records = [json.loads(line) for line in f]
+    print(
+        f"{sum(used_server)} of {args.clients} concurrent runs used the server, "
+        f"up to {max(record['clients'] for record in records)} clients per "
+        f"generate call, up to {max(record['batch_size'] for record in records)} "
+        "prompts per batch"
+    )
+
+    # Sequential runs generate the same batches as in process, so greedy
+    # outputs must match. Merged batches pad prompts differently and may not
+    baseline = read_outputs(os.path.join(run_dir, "local_0"))
+    mismatches = [
+        f"server_{run}"
+        for run in range(args.runs)
+        if read_outputs(os.path.join(run_dir, f"server_{run}")) != baseline
+    ]
+    same = sum(
+        read_outputs(os.path.join(run_dir, f"client_{client}")) == baseline
+        for client in range(args.clients)
+    )
+    print(f"{same} of {args.clients} concurrent runs match the in-process outputs")
+    if not all(used_server):
+        sys.exit("A concurrent run loaded the model in process")
+    if mismatches:
+        sys.exit(f"Outputs differ from the in-process run: {', '.join(mismatches)}")
+    print(f"Sequential runs match the in-process outputs, {len(baseline)} documents")
+
+
+if __name__ == "__main__":
+    main()
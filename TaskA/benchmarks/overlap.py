@@ -0,0 +1,93 @@
+import argparse
+import os
+import time
+
+from src import utils
+from src.backends import TransformersBackend
+from src.overlap import StageStats
+from src.quantization import set_threads
+from src.utils import ee_prompt_setup, load_test_docs
+
+from .tiny import build_corpus, build_tiny_model
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="overlapped tokenization and decoding against static batching"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny model and synthetic corpora are built once",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument(
+        "--subset", choices=["engineering", "scholarly"], default="engineering"
+    )
+    parser.add_argument("--docs", type=int, default=64)
+    parser.add_argument("--doc_words", type=int, default=200)
+    parser.add_argument("--batch_size", "-b", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=8)
+    parser.add_argument("--prefetch_batches", type=int, default=2)
+    parser.add_argument("--stage_workers", type=int, default=2)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+    args = parser.parse_args()
+
+    model_dir = os.path.join(args.workdir, f"model_{args.hidden_size}x{args.layers}")
+    data_dir = os.path.join(args.workdir, f"data_{args.docs}x{args.doc_words}")
+    build_tiny_model(
+        model_dir,
+        args.example_dir,
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+    )
+    build_corpus(data_dir, args.example_dir, args.docs, args.doc_words)
+    set_threads(args.threads, None)
+    utils.GENERATION_KWARGS["max_new_tokens"] = args.max_new_tokens
+
+    template, kwargs = ee_prompt_setup("1", args.subset, data_dir, "")
+    prompts = [
+        template.format(**kwargs, title=doc["title"], text=doc["text"])
+        for doc in load_test_docs(data_dir, args.subset)
+    ]
+
+    outputs, seconds = {}, {}
+    print(f"{'scheduler':<12} {'seconds':>8} {'prompts/s':>10}")
+    for scheduler in ("static", "overlapped"):
+        backend = TransformersBackend(
+            model_dir,
+            device_map=None,
+            scheduler=scheduler,
+            prefetch_batches=args.prefetch_batches,
+            stage_workers=args.stage_workers,
+        )
+        # Warm up the kernels before timing
+        backend.generate(prompts[: args.batch_size], batch_size=args.batch_size)
+        if backend.stage_stats is not None:
+            backend.stage_stats = StageStats()
+        start_time = time.perf_counter()
+        outputs[scheduler] = backend.generate(prompts, batch_size=args.batch_size)
+        seconds[scheduler] = time.perf_counter() - start_time
+        print(
+            f"{scheduler:<12} {seconds[scheduler]:>8.2f} "
+            f"{len(prompts) / seconds[scheduler]:>10.1f}"
+        )
+    print(backend.stage_stats.report())
+    same = sum(a == b for a, b in zip(outputs["static"], outputs["overlapped"]))
+    print(
+        f"Speedup {seconds['static'] / seconds['overlapped']:.2f}x, "
+        f"{same} of {len(prompts)} outputs identical"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import random
+import time
+from typing import Any, Callable
+
+from src.utils import (
+    ec_prompt_1_preprocess,
+    ee_postprocess,
+    entity_columns,
+    entity_names,
+)
+
+from .tiny import WORDS
+
+
+# The per-field helpers the single-pass parser replaced, kept as the baseline
+def raw_ee_line2entity(entity_line: str, lower: bool = True) -> str:
+    if lower:
+        return entity_line.strip().split("|||")[1].lower()
+    else:
+        return entity_line.strip().split("|||")[1]
+
+
+def raw_ee_line2cat(entity_line: str, lower: bool = True) -> str:
+    if lower:
+        return entity_line.strip().split("|||")[2].lower()
+    else:
+        return entity_line.strip().split("|||")[2]
+
+
+def raw_ee_line2des(entity_line: str, lower: bool = True) -> str:
+    if lower:
+        return entity_line.strip().split("|||")[3].strip().lower()
+    else:
+        return entity_line.strip().split("|||")[3].strip()
+
+
+def legacy_ee_postprocess(contents: dict[str, str]) -> list[str]:
+    all_extracted_entities = []
+    for doc_id in contents:
+        all_extracted_entities += [
+            raw_ee_line2entity(entity_line)
+            for entity_line in contents[doc_id].splitlines()
+        ]
+    return list(dict.fromkeys(all_extracted_entities))
+
+
+def legacy_ec_prompt_1_preprocess(ee_contents: dict[str, Any]) -> str:
+    list_of_entities_with_description = ""
+    for doc_id, content in ee_contents.items():
+        for entity_line in content.splitlines():
+            entity_name = raw_ee_line2entity(entity_line)
+            try:
+                entity_desc = raw_ee_line2des(entity_line, lower=False)
+            except:
+                entity_desc = raw_ee_line2cat(entity_line, lower=False)
+            list_of_entities_with_description += f"{entity_name}: {entity_desc}\n"
+    return list_of_entities_with_description
+
+
+def legacy_all_fields(contents: dict[str, str]) -> list[tuple[str, str, str]]:
+    fields = []
+    for content in contents.values():
+        for entity_line in content.splitlines():
+            try:
+                entity_desc = raw_ee_line2des(entity_line, lower=False)
+            except:
+                entity_desc = None
+            fields.append(
+                (
+                    raw_ee_line2entity(entity_line, lower=False),
+                    raw_ee_line2cat(entity_line, lower=False),
+                    entity_desc,
+                )
+            )
+    return fields
+
+
+def build_contents(num_lines: int, lines_per_doc: int, seed: int) -> dict[str, str]:
+    # One line in ten has no description, like truncated model output
+    rng = random.Random(seed)
+    contents = {}
+    for doc_index in range(-(-num_lines // lines_per_doc)):
+        lines = []
+        for _ in range(min(lines_per_doc, num_lines - doc_index * lines_per_doc)):
+            name = " ".join(rng.choices(WORDS, k=rng.randint(1, 3)))
+            entity_type = rng.choice(WORDS).title()
+            if rng.random() < 0.1:
+                lines.append(f'("entity"|||{name}|||{entity_type})')
+            else:
+                description = " ".join(rng.choices(WORDS, k=rng.randint(4, 12)))
+                lines.append(f'("entity"|||{name}|||{entity_type}|||{description}.)')
+        contents[f"doc_{doc_index}"] = "\n".join(lines)
+    return contents
+
+
+def best_time(run: Callable[[], Any], repeats: int) -> float:
+    seconds = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        run()
+        seconds = min(seconds, time.perf_counter() - start_time)
+    return seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="entity-line parsing speed against the per-field helpers"
+    )
+    parser.add_argument("--lines", type=int, default=2_000_000)
+    parser.add_argument("--lines_per_doc", type=int, default=40)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    contents = build_contents(args.lines, args.lines_per_doc, args.seed)
+    # Same output before timing anything
+    assert legacy_ee_postprocess(contents) == ee_postprocess(contents)
+    assert legacy_ec_prompt_1_preprocess(contents) == ec_prompt_1_preprocess(contents)
+
+    stages = [
+        ("ee_postprocess", legacy_ee_postprocess, ee_postprocess),
+        (
+            "ec_prompt_1_preprocess",
+            legacy_ec_prompt_1_preprocess,
+            ec_prompt_1_preprocess,
+        ),
+        (
+            "name column",
+            lambda contents: [
+                raw_ee_line2entity(line, lower=False)
+                for content in contents.values()
+                for line in content.splitlines()
+            ],
+            lambda contents: list(entity_names(contents.values())),
+        ),
+        ("all columns", legacy_all_fields, entity_columns),
+    ]
+    print(f"{args.lines} lines in {len(contents)} documents")
+    print(f"{'stage':<24} {'helpers s':>10} {'parser s':>10} {'speedup':>8}")
+    for name, legacy, current in stages:
+        current_seconds = best_time(lambda: current(contents), args.repeats)
+        legacy_seconds = best_time(lambda: legacy(contents), args.repeats)
+        print(
+            f"{name:<24} {legacy_seconds:>10.3f} {current_seconds:>10.3f} "
+            f"{legacy_seconds / current_seconds:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import argparse
+import io
+import json
+import os
+import time
+
+import torch
+from src import utils
+from src.quantization import load_cpu_model, quantized_path, set_threads
+from src.utils import (
+    ee_prompt_setup,
+    entity_names,
+    load_test_docs,
+    load_train_docs,
+    qwen_gen_batch,
+)
+from transformers import AutoModelForCausalLM, AutoTokenizer, PreTrainedModel
+
+from .tiny import build_corpus, build_tiny_model
+
+MODES = ("fp32", "bf16", "int8")
+
+
+def weights_mb(model: PreTrainedModel) -> float:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def load_model(model_dir: str, mode: str, quantized_dir: str) -> PreTrainedModel:
+    if mode == "bf16":
+        return AutoModelForCausalLM.from_pretrained(
+            model_dir, torch_dtype=torch.bfloat16
+        )
+    return load_cpu_model(
+        model_dir, "int8" if mode == "int8" else "none", quantized_dir
+    )
+
+
+def entity_f1(predicted: set[str], gold: set[str]) -> float:
+    if not predicted or not gold:
+        return 0.0
+    overlap = len(predicted & gold)
+    return 2 * overlap / (len(predicted) + len(gold))
+
+
+def token_agreement(tokenizer: AutoTokenizer, reference: str, output: str) -> float:
+    # Share of the reference tokens generated identically before the first
+    # difference, 1.0 for the same output
+    reference_ids = tokenizer(reference, add_special_tokens=False).input_ids
+    output_ids = tokenizer(output, add_special_tokens=False).input_ids
+    length = max(len(reference_ids), len(output_ids))
+    if length == 0:
+        return 1.0
+    same = 0
+    for reference_id, output_id in zip(reference_ids, output_ids):
+        if reference_id != output_id:
+            break
+        same += 1
+    return same / length
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="CPU tokens/sec, memory and extraction agreement of fp32, bf16 "
+        "and int8 weights"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny model and synthetic corpora are built once",
+    )
+    parser.add_argument(
+        "--model",
+        "-m",
+        default=None,
+        help="model path to measure instead of the tiny random model",
+    )
+    parser.add_argument(
+        "--data_dir",
+        "-d",
+        default=None,
+        help="with --model, path to the input data directory",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument(
+        "--subset", choices=["engineering", "scholarly"], default="engineering"
+    )
+    parser.add_argument("--docs", type=int, default=8)
+    parser.add_argument("--doc_words", type=int, default=200)
+    parser.add_argument("--batch_size", "-b", type=int, default=4)
+    parser.add_argument("--max_new_tokens", type=int, default=32)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+    parser.add_argument(
+        "--interop_threads", type=int, default=None, help="torch inter-op threads"
+    )
+    args = parser.parse_args()
+
+    set_threads(args.threads, args.interop_threads)
+    if args.model is None:
+        model_dir = os.path.join(
+            args.workdir, f"model_{args.hidden_size}x{args.layers}"
+        )
+        data_dir = os.path.join(args.workdir, f"data_{args.docs}x{args.doc_words}")
+        build_tiny_model(
+            model_dir,
+            args.example_dir,
+            hidden_size=args.hidden_size,
+            num_layers=args.layers,
+        )
+        build_corpus(data_dir, args.example_dir, args.docs, args.doc_words)
+    else:
+        model_dir, data_dir = args.model, args.data_dir
+    quantized_dir = os.path.join(args.workdir, "quantized")
+    utils.GENERATION_KWARGS["max_new_tokens"] = args.max_new_tokens
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    template, kwargs = ee_prompt_setup("1", args.subset, data_dir, "")
+    test_prompts = [
+        template.format(**kwargs, title=doc["title"], text=doc["text"])
+        for doc in load_test_docs(data_dir, args.subset)[: args.docs]
+    ]
+    # The few-shot example documents come with reference extractions
+    with open(
+        os.path.join(
+            args.example_dir, f"entity_extraction/{args.subset}/doc_examples.json"
+        )
+    ) as f:
+        example_outputs = json.load(f)
+    example_docs = load_train_docs(data_dir, args.subset, example_outputs)
+    example_prompts = [
+        template.format(**kwargs, title=doc["title"], text=doc["text"])
+        for doc in example_docs
+    ]
+
+    results, example_contents = {}, {}
+    for mode in MODES:
+        result = {}
+        if mode == "int8":
+            # Converted once, later starts read the saved int8 weights
+            path = quantized_path(model_dir, quantized_dir)
+            if os.path.exists(path):
+                os.remove(path)
+            start_time = time.perf_counter()
+            load_model(model_dir, mode, quantized_dir)
+            result["convert_s"] = round(time.perf_counter() - start_time, 2)
+        start_time = time.perf_counter()
+        model = load_model(model_dir, mode, quantized_dir)
+        result["load_s"] = round(time.perf_counter() - start_time, 2)
+        # What the weights occupy in memory; process RSS is not comparable
+        # between modes loaded one after another in the same process
+        result["weights_mb"] = round(weights_mb(model), 1)
+
+        start_time = time.perf_counter()
+        qwen_gen_batch(test_prompts, tokenizer, model, batch_size=args.batch_size)
+        seconds = time.perf_counter() - start_time
+        # The tiny model never ends early, with --model this is an upper bound
+        result["tokens_per_sec"] = round(
+            len(test_prompts) * args.max_new_tokens / seconds, 1
+        )
+
+        example_contents[mode] = qwen_gen_batch(
+            example_prompts, tokenizer, model, batch_size=args.batch_size
+        )
+        result["entity_f1"] = round(
+            sum(
+                entity_f1(
+                    set(entity_names([content])),
+                    set(entity_names([example_outputs[doc["id"]]])),
+                )
+                for doc, content in zip(example_docs, example_contents[mode])
+            )
+            / len(example_docs),
+            3,
+        )
+        result["same_as_fp32"] = sum(
+            content == reference
+            for content, reference in zip(
+                example_contents[mode], example_contents["fp32"]
+            )
+        )
+        result["token_agreement"] = round(
+            sum(
+                token_agreement(tokenizer, reference, content)
+                for content, reference in zip(
+                    example_contents[mode], example_contents["fp32"]
+                )
+            )
+            / len(example_docs),
+            3,
+        )
+        results[mode] = result
+        del model
+
+    print(
+        f"{len(test_prompts)} prompts x {args.max_new_tokens} tokens, "
+        f"{len(example_docs)} example documents, {torch.get_num_threads()} threads"
+    )
+    columns = list(results["int8"])
+    print(f"{'mode':<6}" + "".join(f"{column:>16}" for column in columns))
+    for mode, result in results.items():
+        print(
+            f"{mode:<6}"
+            + "".join(f"{str(result.get(column, '')):>16}" for column in columns)
+        )
+
+
+if __name__ == "__main__":
+    main()
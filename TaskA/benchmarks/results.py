@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Callable
+
+from src.postprocess import SUBSETS
+from src.results import ResultsStore, ec_prompt_2_entity_rows
+from src.utils import ec_prompt_2_postprocess
+
+
+def synthetic_contents(
+    rng: random.Random, docs: int, entities_per_doc: int, vocabulary: int, flip: float
+) -> dict[str, str]:
+    # EC Prompt 2 responses. Each entity has a fixed label that a run flips
+    # with probability flip
+    contents = {}
+    for doc in range(docs):
+        lines = []
+        for entity in rng.sample(range(vocabulary), entities_per_doc):
+            label = ("term", "type")[(entity % 3 == 0) ^ (rng.random() < flip)]
+            lines.append(f"entity {entity}|||{label}")
+        contents[f"doc_{doc}"] = "\n".join(lines)
+    return contents
+
+
+def best_ms(run: Callable[[], Any], repeats: int) -> tuple[float, Any]:
+    seconds = float("inf")
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = run()
+        seconds = min(seconds, time.perf_counter() - start_time)
+    return seconds * 1000, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="bulk inserts and cross-run queries of the results store"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the synthetic runs are written",
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--docs", type=int, default=10000, help="per subset")
+    parser.add_argument("--entities_per_doc", type=int, default=10)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument(
+        "--flip", type=float, default=0.05, help="share of labels a run flips"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--max_ms",
+        type=float,
+        default=100.0,
+        help="time a query between two runs may take",
+    )
+    args = parser.parse_args()
+
+    run_dir = os.path.join(args.workdir, "results")
+    os.makedirs(run_dir, exist_ok=True)
+    path = os.path.join(run_dir, "results.sqlite")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    store = ResultsStore(path)
+
+    rng = random.Random(0)
+    insert_seconds = 0.0
+    rows_inserted = 0
+    outputs = {}
+    for run in range(args.runs):
+        run_id = store.start_run(f"run_{run}", variant="ec2")
+        for subset in SUBSETS:
+            contents = synthetic_contents(
+                rng, args.docs, args.entities_per_doc, args.vocabulary, args.flip
+            )
+            terms, types = ec_prompt_2_postprocess(contents)
+            rows = ec_prompt_2_entity_rows(contents)
+            start_time = time.perf_counter()
+            store.save_subset(run_id, "ec", subset, contents, rows, terms, types)
+            insert_seconds += time.perf_counter() - start_time
+            rows_inserted += len(rows)
+            if run < 2:
+                outputs[run, subset] = contents, terms, types
+    print(
+        f"Inserted {rows_inserted} entity rows of {args.runs} runs in "
+        f"{insert_seconds:.1f}s, {rows_inserted / insert_seconds:,.0f} rows/s, "
+        f"{os.path.getsize(path) / 1024 / 1024:.0f} MB"
+    )
+
+    # The same diff from saved JSON, the way runs were compared before
+    def json_diff() -> int:
+        labels = []
+        for run in range(2):
+            run_labels = {}
+            for subset in SUBSETS:
+                with open(os.path.join(run_dir, f"contents_{run}_{subset}.json")) as f:
+                    contents = json.load(f)
+                terms, types = ec_prompt_2_postprocess(contents)
+                for entity in terms:
+                    run_labels[subset, entity] = 1
+                for entity in types:
+                    run_labels[subset, entity] = run_labels.get((subset, entity), 0) | 2
+            labels.append(run_labels)
+        return sum(
+            labels[0][key] != labels[1][key] for key in labels[0].keys() & labels[1]
+        )
+
+    for (run, subset), (contents, _, _) in outputs.items():
+        with open(os.path.join(run_dir, f"contents_{run}_{subset}.json"), "w") as f:
+            json.dump(contents, f)
+
+    run_a, run_b = store.run_id("run_0"), store.run_id("run_1")
+    entity = "entity 3"
+    doc_id = "doc_0"
+    timings = {}
+    timings["json diff"], expected = best_ms(json_diff, 1)
+    timings["diff"], differences = best_ms(
+        lambda: store.diff(run_a, run_b), args.repeats
+    )
+    timings["only in a"], _ = best_ms(lambda: store.only_in(run_a, run_b), args.repeats)
+    timings["entity"], entity_rows = best_ms(
+        lambda: store.entity_labels(entity), args.repeats
+    )
+    timings["doc"], doc_rows = best_ms(lambda: store.doc_entities(doc_id), args.repeats)
+    timings["export"], (terms, _) = best_ms(
+        lambda: store.labels(run_a, "ec", SUBSETS[0]), args.repeats
+    )
+    store.close()
+
+    print(f"{'query':<12} {'ms':>10}")
+    for name, value in timings.items():
+        print(f"{name:<12} {value:>10.2f}")
+    print(
+        f"{len(differences)} entities labelled differently by run_0 and run_1, "
+        f"{len(entity_rows)} labels of {entity!r}, {len(doc_rows)} rows of {doc_id}"
+    )
+
+    failures = []
+    if len(differences) != expected:
+        failures.append(f"diff found {len(differences)} entities, JSON {expected}")
+    if terms != outputs[0, SUBSETS[0]][1]:
+        failures.append("exported terms differ from ec_prompt_2_postprocess")
+    slow = [
+        name
+        for name, value in timings.items()
+        if name != "json diff" and value > args.max_ms
+    ]
+    if slow:
+        failures.append(f"{', '.join(slow)} took more than {args.max_ms} ms")
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
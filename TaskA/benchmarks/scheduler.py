@@ -0,0 +1,175 @@
+import argparse
+import os
+import random
+import time
+from typing import Any
+
+import torch
+from src import utils
+from src.backends import TransformersBackend
+from src.scheduler import qwen_gen_continuous
+from src.stopping import GenerationGuard
+from src.telemetry import percentile
+from transformers import LogitsProcessor
+
+from .tiny import build_tiny_model, synthetic_text
+
+
+class TargetLengthProcessor(LogitsProcessor):
+    # Forces the end token once a row reaches the target length of its prompt,
+    # since the random model never ends on its own
+    def __init__(
+        self,
+        targets: list[int],
+        input_length: int,
+        end_token_id: int,
+    ) -> None:
+        self.targets = targets
+        self.input_length = input_length
+        self.end_token_id = end_token_id
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        num_tokens = input_ids.shape[1] - self.input_length
+        for row, target in enumerate(self.targets):
+            if num_tokens >= target - 1:
+                scores[row] = -float("inf")
+                scores[row, self.end_token_id] = 0.0
+        return scores
+
+
+class TargetLengthGuard(GenerationGuard):
+    # Output lengths keyed by prompt tokens, so both schedulers generate the
+    # same number of tokens for the same prompt whatever the batch it lands in
+    def __init__(self, targets: dict[tuple[int, ...], int]) -> None:
+        super().__init__("ee", stop_loops=False)
+        self.targets = targets
+
+    def generate_kwargs(
+        self,
+        model_inputs: dict[str, Any],
+        tokenizer,
+        model,
+        enable_thinking: bool,
+        max_new_tokens: int,
+    ) -> dict[str, Any]:
+        generation_kwargs = super().generate_kwargs(
+            model_inputs, tokenizer, model, enable_thinking, max_new_tokens
+        )
+        targets = [
+            self.targets[tuple(ids[mask.bool()].tolist())]
+            for ids, mask in zip(
+                model_inputs["input_ids"], model_inputs["attention_mask"]
+            )
+        ]
+        generation_kwargs["logits_processor"].append(
+            TargetLengthProcessor(
+                targets, model_inputs["input_ids"].shape[1], tokenizer.eos_token_id
+            )
+        )
+        return generation_kwargs
+
+
+def build_prompts(
+    num_prompts: int, prompt_words: int, median_tokens: int, max_tokens: int, seed: int
+) -> tuple[list[str], list[int]]:
+    # Log-normal output lengths: most answers are short, a few run very long
+    rng = random.Random(seed)
+    prompts = [synthetic_text(rng, prompt_words) for _ in range(num_prompts)]
+    lengths = [
+        max(4, min(max_tokens, int(rng.lognormvariate(0, 1) * median_tokens)))
+        for _ in range(num_prompts)
+    ]
+    return prompts, lengths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="continuous against static batching on skewed output lengths"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the tiny model is built once",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument("--prompts", type=int, default=64)
+    parser.add_argument("--prompt_words", type=int, default=100)
+    parser.add_argument("--median_tokens", type=int, default=40)
+    parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--batch_size", "-b", type=int, default=8)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch intra-op threads"
+    )
+    args = parser.parse_args()
+
+    model_dir = os.path.join(args.workdir, f"model_{args.hidden_size}x{args.layers}")
+    build_tiny_model(
+        model_dir,
+        args.example_dir,
+        hidden_size=args.hidden_size,
+        num_layers=args.layers,
+    )
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    utils.GENERATION_KWARGS["max_new_tokens"] = args.max_new_tokens
+    backend = TransformersBackend(model_dir, device_map=None)
+    tokenizer, model = backend.tokenizer, backend.model
+
+    prompts, lengths = build_prompts(
+        args.prompts,
+        args.prompt_words,
+        args.median_tokens,
+        args.max_new_tokens,
+        args.seed,
+    )
+    targets = {}
+    for prompt, length in zip(prompts, lengths):
+        text = utils.render_chat(tokenizer, prompt)
+        targets[tuple(tokenizer(text, add_special_tokens=False).input_ids)] = length
+    guard = TargetLengthGuard(targets)
+    print(
+        f"{len(prompts)} prompts, output tokens p50 {percentile(lengths, 0.5)}, "
+        f"p95 {percentile(lengths, 0.95)}, max {max(lengths)}, total {sum(lengths)}"
+    )
+
+    outputs, seconds = {}, {}
+    print(f"{'scheduler':<12} {'seconds':>8} {'tok/s':>8} {'p50 s':>7} {'p95 s':>7}")
+    for name, generate in (
+        ("static", utils.qwen_gen_batch),
+        ("continuous", qwen_gen_continuous),
+    ):
+        latencies = {}
+        start_time = time.perf_counter()
+        outputs[name] = generate(
+            prompts,
+            tokenizer,
+            model,
+            batch_size=args.batch_size,
+            guard=guard,
+            on_output=lambda i, content: latencies.setdefault(
+                i, time.perf_counter() - start_time
+            ),
+        )
+        seconds[name] = time.perf_counter() - start_time
+        print(
+            f"{name:<12} {seconds[name]:>8.2f} {sum(lengths) / seconds[name]:>8.1f} "
+            f"{percentile(list(latencies.values()), 0.5):>7.2f} "
+            f"{percentile(list(latencies.values()), 0.95):>7.2f}"
+        )
+    # Greedy decoding, so the schedule must not change a single token
+    assert outputs["static"] == outputs["continuous"]
+    print(f"Speedup {seconds['static'] / seconds['continuous']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
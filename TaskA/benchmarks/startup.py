@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from .tiny import build_corpus
+
+# Modules only the generation paths may import
+HEAVY_MODULES = ("torch", "transformers")
+CLI_MODULES = ("entity_extraction", "entity_classification", "pipeline")
+
+
+def import_stats(module: str) -> dict[str, object]:
+    # A fresh interpreter, the way a CLI starts
+    code = (
+        "import json, sys, time\n"
+        "start_time = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(json.dumps({'seconds': time.perf_counter() - start_time, "
+        f"'heavy': [name for name in {HEAVY_MODULES!r} if name in sys.modules]}}))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_stats(script: str, *args: str) -> dict[str, object]:
+    # A whole run in a fresh interpreter, with the heavy modules it imported
+    # and its peak memory
+    code = (
+        "import json, runpy, sys\n"
+        f"sys.argv = {[script, *args]!r}\n"
+        f"runpy.run_path({script!r}, run_name='__main__')\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        # ru_maxrss would include the benchmark process this one forked from
+        "status = open('/proc/self/status').read().split()\n"
+        "rss = int(status[status.index('VmHWM:') + 1])\n"
+        "print(json.dumps({'heavy': heavy, 'rss_mb': rss / 1024}))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_script(*args: str) -> float:
+    start_time = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args], check=True, stdout=subprocess.DEVNULL, stderr=None
+    )
+    return time.perf_counter() - start_time
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="import time of the CLIs and of the postprocess subcommand, "
+        "failing when it regresses"
+    )
+    parser.add_argument(
+        "--workdir",
+        default="output/benchmarks",
+        help="path where the synthetic corpus and mock outputs are built once",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--doc_words", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--max_seconds",
+        type=float,
+        default=1.0,
+        help="wall time a postprocess run may take for all subsets",
+    )
+    args = parser.parse_args()
+
+    data_dir = os.path.join(args.workdir, f"data_{args.docs}x{args.doc_words}")
+    build_corpus(data_dir, args.example_dir, args.docs, args.doc_words)
+    # Saved responses to rebuild from, written once with the mock backend
+    output_dir = os.path.join(args.workdir, f"startup_{args.docs}x{args.doc_words}")
+    output_dirs = {
+        "ee": os.path.join(output_dir, "ee"),
+        "ec1": os.path.join(output_dir, "ec1"),
+        "ec2": os.path.join(output_dir, "ec2"),
+    }
+    mock_args = [
+        "-d",
+        data_dir,
+        "-e",
+        args.example_dir,
+        "--backend",
+        "mock",
+        "--no_cache",
+    ]
+    if not os.path.exists(os.path.join(output_dirs["ee"], "scholarly/terms.txt")):
+        run_script("entity_extraction.py", "1", *mock_args, "-o", output_dirs["ee"])
+    for prompt in ("1", "2"):
+        if not os.path.exists(
+            os.path.join(output_dirs[f"ec{prompt}"], "scholarly/terms.txt")
+        ):
+            run_script(
+                "entity_classification.py",
+                prompt,
+                *mock_args,
+                "--ee_output_dir",
+                output_dirs["ee"],
+                "-o",
+                output_dirs[f"ec{prompt}"],
+            )
+
+    failures = []
+    print(f"{'import':<24} {'seconds':>8}  heavy modules")
+    for module in CLI_MODULES:
+        stats = import_stats(module)
+        print(
+            f"{module:<24} {stats['seconds']:>8.3f}  {', '.join(stats['heavy']) or '-'}"
+        )
+        if stats["heavy"]:
+            failures.append(f"{module} imports {', '.join(stats['heavy'])}")
+
+    # Runs that do not generate in process must not import them either
+    print(f"\n{'mock run':<24} {'RSS MB':>8}  heavy modules")
+    for name, script, script_args in (
+        ("ee", "entity_extraction.py", ["1"]),
+        (
+            "ec2",
+            "entity_classification.py",
+            ["2", "--ee_output_dir", output_dirs["ee"]],
+        ),
+        ("pipeline", "pipeline.py", ["1", "1"]),
+    ):
+        stats = run_stats(
+            script,
+            *script_args,
+            *mock_args,
+            "-o",
+            os.path.join(output_dir, f"mock_{name}"),
+        )
+        print(f"{name:<24} {stats['rss_mb']:>8.0f}  {', '.join(stats['heavy']) or '-'}")
+        if stats["heavy"]:
+            failures.append(f"a mock {name} run imports {', '.join(stats['heavy'])}")
+
+    print(f"\n{'postprocess':<24} {'seconds':>8}")
+    for name, script in (
+        ("ee", "entity_extraction.py"),
+        ("ec1", "entity_classification.py"),
+        ("ec2", "entity_classification.py"),
+    ):
+        seconds = min(
+            run_script(script, "postprocess", "-o", output_dirs[name])
+            for _ in range(args.repeats)
+        )
+        print(f"{name:<24} {seconds:>8.3f}")
+        if seconds > args.max_seconds:
+            failures.append(f"{name} postprocess took {seconds:.2f}s")
+
+    if failures:
+        sys.exit(f"{len(failures)} regressions: " + "; ".join(failures))
+    print(f"\n{args.docs} documents per subset, all under {args.max_seconds}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import glob
+import json
+import os
+import random
+
+import torch
+from src import prompts
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<think>", "</think>"]
+
+# The parts of the Qwen3 chat template that render_chat relies on
+CHAT_TEMPLATE = (
+    "{%- for message in messages %}"
+    "<|im_start|>{{ message.role }}\n{{ message.content }}<|im_end|>\n"
+    "{%- endfor %}"
+    "{%- if add_generation_prompt %}<|im_start|>assistant\n"
+    "{%- if enable_thinking is defined and enable_thinking is false %}"
+    "<think>\n\n</think>\n\n"
+    "{%- endif %}{%- endif %}"
+)
+
+WORDS = (
+    "bean soybean pulse legume product food category ingredient kelvin celsius "
+    "scale unit energy joule calorie watt magnitude field vector force charge "
+    "length meter yard volume weight pronoun noun verb case frame clause tense "
+    "mood aspect grammar phoneme morpheme syntax semantics lexicon dialect"
+).split()
+
+
+def synthetic_text(rng: random.Random, num_words: int) -> str:
+    sentences = []
+    while num_words > 0:
+        length = min(num_words, rng.randint(6, 16))
+        words = rng.choices(WORDS, k=length)
+        sentences.append(" ".join(words).capitalize() + ".")
+        num_words -= length
+    return " ".join(sentences)
+
+
+def build_tokenizer(
+    path: str, example_dir: str, vocab_size: int = 8192
+) -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    # Trained on the prompts too, so prompt lengths stay close to the real tokenizer
+    rng = random.Random(0)
+    texts = [synthetic_text(rng, 200) for _ in range(50)]
+    texts += [value for value in vars(prompts).values() if isinstance(value, str)]
+    texts += [
+        json.dumps(json.load(open(path)))
+        for path in sorted(glob.glob(os.path.join(example_dir, "*/*/*.json")))
+    ]
+    tokenizer.train_from_iterator(texts * 4, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        chat_template=CHAT_TEMPLATE,
+        model_input_names=["input_ids", "attention_mask"],
+    )
+    tokenizer.save_pretrained(path)
+    return tokenizer
+
+
+def build_tiny_model(
+    path: str,
+    example_dir: str,
+    hidden_size: int = 64,
+    num_layers: int = 2,
+    seed: int = 0,
+) -> None:
+    # Randomly initialized Qwen3 architecture, saved with its tokenizer so it
+    # loads with from_pretrained like the real model
+    if os.path.exists(os.path.join(path, "config.json")):
+        return
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer(path, example_dir)
+    config = Qwen3Config(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        head_dim=hidden_size // 4,
+        max_position_embeddings=32768,
+        tie_word_embeddings=True,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = Qwen3ForCausalLM(config)
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    # Never end early, so every prompt decodes exactly max_new_tokens
+    model.generation_config.suppress_tokens = [tokenizer.eos_token_id]
+    model.save_pretrained(path)
+
+
+def build_corpus(
+    data_dir: str,
+    example_dir: str,
+    num_docs: int,
+    doc_words: int,
+    seed: int = 0,
+) -> None:
+    # Test documents plus the training documents the few-shot examples refer to
+    rng = random.Random(seed)
+    for subset in ("engineering", "scholarly"):
+        test_dir = os.path.join(data_dir, subset, "test")
+        train_dir = os.path.join(data_dir, subset, "train")
+        os.makedirs(test_dir, exist_ok=True)
+        os.makedirs(train_dir, exist_ok=True)
+        with open(
+            os.path.join(test_dir, f"text2onto_{subset}_test_documents.jsonl"), "w"
+        ) as fout:
+            for i in range(num_docs):
+                doc = {
+                    "id": f"{subset}_test_{i}",
+                    "title": " ".join(rng.choices(WORDS, k=3)).title(),
+                    "text": synthetic_text(
+                        rng, rng.randint(doc_words // 2, doc_words * 3 // 2)
+                    ),
+                }
+                fout.write(json.dumps(doc) + "\n")
+
+        example_ids = set()
+        for examples_file in (
+            f"entity_extraction/{subset}/doc_examples.json",
+            f"entity_classification/{subset}/example_doc_entities.json",
+        ):
+            with open(os.path.join(example_dir, examples_file)) as f:
+                example_ids |= set(json.load(f))
+        with open(os.path.join(train_dir, "documents.jsonl"), "w") as fout:
+            for doc_id in sorted(example_ids):
+                doc = {
+                    "id": doc_id,
+                    "title": " ".join(rng.choices(WORDS, k=3)).title(),
+                    "text": synthetic_text(rng, doc_words),
+                }
+                fout.write(json.dumps(doc) + "\n")
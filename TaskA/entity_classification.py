@@ -1,30 +1,64 @@
 import argparse
 import json
 import os
+import time
 
-from src.prompts import (
-    plain_classification_customized_example_string,
-    plain_classification_engineering_customized_examples_prompt,
-    plain_classification_prompt_engineering,
-    plain_classification_prompt_scholarly,
-    plain_classification_scholarly_customized_examples_prompt,
+from src.backends import (
+    add_backend_arguments,
+    load_backend,
+    load_guard,
+    load_telemetry,
+    report_token_savings,
+)
+from src.cache import add_cache_arguments, load_response_cache
+from src.checkpoint import JsonlCheckpoint
+from src.manifest import (
+    add_manifest_arguments,
+    load_manifest,
+    prompt_hash,
+    reuse_unchanged,
+    write_manifest,
+)
+from src.postprocess import rebuild_outputs
+from src.results import (
+    add_results_arguments,
+    ec_prompt_1_entity_rows,
+    ec_prompt_2_entity_rows,
+    load_results,
+    write_outputs,
+)
+from src.retrieval import add_retrieval_arguments, few_shot_log_path, load_selector
+from src.sharding import (
+    add_shard_arguments,
+    checkpoint_path,
+    load_shard_records,
+    load_shard_responses,
+    shard_indices,
+    shard_items,
 )
 from src.utils import (
+    ec_prompt_1_entity_names,
+    ec_prompt_1_fan_out,
     ec_prompt_1_generate,
+    ec_prompt_1_pack,
+    ec_prompt_1_parse,
     ec_prompt_1_postprocess,
     ec_prompt_1_preprocess,
     ec_prompt_2_postprocess,
-    ec_prompt_2_preprocess,
-    qwen_gen,
+    ec_prompt_setup,
+    ee_content2entities,
+    open_test_docs,
+    split_prompt_template,
 )
-from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
 
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "prompt", choices=["1", "2"], help="choose between EC Prompt 1 & 2"
+        "prompt",
+        choices=["1", "2", "postprocess"],
+        help="choose between EC Prompt 1 & 2, or rebuild terms.txt and "
+        "types.txt in --output_dir from the saved responses",
     )
     parser.add_argument(
         "--data_dir",
@@ -50,51 +84,183 @@ def main() -> None:
         default="output/LLMs4OL_TaskA_Entity_Classification",
         help="path to output directory",
     )
+    add_backend_arguments(parser)
+    parser.add_argument(
+        "--batch_size",
+        "-b",
+        type=int,
+        default=1,
+        help="number of prompts generated together in one batch",
+    )
+    parser.add_argument(
+        "--dedup_entities",
+        action="store_true",
+        help="with Prompt 1, classify each distinct entity name only once. Its "
+        "result is repeated for every entity line, in document order, in "
+        "classification_responses.json; "
+        "terms.txt and types.txt list each entity once either way",
+    )
+    parser.add_argument(
+        "--entities_per_prompt",
+        type=int,
+        default=1,
+        help="with Prompt 1, number of entities packed into each prompt",
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="with Prompt 2, prefill the shared few-shot examples once per subset",
+    )
+    parser.add_argument(
+        "--check_prefix_cache",
+        action="store_true",
+        help="verify on the first document that the prefix cache keeps greedy output",
+    )
+    parser.add_argument(
+        "--compare_constrained",
+        type=int,
+        default=0,
+        metavar="N",
+        help="with --constrained, report tokens saved on the first N prompts "
+        "against an unconstrained run",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip prompts already recorded in the response checkpoint",
+    )
+    add_retrieval_arguments(parser)
+    add_manifest_arguments(parser)
+    add_shard_arguments(parser)
+    add_results_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
+    if args.prompt == "postprocess":
+        rebuild_outputs("ec", args.output_dir)
+        return
+    if args.compare_constrained and not args.constrained:
+        parser.error("--compare_constrained needs --constrained")
+    if (args.few_shot_k or args.prompt_token_budget) and args.prompt != "2":
+        parser.error("--few_shot_k and --prompt_token_budget need Prompt 2")
+    if (args.few_shot_k or args.prompt_token_budget) and args.prefix_cache:
+        parser.error("--prefix_cache needs the same examples in every prompt")
 
-    # Load model and tokenizer
-    model_name = "Qwen/Qwen3-8B"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name, torch_dtype="auto", device_map="auto"
+    # Load inference backend, a merge only reads finished shards
+    backend = None if args.merge else load_backend(args)
+    guard = load_guard(
+        args, "ec", grammar="ec_json" if args.prompt == "1" else "ec_lines"
     )
+    response_cache = load_response_cache(args)
+    variant = f"ec{args.prompt}" + (
+        "-bm25" if args.few_shot_k or args.prompt_token_budget else ""
+    )
+    telemetry = load_telemetry(args, variant=variant)
+    results = load_results(args, "ec", variant, backend)
 
     subsets = ("engineering", "scholarly")
     for subset in subsets:
-        # Load data
-        testdata_dir = os.path.join(args.data_dir, f"{subset}/test")
-        with open(
-            os.path.join(testdata_dir, f"text2onto_{subset}_test_documents.jsonl"), "r"
-        ) as f:
-            test_docs = [json.loads(line) for line in f]
-
-        # Load data and prepare the model input
+        # Load data and form prompt
+        test_docs = open_test_docs(args.data_dir, subset)
         ee_contents = json.load(
             open(os.path.join(args.ee_output_dir, f"{subset}/contents.json"))
         )
+        prompt_template, prompt_template_kwargs = ec_prompt_setup(
+            args.prompt, subset, args.data_dir, args.example_dir
+        )
 
-        if args.prompt == "1":
-            if subset == "engineering":
-                prompt_template = plain_classification_prompt_engineering
-            elif subset == "scholarly":
-                prompt_template = plain_classification_prompt_scholarly
+        if telemetry is not None:
+            telemetry.tags["subset"] = subset
 
-            # Prepare model input
-            entities_with_description = ec_prompt_1_preprocess(ee_contents)
+        # Prepare output directory and the checkpoint of streamed responses
+        output_dir = os.path.join(args.output_dir, subset)
+        os.makedirs(output_dir, exist_ok=True)
+        if not args.merge:
+            checkpoint = JsonlCheckpoint(
+                checkpoint_path(output_dir, args.shard), resume=args.resume
+            )
 
-            # Conduct text completion
-            all_class_responses, unreadable_responses = ec_prompt_1_generate(
-                subset,
-                entities_with_description,
-                prompt_template=prompt_template,
-                tokenizer=tokenizer,
-                model=model,
+        if args.prompt == "1":
+            # Prepare model input
+            entities_with_description = ec_prompt_1_preprocess(
+                ee_contents, dedup=args.dedup_entities
             )
 
+            if args.merge:
+                lines, line_keys = ec_prompt_1_pack(
+                    entities_with_description, args.entities_per_prompt
+                )
+                responses = load_shard_responses(output_dir, args.merge)
+                all_class_responses, unreadable_responses = ec_prompt_1_parse(
+                    lines, [responses[key] for key in line_keys]
+                )
+            else:
+                if args.compare_constrained:
+                    lines, _ = ec_prompt_1_pack(
+                        entities_with_description, args.entities_per_prompt
+                    )
+                    lines = shard_items(lines, args.shard)[: args.compare_constrained]
+                    report_token_savings(
+                        backend,
+                        [
+                            prompt_template.format(
+                                list_of_entities_with_description=line
+                            )
+                            for line in lines
+                        ],
+                        [ec_prompt_1_entity_names(line) for line in lines],
+                        guard,
+                    )
+
+                # Conduct text completion
+                start_time = time.perf_counter()
+                all_class_responses, unreadable_responses = ec_prompt_1_generate(
+                    subset,
+                    entities_with_description,
+                    prompt_template=prompt_template,
+                    backend=backend,
+                    batch_size=args.batch_size,
+                    response_cache=response_cache,
+                    guard=guard,
+                    checkpoint=checkpoint,
+                    entities_per_prompt=args.entities_per_prompt,
+                    shard=args.shard,
+                    telemetry=telemetry,
+                    manifest=load_manifest(output_dir) if args.incremental else None,
+                    on_output=(
+                        None
+                        if results is None
+                        else lambda key, response: results.add_response(
+                            subset, key, response
+                        )
+                    ),
+                )
+                elapsed = time.perf_counter() - start_time
+                num_occurrences = sum(
+                    len(content.splitlines()) for content in ee_contents.values()
+                )
+                num_entities = len(entities_with_description.splitlines())
+                num_calls = len(
+                    shard_indices(
+                        -(-num_entities // args.entities_per_prompt), args.shard
+                    )
+                )
+                print(
+                    f"{subset}: {num_occurrences} entity lines, {num_entities} "
+                    f"classified in {num_calls} model calls ({elapsed:.1f}s)"
+                )
+                if args.shard is not None:
+                    continue
+                # Responses by checkpoint key, only read for the results store
+                responses = checkpoint.load() if results is not None else {}
+
+            if args.dedup_entities:
+                all_class_responses, mismatched_responses = ec_prompt_1_fan_out(
+                    all_class_responses, ee_contents
+                )
+                unreadable_responses += mismatched_responses
+
             # Save model responses
-            output_dir = os.path.join(args.output_dir, subset)
-            os.makedirs(output_dir, exist_ok=True)
             json.dump(
                 all_class_responses,
                 open(os.path.join(output_dir, "classification_responses.json"), "w"),
@@ -110,75 +276,141 @@ def main() -> None:
             extracted_terms, extracted_types = ec_prompt_1_postprocess(
                 all_class_responses
             )
+            write_outputs(
+                results,
+                subset,
+                output_dir,
+                extracted_terms,
+                extracted_types,
+                lambda: (responses, ec_prompt_1_entity_rows(responses)),
+            )
 
         elif args.prompt == "2":
-            example_template = plain_classification_customized_example_string
-            if subset == "engineering":
-                prompt_template = (
-                    plain_classification_engineering_customized_examples_prompt
-                )
-            elif subset == "scholarly":
-                prompt_template = (
-                    plain_classification_scholarly_customized_examples_prompt
-                )
+            if args.merge:
+                responses = load_shard_responses(output_dir, args.merge)
+            else:
+                extracted_entities = {
+                    doc_id: ee_content2entities(content)
+                    for doc_id, content in ee_contents.items()
+                }
 
-            example_doc_entities = json.load(
-                open(
-                    os.path.join(
-                        args.example_dir,
-                        f"entity_classification/{subset}/example_doc_entities.json",
+                done = checkpoint.keys()
+                shard_doc_ids = shard_items(test_docs.ids(), args.shard)
+                pending_docs = [
+                    test_docs.get(doc_id)
+                    for doc_id in shard_doc_ids
+                    if doc_id not in done
+                ]
+                prompts = [
+                    prompt_template.format(
+                        **prompt_template_kwargs,
+                        title=test_doc["title"],
+                        text=test_doc["text"],
+                        entities="\n".join(extracted_entities[test_doc["id"]]),
                     )
-                )
-            )
-
-            with open(
-                os.path.join(args.data_dir, f"{subset}/train/documents.jsonl")
-            ) as f:
-                example_train_docs = [
-                    json.loads(line)
-                    for line in f
-                    if json.loads(line)["id"] in example_doc_entities
+                    for test_doc in pending_docs
                 ]
+                selector = load_selector(args, "ec", subset, backend)
+                if selector is not None:
+                    examples_strings = selector.examples_strings(
+                        pending_docs,
+                        few_shot_log_path(checkpoint_path(output_dir, args.shard)),
+                        args.resume,
+                    )
+                    prompts = [
+                        prompt_template.format(
+                            examples_string=examples_string,
+                            title=test_doc["title"],
+                            text=test_doc["text"],
+                            entities="\n".join(extracted_entities[test_doc["id"]]),
+                        )
+                        for test_doc, examples_string in zip(
+                            pending_docs, examples_strings
+                        )
+                    ]
 
-            with open(
-                os.path.join(
-                    args.data_dir,
-                    f"{subset}/test/text2onto_{subset}_test_documents.jsonl",
-                )
-            ) as f:
-                test_docs = [json.loads(line) for line in f]
+                hashes = [prompt_hash(backend, prompt, guard) for prompt in prompts]
+                if args.incremental:
+                    keep = reuse_unchanged(
+                        load_manifest(output_dir),
+                        [doc["id"] for doc in pending_docs],
+                        hashes,
+                        checkpoint,
+                    )
+                    pending_docs = [pending_docs[i] for i in keep]
+                    prompts = [prompts[i] for i in keep]
+                    hashes = [hashes[i] for i in keep]
 
-            examples_string, extracted_entities = ec_prompt_2_preprocess(
-                example_train_docs, example_doc_entities, example_template, ee_contents
-            )
+                prefix_cache = None
+                if args.prefix_cache:
+                    prefix_prompt = split_prompt_template(prompt_template)[0].format(
+                        **prompt_template_kwargs
+                    )
+                    prefix_cache = backend.build_prefix_cache(prefix_prompt)
+                    if args.check_prefix_cache:
+                        backend.check_prefix_cache(prompts[:1], prefix_cache)
+                if args.compare_constrained:
+                    report_token_savings(
+                        backend,
+                        prompts[: args.compare_constrained],
+                        [doc["id"] for doc in pending_docs[: args.compare_constrained]],
+                        guard,
+                    )
 
-            contents = {}
-            for test_doc in tqdm(test_docs, desc=f"Processing {subset}"):
-                doc_id = test_doc["id"]
-                contents[doc_id] = qwen_gen(
-                    prompt_template,
-                    tokenizer,
-                    model,
-                    examples_string=examples_string,
-                    title=test_doc["title"],
-                    text=test_doc["text"],
-                    entities="\n".join(extracted_entities[doc_id]),
+                def save_response(i: int, response: str) -> None:
+                    checkpoint.append(pending_docs[i]["id"], response, hash=hashes[i])
+                    if results is not None:
+                        results.add_response(subset, pending_docs[i]["id"], response)
+
+                backend.generate(
+                    prompts,
+                    batch_size=args.batch_size,
+                    desc=f"Processing {subset}",
+                    done=len(shard_doc_ids) - len(pending_docs),
+                    prefix_cache=prefix_cache,
+                    response_cache=response_cache,
+                    guard=guard,
+                    on_output=save_response,
+                    telemetry=telemetry,
+                    tags=[{"doc_id": doc["id"]} for doc in pending_docs],
                 )
+                if args.shard is not None:
+                    continue
+                responses = checkpoint.load()
 
-            output_dir = os.path.join(args.output_dir, subset)
-            os.makedirs(output_dir, exist_ok=True)
+            # Save model responses, rebuilt from the checkpoint in document order
+            contents = {doc_id: responses[doc_id] for doc_id in test_docs.ids()}
             json.dump(
                 contents, open(os.path.join(output_dir, "contents.json"), "w"), indent=2
             )
 
             extracted_terms, extracted_types = ec_prompt_2_postprocess(contents)
+            write_outputs(
+                results,
+                subset,
+                output_dir,
+                extracted_terms,
+                extracted_types,
+                lambda: (contents, ec_prompt_2_entity_rows(contents)),
+            )
+
+        write_manifest(
+            output_dir,
+            (
+                load_shard_records(output_dir, args.merge)
+                if args.merge
+                else checkpoint.records()
+            ),
+        )
 
-        with open(os.path.join(output_dir, "terms.txt"), "w") as fout:
-            for t in extracted_terms:
-                fout.write(t + "\n")
-        with open(os.path.join(output_dir, "types.txt"), "w") as fout:
-            for t in extracted_types:
-                fout.write(t + "\n")
+    if results is not None:
+        results.store.close()
+    if response_cache is not None:
+        print(response_cache.stats())
+        response_cache.close()
+    print(guard.report())
+    if backend is not None and backend.stage_stats is not None:
+        print(backend.stage_stats.report())
 
 
 if __name__ == "__main__":
@@ -1,21 +1,170 @@
 import argparse
 import json
 import os
+from typing import TYPE_CHECKING
 
-from src.prompts import (
-    entity_extraction_customized_example_string,
-    entity_extraction_customized_examples_prompt,
-    entity_extraction_prompt,
+from src.backends import (
+    Backend,
+    add_backend_arguments,
+    load_backend,
+    load_guard,
+    load_telemetry,
+    report_token_savings,
 )
-from src.utils import ee_prompt_2_preprocess, qwen_gen, raw_ee_line2entity
-from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from src.cache import ResponseCache, add_cache_arguments, load_response_cache
+from src.checkpoint import JsonlCheckpoint
+from src.chunking import add_chunk_arguments, chunk_docs, merge_chunk_responses
+from src.docstore import DocumentStore
+from src.manifest import (
+    add_manifest_arguments,
+    load_manifest,
+    prompt_hash,
+    reuse_unchanged,
+    write_manifest,
+)
+from src.postprocess import rebuild_outputs
+from src.results import (
+    RunResults,
+    add_results_arguments,
+    ee_entity_rows,
+    load_results,
+    write_outputs,
+)
+from src.retrieval import add_retrieval_arguments, few_shot_log_path, load_selector
+from src.sharding import (
+    add_shard_arguments,
+    checkpoint_path,
+    load_shard_records,
+    shard_items,
+)
+from src.telemetry import Telemetry
+from src.utils import (
+    ee_postprocess,
+    ee_prompt_setup,
+    open_test_docs,
+    split_prompt_template,
+)
+
+if TYPE_CHECKING:
+    from src.stopping import GenerationGuard
+
+
+def generate_responses(
+    args: argparse.Namespace,
+    subset: str,
+    test_docs: DocumentStore,
+    backend: Backend,
+    guard: "GenerationGuard",
+    response_cache: ResponseCache | None,
+    telemetry: Telemetry | None,
+    results: RunResults | None,
+) -> list[dict[str, str]]:
+    prompt_template, prompt_template_kwargs = ee_prompt_setup(
+        args.prompt, subset, args.data_dir, args.example_dir
+    )
+
+    prefix_cache = None
+    if args.prompt == "2" and args.prefix_cache:
+        prefix_prompt = split_prompt_template(prompt_template)[0].format(
+            **prompt_template_kwargs
+        )
+        prefix_cache = backend.build_prefix_cache(prefix_prompt)
+
+    # Prepare output directory
+    output_dir = os.path.join(args.output_dir, subset)
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = JsonlCheckpoint(
+        checkpoint_path(output_dir, args.shard), resume=args.resume
+    )
+    done = checkpoint.keys()
+    shard_docs = [
+        test_docs.get(doc_id) for doc_id in shard_items(test_docs.ids(), args.shard)
+    ]
+    # Long documents are split into windows, extracted like documents of their own
+    chunks = chunk_docs(
+        shard_docs, backend.token_spans, args.max_chunk_tokens, args.chunk_overlap
+    )
+    if len(chunks) > len(shard_docs):
+        print(
+            f"Split {subset} into {len(chunks)} chunks of {len(shard_docs)} documents"
+        )
+    pending_docs = [
+        doc
+        for doc in chunks
+        if doc["id"] not in done and doc.get("doc_id", doc["id"]) not in done
+    ]
+
+    # Prepare the model input and conduct text completion
+    prompts = [
+        prompt_template.format(
+            **prompt_template_kwargs, title=doc["title"], text=doc["text"]
+        )
+        for doc in pending_docs
+    ]
+    selector = load_selector(args, "ee", subset, backend)
+    if selector is not None:
+        examples_strings = selector.examples_strings(
+            pending_docs,
+            few_shot_log_path(checkpoint_path(output_dir, args.shard)),
+            args.resume,
+        )
+        prompts = [
+            prompt_template.format(
+                examples_string=examples_string, title=doc["title"], text=doc["text"]
+            )
+            for doc, examples_string in zip(pending_docs, examples_strings)
+        ]
+    hashes = [prompt_hash(backend, prompt, guard) for prompt in prompts]
+    if args.incremental:
+        keep = reuse_unchanged(
+            load_manifest(output_dir),
+            [doc["id"] for doc in pending_docs],
+            hashes,
+            checkpoint,
+        )
+        pending_docs = [pending_docs[i] for i in keep]
+        prompts = [prompts[i] for i in keep]
+        hashes = [hashes[i] for i in keep]
+    if prefix_cache is not None and args.check_prefix_cache:
+        backend.check_prefix_cache(prompts[:1], prefix_cache)
+    if args.compare_constrained:
+        report_token_savings(
+            backend,
+            prompts[: args.compare_constrained],
+            [doc["id"] for doc in pending_docs[: args.compare_constrained]],
+            guard,
+        )
+
+    def save_response(i: int, response: str) -> None:
+        checkpoint.append(pending_docs[i]["id"], response, hash=hashes[i])
+        if results is not None:
+            results.add_response(subset, pending_docs[i]["id"], response)
+
+    backend.generate(
+        prompts,
+        batch_size=args.batch_size,
+        desc=f"Processing {subset}",
+        done=len(chunks) - len(pending_docs),
+        prefix_cache=prefix_cache,
+        response_cache=response_cache,
+        guard=guard,
+        on_output=save_response,
+        telemetry=telemetry,
+        tags=[
+            {"doc_id": doc.get("doc_id", doc["id"]), "chunk": doc.get("chunk", 0)}
+            for doc in pending_docs
+        ],
+    )
+    return list(checkpoint.records())
 
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "prompt", choices=["1", "2"], help="choose between EE Prompt 1 & 2"
+        "prompt",
+        choices=["1", "2", "postprocess"],
+        help="choose between EE Prompt 1 & 2, or rebuild terms.txt and "
+        "types.txt in --output_dir from the saved responses",
     )
     parser.add_argument(
         "--data_dir",
@@ -35,89 +184,117 @@ def main() -> None:
         default="output/LLMs4OL_TaskA_Entity_Extraction",
         help="path to output directory",
     )
+    add_backend_arguments(parser)
+    parser.add_argument(
+        "--batch_size",
+        "-b",
+        type=int,
+        default=1,
+        help="number of documents generated together in one batch",
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="with Prompt 2, prefill the shared few-shot examples once per subset",
+    )
+    parser.add_argument(
+        "--check_prefix_cache",
+        action="store_true",
+        help="verify on the first document that the prefix cache keeps greedy output",
+    )
+    parser.add_argument(
+        "--compare_constrained",
+        type=int,
+        default=0,
+        metavar="N",
+        help="with --constrained, report tokens saved on the first N documents "
+        "against an unconstrained run",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip documents already recorded in the response checkpoint",
+    )
+    add_chunk_arguments(parser)
+    add_retrieval_arguments(parser)
+    add_manifest_arguments(parser)
+    add_shard_arguments(parser)
+    add_results_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
+    if args.prompt == "postprocess":
+        rebuild_outputs("ee", args.output_dir)
+        return
+    if args.compare_constrained and not args.constrained:
+        parser.error("--compare_constrained needs --constrained")
+    if (args.few_shot_k or args.prompt_token_budget) and args.prompt != "2":
+        parser.error("--few_shot_k and --prompt_token_budget need Prompt 2")
+    if (args.few_shot_k or args.prompt_token_budget) and args.prefix_cache:
+        parser.error("--prefix_cache needs the same examples in every prompt")
 
-    # Load model and tokenizer
-    model_name = "Qwen/Qwen3-8B"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(
-        model_name, torch_dtype="auto", device_map="auto"
+    # Load inference backend, a merge only reads finished shards
+    backend = None if args.merge else load_backend(args)
+    guard = load_guard(args, "ee", grammar="ee")
+    # Selected examples get their own variant, to compare against the fixed ones
+    variant = f"ee{args.prompt}" + (
+        "-bm25" if args.few_shot_k or args.prompt_token_budget else ""
     )
+    telemetry = load_telemetry(args, variant=variant)
+    results = load_results(args, "ee", variant, backend)
+    response_cache = load_response_cache(args)
 
     subsets = ("engineering", "scholarly")
     for subset in subsets:
-        # Load data
-        testdata_dir = os.path.join(args.data_dir, f"{subset}/test")
-        with open(
-            os.path.join(testdata_dir, f"text2onto_{subset}_test_documents.jsonl"), "r"
-        ) as f:
-            test_docs = [json.loads(line) for line in f]
-
-        # Select and form prompt
-        if args.prompt == "1":
-            prompt_template = entity_extraction_prompt
-            prompt_template_kwargs = {}
-
-        elif args.prompt == "2":
-            prompt_template = entity_extraction_customized_examples_prompt
-            example_string_template = entity_extraction_customized_example_string
-            example_outputs = json.load(
-                open(
-                    os.path.join(
-                        args.example_dir,
-                        f"entity_extraction/{subset}/doc_examples.json",
-                    )
-                )
-            )
-
-            with open(
-                os.path.join(args.data_dir, f"{subset}/train/documents.jsonl"), "r"
-            ) as f:
-                train_example_docs = [
-                    json.loads(line)
-                    for line in f
-                    if json.loads(line)["id"] in example_outputs
-                ]
-
-            examples_string = ee_prompt_2_preprocess(
-                example_string_template, example_outputs, train_example_docs
-            )
-            prompt_template_kwargs = {"examples_string": examples_string}
-
-        # Prepare the model input and conduct text completion
-        contents = {}
-        for doc in tqdm(test_docs, desc=f"Processing {subset}"):
-            prompt_template_kwargs["title"] = doc["title"]
-            prompt_template_kwargs["text"] = doc["text"]
-            contents[doc["id"]] = qwen_gen(
-                prompt_template, tokenizer, model, **prompt_template_kwargs
-            )
-
-        # Prepare output directory
+        # Load data and form prompt
+        test_docs = open_test_docs(args.data_dir, subset)
         output_dir = os.path.join(args.output_dir, subset)
-        os.makedirs(output_dir, exist_ok=True)
+        if args.merge:
+            records = load_shard_records(output_dir, args.merge)
+        else:
+            if telemetry is not None:
+                telemetry.tags["subset"] = subset
+            records = generate_responses(
+                args,
+                subset,
+                test_docs,
+                backend,
+                guard,
+                response_cache,
+                telemetry,
+                results,
+            )
+            if args.shard is not None:
+                continue
+        responses = {record["key"]: record["response"] for record in records}
 
-        # Save model responses
+        # Save model responses, rebuilt from the checkpoint in document order
+        # with the entities of chunked documents merged
+        contents = merge_chunk_responses(test_docs.ids(), responses)
         content_output_path = os.path.join(output_dir, "contents.json")
         with open(content_output_path, "w") as fout:
             json.dump(contents, fout, indent=2)
 
-        # Post-process
-        all_extracted_entities = []
-        for doc_id in contents:
-            content = contents[doc_id]
-            for entity_line in content.splitlines():
-                all_extracted_entities.append(raw_ee_line2entity(entity_line))
-        all_extracted_entities = list(set(all_extracted_entities))
-
-        # Save final output
-        with open(os.path.join(output_dir, "terms.txt"), "w") as fout:
-            for term in all_extracted_entities:
-                fout.write(term + "\n")
-        with open(os.path.join(output_dir, "types.txt"), "w") as fout:
-            for type in all_extracted_entities:
-                fout.write(type + "\n")
+        # Post-process and save final output
+        all_extracted_entities = ee_postprocess(contents)
+        write_outputs(
+            results,
+            subset,
+            output_dir,
+            all_extracted_entities,
+            all_extracted_entities,
+            lambda: (contents, ee_entity_rows(contents)),
+        )
+        write_manifest(output_dir, records)
+
+    if results is not None:
+        results.store.close()
+    if response_cache is not None:
+        print(response_cache.stats())
+        response_cache.close()
+    print(guard.report())
+    if backend is not None and backend.stage_stats is not None:
+        print(backend.stage_stats.report())
 
 
 if __name__ == "__main__":
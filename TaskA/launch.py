@@ -0,0 +1,105 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+def worker_environment(
+    index: int, args: argparse.Namespace, cores: list[int]
+) -> tuple[dict[str, str], list[int] | None]:
+    env = dict(os.environ)
+    worker_cores = None
+    if args.pin_cpus:
+        # Contiguous core ranges, so a worker stays on one socket where possible
+        start = index * len(cores) // args.workers
+        end = (index + 1) * len(cores) // args.workers
+        worker_cores = cores[start:end]
+        env["OMP_NUM_THREADS"] = str(len(worker_cores))
+    if args.devices:
+        devices = args.devices.split(",")
+        env["CUDA_VISIBLE_DEVICES"] = devices[index % len(devices)]
+    return env, worker_cores
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="run a TaskA script in sharded worker processes and merge the output"
+    )
+    parser.add_argument(
+        "--workers", "-n", type=int, required=True, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--pin_cpus",
+        action="store_true",
+        help="split the available CPU cores evenly and pin each worker to its share",
+    )
+    parser.add_argument(
+        "--devices",
+        default=None,
+        help="comma-separated GPU ids assigned to the workers round robin, e.g. 0,1,2,3",
+    )
+    parser.add_argument(
+        "--log_dir",
+        default="output/logs",
+        help="path to the directory of per-worker logs",
+    )
+    parser.add_argument(
+        "script",
+        help="entity_extraction.py or entity_classification.py",
+    )
+    parser.add_argument(
+        "script_args", nargs=argparse.REMAINDER, help="arguments passed to the script"
+    )
+
+    args = parser.parse_args()
+    if args.pin_cpus and len(os.sched_getaffinity(0)) < args.workers:
+        parser.error("--pin_cpus needs at least one CPU core per worker")
+
+    # Start one process per shard, each loading its own model or backend connection
+    os.makedirs(args.log_dir, exist_ok=True)
+    script_name = os.path.splitext(os.path.basename(args.script))[0]
+    cores = sorted(os.sched_getaffinity(0))
+    start_time = time.perf_counter()
+    workers = []
+    for index in range(args.workers):
+        env, worker_cores = worker_environment(index, args, cores)
+        log_path = os.path.join(
+            args.log_dir, f"{script_name}-{index}-of-{args.workers}.log"
+        )
+        with open(log_path, "w") as log:
+            workers.append(
+                subprocess.Popen(
+                    [sys.executable, args.script, *args.script_args]
+                    + ["--shard", f"{index}/{args.workers}"],
+                    env=env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    preexec_fn=(
+                        (lambda cores=worker_cores: os.sched_setaffinity(0, cores))
+                        if worker_cores is not None
+                        else None
+                    ),
+                )
+            )
+        print(
+            f"Started shard {index}/{args.workers} (pid {workers[-1].pid}), log {log_path}"
+        )
+
+    failed = []
+    for index, worker in enumerate(workers):
+        if worker.wait() != 0:
+            failed.append(index)
+    print(f"Workers finished in {time.perf_counter() - start_time:.1f}s")
+    if failed:
+        sys.exit(f"Shards {failed} failed, see the logs in {args.log_dir}")
+
+    # Write the final output from the shard checkpoints
+    subprocess.run(
+        [sys.executable, args.script, *args.script_args, "--merge", str(args.workers)],
+        check=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
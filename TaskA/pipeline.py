@@ -0,0 +1,471 @@
+import argparse
+import json
+import os
+import queue
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from src.backends import (
+    Backend,
+    add_backend_arguments,
+    load_backend,
+    load_guard,
+    load_telemetry,
+)
+from src.cache import ResponseCache, add_cache_arguments, load_response_cache
+from src.results import (
+    RunResults,
+    add_results_arguments,
+    ec_prompt_1_entity_rows,
+    ec_prompt_2_entity_rows,
+    ee_entity_rows,
+    load_results,
+    write_outputs,
+)
+from src.telemetry import Telemetry
+from src.utils import (
+    ec_prompt_1_entity_names,
+    ec_prompt_1_fan_out,
+    ec_prompt_1_pack,
+    ec_prompt_1_parse,
+    ec_prompt_1_postprocess,
+    ec_prompt_1_preprocess,
+    ec_prompt_2_postprocess,
+    ec_prompt_setup,
+    ee_content2entities,
+    ee_postprocess,
+    ee_prompt_setup,
+    open_test_docs,
+    split_prompt_template,
+)
+from tqdm import tqdm
+
+if TYPE_CHECKING:
+    from src.stopping import GenerationGuard
+
+
+def run_subset(
+    args: argparse.Namespace,
+    subset: str,
+    backend: Backend,
+    response_cache: ResponseCache | None,
+    ee_guard: "GenerationGuard",
+    ec_guard: "GenerationGuard",
+    telemetry: Telemetry | None = None,
+    results: RunResults | None = None,
+) -> None:
+    # Load data and form prompts for both stages
+    # Documents are read from the store as their stream slice comes up
+    test_docs = open_test_docs(args.data_dir, subset)
+    doc_ids = test_docs.ids()
+    ee_template, ee_kwargs = ee_prompt_setup(
+        args.ee_prompt, subset, args.data_dir, args.example_dir
+    )
+    ec_template, ec_kwargs = ec_prompt_setup(
+        args.ec_prompt, subset, args.data_dir, args.example_dir
+    )
+
+    ee_prefix_cache = None
+    ec_prefix_cache = None
+    if args.prefix_cache and args.ee_prompt == "2":
+        ee_prefix_cache = backend.build_prefix_cache(
+            split_prompt_template(ee_template)[0].format(**ee_kwargs)
+        )
+    if args.prefix_cache and args.ec_prompt == "2":
+        ec_prefix_cache = backend.build_prefix_cache(
+            split_prompt_template(ec_template)[0].format(**ec_kwargs)
+        )
+
+    # Extracted documents are queued for classification as soon as they finish
+    ee_contents = {}
+    ec_queue = queue.Queue()
+    ec_contents = {}
+    ec_lines = []
+    ec_responses = []
+
+    def classify_entities(list_of_entities_with_description: str) -> None:
+        lines, _ = ec_prompt_1_pack(
+            list_of_entities_with_description, args.entities_per_prompt
+        )
+        ec_lines.extend(lines)
+        ec_responses.extend(
+            backend.generate(
+                [
+                    ec_template.format(list_of_entities_with_description=line)
+                    for line in lines
+                ],
+                batch_size=args.batch_size,
+                response_cache=response_cache,
+                guard=ec_guard,
+                telemetry=telemetry,
+                tags=[
+                    {"variant": "ec1", "entity": ec_prompt_1_entity_names(line)}
+                    for line in lines
+                ],
+            )
+        )
+
+    def classify(items: list[tuple[str, str]], pbar: tqdm) -> None:
+        if args.ec_prompt == "1":
+            # Deduplicated entities are classified once extraction is done
+            if not args.dedup_entities:
+                classify_entities(ec_prompt_1_preprocess(dict(items)))
+        elif args.ec_prompt == "2":
+            docs = [test_docs.get(doc_id) for doc_id, _ in items]
+            prompts = [
+                ec_template.format(
+                    **ec_kwargs,
+                    title=doc["title"],
+                    text=doc["text"],
+                    entities="\n".join(ee_content2entities(content)),
+                )
+                for doc, (_, content) in zip(docs, items)
+            ]
+            responses = backend.generate(
+                prompts,
+                batch_size=args.batch_size,
+                prefix_cache=ec_prefix_cache,
+                response_cache=response_cache,
+                guard=ec_guard,
+                telemetry=telemetry,
+                tags=[{"variant": "ec2", "doc_id": doc_id} for doc_id, _ in items],
+            )
+            for (doc_id, _), response in zip(items, responses):
+                ec_contents[doc_id] = response
+        pbar.update(len(items))
+
+    def classification_worker() -> None:
+        with tqdm(
+            total=len(test_docs), desc=f"Classifying {subset}", position=1
+        ) as pbar:
+            finished = False
+            while not finished:
+                # Classify everything extracted since the last call in one go
+                items = [ec_queue.get()]
+                while True:
+                    try:
+                        items.append(ec_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                finished = None in items
+                items = [item for item in items if item is not None]
+                if items:
+                    classify(items, pbar)
+
+    # Extraction and classification rows of the run share its run id
+    ee_results = (
+        RunResults(results.store, results.run_id, "ee") if results is not None else None
+    )
+
+    def save_extraction(doc_id: str, response: str) -> None:
+        ee_contents[doc_id] = response
+        if ee_results is not None:
+            ee_results.add_response(subset, doc_id, response)
+        ec_queue.put((doc_id, response))
+
+    if args.joint:
+        # Both turns per document in one conversation, no classification queue
+        saved_tokens = 0
+
+        def save_joint(doc_id: str, ee_content: str, ec_content: str) -> None:
+            ee_contents[doc_id] = ee_content
+            ec_contents[doc_id] = ec_content
+            if results is not None:
+                ee_results.add_response(subset, doc_id, ee_content)
+                results.add_response(subset, doc_id, ec_content)
+
+        with tqdm(
+            total=len(test_docs), desc=f"Extracting and classifying {subset}"
+        ) as pbar:
+            for start in range(0, len(doc_ids), args.stream_size):
+                stream_docs = [
+                    test_docs.get(doc_id)
+                    for doc_id in doc_ids[start : start + args.stream_size]
+                ]
+                _, _, stream_saved_tokens = backend.generate_joint(
+                    stream_docs,
+                    ee_template,
+                    ee_kwargs,
+                    ec_template,
+                    ec_kwargs,
+                    response_cache=response_cache,
+                    on_output=lambda i, ee_content, ec_content: save_joint(
+                        stream_docs[i]["id"], ee_content, ec_content
+                    ),
+                    ee_guard=ee_guard,
+                    ec_guard=ec_guard,
+                    telemetry=telemetry,
+                    ee_tags=[
+                        {"variant": f"ee{args.ee_prompt}", "doc_id": doc["id"]}
+                        for doc in stream_docs
+                    ],
+                    ec_tags=[
+                        {"variant": "ec2-joint", "doc_id": doc["id"]}
+                        for doc in stream_docs
+                    ],
+                )
+                saved_tokens += sum(stream_saved_tokens)
+                pbar.update(len(stream_docs))
+        print(
+            f"Joint classification saved {saved_tokens} prefill tokens in {subset}, "
+            f"{saved_tokens / max(len(doc_ids), 1):.0f} per document"
+        )
+    else:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            classification = executor.submit(classification_worker)
+            try:
+                with tqdm(
+                    total=len(test_docs), desc=f"Extracting {subset}", position=0
+                ) as pbar:
+                    for start in range(0, len(doc_ids), args.stream_size):
+                        stream_docs = [
+                            test_docs.get(doc_id)
+                            for doc_id in doc_ids[start : start + args.stream_size]
+                        ]
+                        backend.generate(
+                            [
+                                ee_template.format(
+                                    **ee_kwargs, title=doc["title"], text=doc["text"]
+                                )
+                                for doc in stream_docs
+                            ],
+                            batch_size=args.batch_size,
+                            prefix_cache=ee_prefix_cache,
+                            response_cache=response_cache,
+                            guard=ee_guard,
+                            on_output=lambda i, response: save_extraction(
+                                stream_docs[i]["id"], response
+                            ),
+                            telemetry=telemetry,
+                            tags=[
+                                {"variant": f"ee{args.ee_prompt}", "doc_id": doc["id"]}
+                                for doc in stream_docs
+                            ],
+                        )
+                        pbar.update(len(stream_docs))
+            finally:
+                ec_queue.put(None)
+            classification.result()
+
+    ee_contents = {doc_id: ee_contents[doc_id] for doc_id in doc_ids}
+    if args.ec_prompt == "1" and args.dedup_entities:
+        # Each entity keeps its most detailed description in the whole subset,
+        # as in entity_classification.py
+        classify_entities(ec_prompt_1_preprocess(ee_contents, dedup=True))
+
+    # Intermediate extraction output is only written on request
+    if args.save_intermediate:
+        ee_output_dir = os.path.join(args.ee_output_dir, subset)
+        os.makedirs(ee_output_dir, exist_ok=True)
+        with open(os.path.join(ee_output_dir, "contents.json"), "w") as fout:
+            json.dump(ee_contents, fout, indent=2)
+        all_extracted_entities = ee_postprocess(ee_contents)
+        write_outputs(
+            ee_results,
+            subset,
+            ee_output_dir,
+            all_extracted_entities,
+            all_extracted_entities,
+            lambda: (ee_contents, ee_entity_rows(ee_contents)),
+        )
+    elif ee_results is not None:
+        all_extracted_entities = ee_postprocess(ee_contents)
+        ee_results.save_subset(
+            subset,
+            None,
+            ee_contents,
+            ee_entity_rows(ee_contents),
+            all_extracted_entities,
+            all_extracted_entities,
+        )
+
+    output_dir = os.path.join(args.output_dir, subset)
+    os.makedirs(output_dir, exist_ok=True)
+    if args.ec_prompt == "1":
+        all_class_responses, unreadable_responses = ec_prompt_1_parse(
+            ec_lines, ec_responses
+        )
+        if args.dedup_entities:
+            all_class_responses, mismatched_responses = ec_prompt_1_fan_out(
+                all_class_responses, ee_contents
+            )
+            unreadable_responses += mismatched_responses
+        json.dump(
+            all_class_responses,
+            open(os.path.join(output_dir, "classification_responses.json"), "w"),
+            indent=2,
+        )
+        json.dump(
+            unreadable_responses,
+            open(os.path.join(output_dir, "unreadable_responses.json"), "w"),
+            indent=2,
+        )
+        extracted_terms, extracted_types = ec_prompt_1_postprocess(all_class_responses)
+        # Keyed like the checkpoints of entity_classification.py
+        ec_saved = {
+            f"{i}:{line}": response
+            for i, (line, response) in enumerate(zip(ec_lines, ec_responses))
+        }
+        write_outputs(
+            results,
+            subset,
+            output_dir,
+            extracted_terms,
+            extracted_types,
+            lambda: (ec_saved, ec_prompt_1_entity_rows(ec_saved)),
+        )
+    elif args.ec_prompt == "2":
+        ec_contents = {doc_id: ec_contents[doc_id] for doc_id in doc_ids}
+        json.dump(
+            ec_contents, open(os.path.join(output_dir, "contents.json"), "w"), indent=2
+        )
+        extracted_terms, extracted_types = ec_prompt_2_postprocess(ec_contents)
+        write_outputs(
+            results,
+            subset,
+            output_dir,
+            extracted_terms,
+            extracted_types,
+            lambda: (ec_contents, ec_prompt_2_entity_rows(ec_contents)),
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="run entity extraction and classification with one model load"
+    )
+    parser.add_argument(
+        "ee_prompt", choices=["1", "2"], help="choose between EE Prompt 1 & 2"
+    )
+    parser.add_argument(
+        "ec_prompt", choices=["1", "2"], help="choose between EC Prompt 1 & 2"
+    )
+    parser.add_argument(
+        "--data_dir",
+        "-d",
+        default="data/LLMs4OL-Challenge/2025/TaskA-Text2Onto",
+        help="path to input data directory",
+    )
+    parser.add_argument(
+        "--example_dir",
+        "-e",
+        default="data/few_shot_examples",
+        help="path to few-shot examples directory",
+    )
+    parser.add_argument(
+        "--ee_output_dir",
+        "-p",
+        default="output/LLMs4OL_TaskA_Entity_Extraction",
+        help="path to the directory of intermediate output from entity extraction",
+    )
+    parser.add_argument(
+        "--output_dir",
+        "-o",
+        default="output/LLMs4OL_TaskA_Entity_Classification",
+        help="path to output directory",
+    )
+    parser.add_argument(
+        "--save_intermediate",
+        action="store_true",
+        help="also write entity extraction output to --ee_output_dir",
+    )
+    add_backend_arguments(parser)
+    parser.add_argument(
+        "--batch_size",
+        "-b",
+        type=int,
+        default=1,
+        help="number of prompts generated together in one batch",
+    )
+    parser.add_argument(
+        "--stream_size",
+        type=int,
+        default=8,
+        help="number of documents extracted before they are queued for classification",
+    )
+    parser.add_argument(
+        "--dedup_entities",
+        action="store_true",
+        help="with EC Prompt 1, classify each distinct entity name only once, "
+        "after extraction of the subset has finished. Its "
+        "result is repeated for every entity line, in document order, in "
+        "classification_responses.json; "
+        "terms.txt and types.txt list each entity once either way",
+    )
+    parser.add_argument(
+        "--entities_per_prompt",
+        type=int,
+        default=1,
+        help="with EC Prompt 1, number of entities packed into each prompt",
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="with Prompt 2, prefill the shared few-shot examples once per subset",
+    )
+    parser.add_argument(
+        "--joint",
+        action="store_true",
+        help="with EC Prompt 2, classify each document in a second chat turn "
+        "right after its extraction, reusing the KV cache of the document",
+    )
+    add_results_arguments(parser)
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    if args.joint and args.ec_prompt != "2":
+        parser.error("--joint needs EC Prompt 2")
+    if args.joint and args.backend != "transformers":
+        parser.error("--joint needs the transformers backend")
+    if args.joint and (args.prefix_cache or args.draft_model):
+        parser.error("--joint cannot be combined with --prefix_cache or --draft_model")
+
+    # Load inference backend once for both stages
+    start_time = time.perf_counter()
+    backend = load_backend(args)
+    print(f"Loaded {args.model} in {time.perf_counter() - start_time:.1f}s")
+    response_cache = load_response_cache(args)
+    ee_guard = load_guard(args, "ee", grammar="ee")
+    ec_guard = load_guard(
+        args, "ec", grammar="ec_json" if args.ec_prompt == "1" else "ec_lines"
+    )
+
+    subsets = ("engineering", "scholarly")
+    telemetry = load_telemetry(args)
+    results = load_results(
+        args,
+        "ec",
+        f"ee{args.ee_prompt}+ec{args.ec_prompt}" + ("-joint" if args.joint else ""),
+        backend,
+    )
+    for subset in subsets:
+        if telemetry is not None:
+            telemetry.tags["subset"] = subset
+        run_subset(
+            args,
+            subset,
+            backend,
+            response_cache,
+            ee_guard,
+            ec_guard,
+            telemetry,
+            results,
+        )
+    if results is not None:
+        results.store.close()
+
+    if response_cache is not None:
+        print(response_cache.stats())
+        response_cache.close()
+    print(ee_guard.report())
+    print(ec_guard.report())
+    if backend.stage_stats is not None:
+        print(backend.stage_stats.report())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Total {time.perf_counter() - start_time:.1f}s, peak RSS {peak_rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,676 @@
+import argparse
+import hashlib
+import http.client
+import json
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Any, Callable
+from urllib.parse import urlsplit
+
+from .cache import ResponseCache
+from .chunking import word_spans
+from .quantization import add_device_arguments, set_threads
+from .telemetry import Telemetry
+from .utils import (
+    GENERATION_KWARGS,
+    build_prefix_cache,
+    check_prefix_cache,
+    compare_constrained,
+    generate_with_cache,
+    qwen_gen_batch,
+)
+
+# Modules that import torch and transformers are loaded once a run generates,
+# so that postprocessing starts without them
+if TYPE_CHECKING:
+    from .stopping import GenerationGuard
+
+BACKENDS = ("transformers", "openai", "mock")
+SCHEDULERS = ("static", "continuous", "overlapped")
+
+
+class Backend:
+    # The --backend choice, recorded with the model of a run in the results store
+    kind = ""
+    model_name = ""
+    quantize = None
+    stage_stats = None
+    generation_kwargs = GENERATION_KWARGS
+
+    def cache_key(self, prompt: str, enable_thinking: bool) -> str:
+        messages = json.dumps([{"role": "user", "content": prompt}])
+        return ResponseCache.key(
+            self.model_name, messages, enable_thinking, self.generation_kwargs
+        )
+
+    def generate(
+        self,
+        prompts: list[str],
+        batch_size: int = 1,
+        enable_thinking: bool = False,
+        desc: str | None = None,
+        done: int = 0,
+        prefix_cache: Any = None,
+        response_cache: ResponseCache | None = None,
+        on_output: Callable[[int, str], None] | None = None,
+        guard: "GenerationGuard | None" = None,
+        telemetry: Telemetry | None = None,
+        tags: list[dict[str, Any]] | None = None,
+    ) -> list[str]:
+        # Stopping criteria and logits processors only apply in-process
+        def cache_keys() -> list[str]:
+            return [self.cache_key(prompt, enable_thinking) for prompt in prompts]
+
+        def run_uncached(
+            pending: list[int], save_output: Callable[[int, str, dict[str, Any]], None]
+        ) -> None:
+            self.generate_uncached(
+                [prompts[i] for i in pending],
+                enable_thinking,
+                lambda index, content, stats: save_output(
+                    pending[index], content, {"batch_size": 1, **stats}
+                ),
+            )
+
+        return generate_with_cache(
+            len(prompts),
+            cache_keys,
+            run_uncached,
+            desc=desc,
+            done=done,
+            response_cache=response_cache,
+            on_output=on_output,
+            telemetry=telemetry,
+            tags=tags,
+        )
+
+    def generate_uncached(
+        self,
+        prompts: list[str],
+        enable_thinking: bool,
+        on_output: Callable[[int, str, dict[str, Any]], None],
+    ) -> None:
+        raise self.unsupported("generate_uncached")
+
+    def unsupported(self, operation: str) -> NotImplementedError:
+        return NotImplementedError(
+            f"{operation} is not supported by {type(self).__name__}"
+        )
+
+    def build_prefix_cache(self, prefix_prompt: str) -> Any:
+        # Serving engines handle prefix caching on their side
+        return None
+
+    def check_prefix_cache(self, prompts: list[str], prefix_cache: Any) -> None:
+        pass
+
+    def compare_constrained(
+        self, prompts: list[str], guard: "GenerationGuard"
+    ) -> list[tuple[int, int]]:
+        # Needs logits processors in the same process
+        raise self.unsupported("compare_constrained")
+
+    def generate_joint(
+        self,
+        docs: list[dict[str, str]],
+        ee_template: str,
+        ee_kwargs: dict[str, str],
+        ec_template: str,
+        ec_kwargs: dict[str, str],
+        **kwargs: Any,
+    ) -> tuple[list[str], list[str], list[int]]:
+        # Needs the KV cache of the extraction turn
+        raise self.unsupported("generate_joint")
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        # Character spans of the tokens of text, used to bound chunk lengths
+        return word_spans(text)
+
+
+class TransformersBackend(Backend):
+    kind = "transformers"
+
+    def __init__(
+        self,
+        model_name: str,
+        device_map: str | None = "auto",
+        scheduler: str = "static",
+        device: str = "auto",
+        quantize: str = "none",
+        quantized_dir: str = "output/quantized",
+        draft_model: str | None = None,
+        prefetch_batches: int = 2,
+        stage_workers: int = 2,
+        max_new_tokens: int | None = None,
+    ) -> None:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        from .overlap import StageStats
+        from .quantization import load_cpu_model
+
+        def load_model(name: str) -> AutoModelForCausalLM:
+            if device == "cpu":
+                return load_cpu_model(name, quantize, quantized_dir)
+            return AutoModelForCausalLM.from_pretrained(
+                name, torch_dtype="auto", device_map=device_map
+            )
+
+        self.model_name = model_name
+        self.scheduler = scheduler
+        self.device = device
+        if max_new_tokens is not None:
+            self.generation_kwargs = {
+                **GENERATION_KWARGS,
+                "max_new_tokens": max_new_tokens,
+            }
+        self.prefetch_batches = prefetch_batches
+        self.stage_workers = stage_workers
+        if scheduler == "overlapped":
+            self.stage_stats = StageStats()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = load_model(model_name)
+        self.quantize = getattr(self.model, "quantization", None)
+        self.draft_model = None
+        self.draft_model_name = draft_model
+        if draft_model is not None:
+            # Drafted token ids are checked by the target as they are
+            if AutoTokenizer.from_pretrained(draft_model).get_vocab() != (
+                self.tokenizer.get_vocab()
+            ):
+                raise ValueError(f"{draft_model} has a different tokenizer")
+            self.draft_model = load_model(draft_model)
+        # The in-process model runs one generate call at a time
+        self.lock = threading.Lock()
+
+    def generate(
+        self,
+        prompts: list[str],
+        batch_size: int = 1,
+        enable_thinking: bool = False,
+        desc: str | None = None,
+        done: int = 0,
+        prefix_cache: Any = None,
+        response_cache: ResponseCache | None = None,
+        on_output: Callable[[int, str], None] | None = None,
+        guard: "GenerationGuard | None" = None,
+        telemetry: Telemetry | None = None,
+        tags: list[dict[str, Any]] | None = None,
+    ) -> list[str]:
+        from .overlap import qwen_gen_overlapped
+        from .scheduler import qwen_gen_continuous
+
+        if self.scheduler == "continuous" and prefix_cache is None:
+            # The shared prefix cache only fits fixed batches
+            with self.lock:
+                return qwen_gen_continuous(
+                    prompts,
+                    self.tokenizer,
+                    self.model,
+                    batch_size=batch_size,
+                    enable_thinking=enable_thinking,
+                    desc=desc,
+                    done=done,
+                    response_cache=response_cache,
+                    on_output=on_output,
+                    guard=guard,
+                    telemetry=telemetry,
+                    tags=tags,
+                    generation_kwargs=self.generation_kwargs,
+                )
+        if self.scheduler == "overlapped":
+            with self.lock:
+                return qwen_gen_overlapped(
+                    prompts,
+                    self.tokenizer,
+                    self.model,
+                    batch_size=batch_size,
+                    enable_thinking=enable_thinking,
+                    desc=desc,
+                    done=done,
+                    prefix_cache=prefix_cache,
+                    response_cache=response_cache,
+                    on_output=on_output,
+                    guard=guard,
+                    telemetry=telemetry,
+                    tags=tags,
+                    prefetch=self.prefetch_batches,
+                    workers=self.stage_workers,
+                    stats=self.stage_stats,
+                    generation_kwargs=self.generation_kwargs,
+                )
+        with self.lock:
+            return qwen_gen_batch(
+                prompts,
+                self.tokenizer,
+                self.model,
+                batch_size=batch_size,
+                enable_thinking=enable_thinking,
+                desc=desc,
+                done=done,
+                prefix_cache=prefix_cache,
+                response_cache=response_cache,
+                on_output=on_output,
+                guard=guard,
+                telemetry=telemetry,
+                tags=tags,
+                assistant_model=self.draft_model,
+                generation_kwargs=self.generation_kwargs,
+            )
+
+    def build_prefix_cache(self, prefix_prompt: str) -> Any:
+        with self.lock:
+            return build_prefix_cache(prefix_prompt, self.tokenizer, self.model)
+
+    def check_prefix_cache(self, prompts: list[str], prefix_cache: Any) -> None:
+        with self.lock:
+            check_prefix_cache(
+                prompts,
+                self.tokenizer,
+                self.model,
+                prefix_cache,
+                generation_kwargs=self.generation_kwargs,
+            )
+
+    def compare_constrained(
+        self, prompts: list[str], guard: "GenerationGuard"
+    ) -> list[tuple[int, int]]:
+        with self.lock:
+            return compare_constrained(
+                prompts,
+                self.tokenizer,
+                self.model,
+                guard,
+                generation_kwargs=self.generation_kwargs,
+            )
+
+    def generate_joint(
+        self,
+        docs: list[dict[str, str]],
+        ee_template: str,
+        ee_kwargs: dict[str, str],
+        ec_template: str,
+        ec_kwargs: dict[str, str],
+        **kwargs: Any,
+    ) -> tuple[list[str], list[str], list[int]]:
+        from .joint import qwen_gen_joint
+
+        with self.lock:
+            return qwen_gen_joint(
+                docs,
+                ee_template,
+                ee_kwargs,
+                ec_template,
+                ec_kwargs,
+                self.tokenizer,
+                self.model,
+                generation_kwargs=self.generation_kwargs,
+                **kwargs,
+            )
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        return self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+
+
+class OpenAIServerBackend(Backend):
+    kind = "openai"
+
+    def __init__(
+        self,
+        model_name: str,
+        base_url: str = "http://localhost:8000/v1",
+        concurrency: int = 8,
+        timeout: float = 3600,
+        api_key: str | None = None,
+        max_new_tokens: int | None = None,
+    ) -> None:
+        self.model_name = model_name
+        # Without a cap the server allows up to its context length, vLLM rejects
+        # requests whose prompt and max_tokens exceed it
+        self.generation_kwargs = {"max_new_tokens": max_new_tokens}
+        url = urlsplit(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path.rstrip("/") + "/chat/completions"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+
+        # Keep-alive connections shared by the worker threads
+        self.connections = queue.LifoQueue()
+        for _ in range(concurrency):
+            self.connections.put(None)
+
+    def connect(self) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, prompt: str, enable_thinking: bool) -> tuple[str, dict[str, Any]]:
+        request = {
+            "model": self.model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "chat_template_kwargs": {"enable_thinking": enable_thinking},
+        }
+        if self.generation_kwargs["max_new_tokens"] is not None:
+            request["max_tokens"] = self.generation_kwargs["max_new_tokens"]
+        body = json.dumps(request)
+        start_time = time.perf_counter()
+        connection = self.connections.get()
+        try:
+            for attempt in range(2):
+                if connection is None:
+                    connection = self.connect()
+                try:
+                    connection.request("POST", self.path, body, self.headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (ConnectionError, http.client.HTTPException):
+                    # The server may have closed an idle keep-alive connection
+                    connection.close()
+                    connection = None
+                    if attempt == 1:
+                        raise
+        except BaseException:
+            # A timeout or interrupt can leave a response half read, the next
+            # request must not reuse the connection
+            if connection is not None:
+                connection.close()
+                connection = None
+            raise
+        finally:
+            self.connections.put(connection)
+        if response.status != 200:
+            raise RuntimeError(
+                f"{self.netloc} returned {response.status}: {data[:200]!r}"
+            )
+
+        data = json.loads(data)
+        content = data["choices"][0]["message"]["content"] or ""
+        usage = data.get("usage") or {}
+        stats = {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "new_tokens": usage.get("completion_tokens", 0),
+            "seconds": round(time.perf_counter() - start_time, 4),
+        }
+        # parsing thinking content
+        return content.split("</think>")[-1].strip("\n"), stats
+
+    def generate_uncached(
+        self,
+        prompts: list[str],
+        enable_thinking: bool,
+        on_output: Callable[[int, str, dict[str, Any]], None],
+    ) -> None:
+        # One blocking request per worker thread, at most concurrency in flight,
+        # and outputs in completion order
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {
+                executor.submit(self.request, prompt, enable_thinking): i
+                for i, prompt in enumerate(prompts)
+            }
+            try:
+                for future in as_completed(futures):
+                    content, stats = future.result()
+                    on_output(futures[future], content, stats)
+            except BaseException:
+                # Requests not yet sent are dropped instead of waited for
+                for future in futures:
+                    future.cancel()
+                raise
+
+
+class MockBackend(Backend):
+    kind = "mock"
+
+    def __init__(self, model_name: str = "mock", latency: float = 0.0) -> None:
+        self.model_name = model_name
+        self.latency = latency
+
+    def respond(self, prompt: str) -> str:
+        # Well-formed output for each prompt type, derived only from the prompt
+        seed = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+        real_data = prompt.rsplit("-Real Data-", 1)[-1]
+
+        if "#### List of Entities" in real_data:
+            entities = real_data.split("#### List of Entities\n", 1)[1]
+            entities = entities.split("\n######", 1)[0].splitlines()
+            return "\n".join(
+                f"{entity}|||{('term', 'type')[(seed >> i) & 1]}"
+                for i, entity in enumerate(entities)
+                if entity
+            )
+
+        if "Input:\n" in real_data and "Title:" not in real_data:
+            lines = real_data.split("Input:\n", 1)[1].split("\n######", 1)[0]
+            return json.dumps(
+                [
+                    {
+                        "entity": line.split(": ", 1)[0],
+                        "classification": ("term", "type")[(seed >> i) & 1],
+                    }
+                    for i, line in enumerate(lines.splitlines())
+                ],
+                indent=2,
+            )
+
+        text = real_data.split("Text:", 1)[-1].split("\n######", 1)[0]
+        words = list(dict.fromkeys(re.findall(r"[A-Za-z][\w-]+", text)))
+        entity_lines = []
+        for i, word in enumerate(words[: 3 + seed % 8]):
+            entity_type = ("Concept", "Category", "Unit", "Method")[(seed >> i) % 4]
+            entity_lines.append(
+                f'("entity"|||{word}|||{entity_type}|||A {entity_type.lower()} '
+                f"mentioned in the document.)"
+            )
+        return "\n".join(entity_lines)
+
+    def generate_uncached(
+        self,
+        prompts: list[str],
+        enable_thinking: bool,
+        on_output: Callable[[int, str, dict[str, Any]], None],
+    ) -> None:
+        for i, prompt in enumerate(prompts):
+            start_time = time.perf_counter()
+            if self.latency:
+                time.sleep(self.latency)
+            content = self.respond(prompt)
+            on_output(
+                i, content, {"seconds": round(time.perf_counter() - start_time, 4)}
+            )
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="transformers",
+        help="inference backend: in-process transformers, an OpenAI-compatible "
+        "server such as vLLM or llama.cpp, or a deterministic mock",
+    )
+    parser.add_argument(
+        "--model",
+        "-m",
+        default="Qwen/Qwen3-8B",
+        help="model name or path",
+    )
+    parser.add_argument(
+        "--base_url",
+        default="http://localhost:8000/v1",
+        help="base URL of the OpenAI-compatible server",
+    )
+    parser.add_argument(
+        "--model_server",
+        default="output/model_server.sock",
+        help="Unix socket of a model server started with `python -m "
+        "src.model_server`, used by the transformers backend instead of loading "
+        "the model when it serves the same model",
+    )
+    parser.add_argument(
+        "--no_model_server",
+        action="store_true",
+        help="always load the model in process",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="maximum number of in-flight requests to the OpenAI-compatible server",
+    )
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=None,
+        help="cap on new tokens per response. By default 32768 in process, and "
+        "up to its context length with the openai backend",
+    )
+    parser.add_argument(
+        "--scheduler",
+        choices=SCHEDULERS,
+        default="static",
+        help="with the transformers backend, generate fixed batches, refill "
+        "the batch at every decode step as generations finish, or generate fixed "
+        "batches while other threads tokenize and decode",
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=2,
+        help="with --scheduler overlapped, batches tokenized ahead of generation "
+        "and waiting to be decoded",
+    )
+    parser.add_argument(
+        "--stage_workers",
+        type=int,
+        default=2,
+        help="with --scheduler overlapped, threads that tokenize and threads that "
+        "decode",
+    )
+    parser.add_argument(
+        "--draft_model",
+        default=None,
+        help="smaller model with the same tokenizer that drafts tokens for the "
+        "transformers backend to verify; generates one prompt at a time",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="append per-call token counts and timings to this JSONL file",
+    )
+    add_device_arguments(parser)
+    add_guard_arguments(parser)
+
+
+def add_guard_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--token_budget",
+        action="store_true",
+        help="cap new tokens per prompt at a task-specific multiple of its length",
+    )
+    parser.add_argument(
+        "--no_loop_stop",
+        action="store_true",
+        help="do not stop generations that repeat the same tokens over and over",
+    )
+    parser.add_argument(
+        "--max_thinking_tokens",
+        type=int,
+        default=None,
+        help="force </think> after this many tokens when thinking is enabled",
+    )
+    parser.add_argument(
+        "--constrained",
+        action="store_true",
+        help="only allow output that follows the format of the prompt",
+    )
+
+
+def load_guard(
+    args: argparse.Namespace, task: str, grammar: str | None = None
+) -> "GenerationGuard":
+    from .stopping import GenerationGuard
+
+    if args.constrained and args.backend != "transformers":
+        raise ValueError("--constrained needs the transformers backend")
+    return GenerationGuard(
+        task,
+        token_budget=args.token_budget,
+        stop_loops=not args.no_loop_stop,
+        max_thinking_tokens=args.max_thinking_tokens,
+        grammar=grammar if args.constrained else None,
+    )
+
+
+def report_token_savings(
+    backend: Backend, prompts: list[str], names: list[str], guard: "GenerationGuard"
+) -> None:
+    # Reruns the prompts greedily with and without the grammar, one at a time
+    token_counts = backend.compare_constrained(prompts, guard)
+    for name, (unconstrained, constrained) in zip(names, token_counts):
+        print(
+            f"{name}: generated {unconstrained} tokens unconstrained, "
+            f"{constrained} constrained ({unconstrained - constrained} saved)"
+        )
+    saved = sum(
+        unconstrained - constrained for unconstrained, constrained in token_counts
+    )
+    print(
+        f"Constrained decoding saved {saved} generated tokens over "
+        f"{len(token_counts)} prompts, greedy, counting thinking and end tokens"
+    )
+
+
+def load_telemetry(args: argparse.Namespace, **tags: Any) -> Telemetry | None:
+    if args.metrics is None:
+        return None
+    return Telemetry(args.metrics, model=args.model, backend=args.backend, **tags)
+
+
+def load_backend(args: argparse.Namespace) -> Backend:
+    if args.quantize != "none" and args.device != "cpu":
+        raise ValueError("--quantize needs --device cpu")
+    if args.draft_model is not None:
+        if args.backend != "transformers":
+            raise ValueError("--draft_model needs the transformers backend")
+        if args.scheduler != "static":
+            raise ValueError("--draft_model needs --scheduler static")
+        if getattr(args, "prefix_cache", False):
+            raise ValueError("--draft_model cannot be combined with --prefix_cache")
+        if getattr(args, "batch_size", 1) > 1:
+            print("--draft_model generates one prompt at a time, ignoring --batch_size")
+    if args.backend == "transformers":
+        from .model_server import connect_model_server
+
+        backend = connect_model_server(args)
+        if backend is not None:
+            return backend
+    set_threads(args.threads, args.interop_threads)
+    if args.backend == "transformers":
+        return TransformersBackend(
+            args.model,
+            scheduler=args.scheduler,
+            device=args.device,
+            quantize=args.quantize,
+            quantized_dir=args.quantized_dir,
+            draft_model=args.draft_model,
+            prefetch_batches=args.prefetch_batches,
+            stage_workers=args.stage_workers,
+            max_new_tokens=args.max_new_tokens,
+        )
+    elif args.backend == "openai":
+        return OpenAIServerBackend(
+            args.model,
+            base_url=args.base_url,
+            concurrency=args.concurrency,
+            max_new_tokens=args.max_new_tokens,
+        )
+    elif args.backend == "mock":
+        return MockBackend(args.model)
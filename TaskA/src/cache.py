@@ -0,0 +1,162 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+
+
+class ResponseCache:
+    # last_used updates of cache hits are written in batches of this size
+    touch_batch = 256
+
+    def __init__(self, cache_dir: str, max_size_mb: float = 2048) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "responses.sqlite")
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.touched = {}
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        # Commits without an fsync each, a crash loses at most the last ones
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(
+        model_name: str,
+        text: str,
+        enable_thinking: bool,
+        generation_kwargs: dict[str, Any],
+    ) -> str:
+        payload = json.dumps(
+            {
+                "model": model_name,
+                "text": text,
+                "enable_thinking": enable_thinking,
+                "generation": generation_kwargs,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> str | None:
+        row = self.conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.touched[key] = time.time()
+        if len(self.touched) >= self.touch_batch:
+            self._flush()
+            self.conn.commit()
+        return row[0]
+
+    def _flush(self) -> None:
+        self.conn.executemany(
+            "UPDATE responses SET last_used = ? WHERE key = ?",
+            [(last_used, key) for key, last_used in self.touched.items()],
+        )
+        self.touched.clear()
+
+    def put(self, key: str, response: str) -> None:
+        with self.lock:
+            self._put(key, response)
+
+    def _put(self, key: str, response: str) -> None:
+        size = len(response.encode("utf-8"))
+        old = self.conn.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time()),
+        )
+        self.size += size - (old[0] if old else 0)
+        self.touched.pop(key, None)
+        if self.size > self.max_size:
+            self._flush()
+            self.evict()
+        self.conn.commit()
+
+    def evict(self) -> None:
+        # Drop least recently used responses until the cache fits its size cap,
+        # reading only as many of the oldest rows as it takes
+        while self.size > self.max_size:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT ?",
+                (self.touch_batch,),
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+                self.evictions += 1
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"Response cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1%} hit rate), {self.evictions} evictions, "
+            f"{self.size / 1024 / 1024:.1f} MB in {self.path}"
+        )
+
+    def close(self) -> None:
+        with self.lock:
+            self._flush()
+            self.conn.commit()
+            self.conn.close()
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="disable the on-disk cache of model responses",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default="output/response_cache",
+        help="path to the on-disk cache of model responses",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=2048,
+        help="size cap of the response cache, least recently used entries go first",
+    )
+
+
+def load_response_cache(args: argparse.Namespace) -> ResponseCache | None:
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache_dir, args.cache_max_mb)
@@ -0,0 +1,50 @@
+import json
+import os
+from typing import Any, Iterator
+
+
+class JsonlCheckpoint:
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        self.drop_partial_record()
+
+    def drop_partial_record(self) -> None:
+        # A crash in the middle of a write leaves an unterminated last line
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            data = f.read()
+            f.truncate(data.rfind(b"\n") + 1)
+
+    def records(self) -> Iterator[dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def keys(self) -> set[str]:
+        return {record["key"] for record in self.records()}
+
+    def load(self) -> dict[str, str]:
+        return {record["key"]: record["response"] for record in self.records()}
+
+    def append(self, key: str, response: str, hash: str | None = None) -> None:
+        record = {"key": key, "response": response}
+        if hash is not None:
+            record["hash"] = hash
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,105 @@
+import argparse
+import re
+
+from .utils import normalize_entity_name, parse_entity_line
+
+CHUNK_SEPARATOR = "#"
+
+
+def add_chunk_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--max_chunk_tokens",
+        type=int,
+        default=0,
+        help="split document texts into windows of at most this many tokens, "
+        "0 keeps whole documents",
+    )
+    parser.add_argument(
+        "--chunk_overlap",
+        type=int,
+        default=64,
+        help="tokens shared by consecutive windows, so entities on a window "
+        "boundary appear whole in one of them",
+    )
+
+
+def word_spans(text: str) -> list[tuple[int, int]]:
+    # Stand-in for tokenizer offsets when the backend has no local tokenizer
+    return [match.span() for match in re.finditer(r"\S+", text)]
+
+
+def chunk_text(
+    text: str,
+    spans: list[tuple[int, int]],
+    max_tokens: int,
+    overlap: int,
+) -> list[str]:
+    if max_tokens <= 0 or len(spans) <= max_tokens:
+        return [text]
+    stride = max(1, max_tokens - overlap)
+    chunks = []
+    for start in range(0, len(spans), stride):
+        end = min(start + max_tokens, len(spans))
+        chunks.append(text[spans[start][0] : spans[end - 1][1]].strip())
+        if end == len(spans):
+            break
+    return chunks
+
+
+def chunk_docs(
+    docs: list[dict[str, str]],
+    token_spans,
+    max_tokens: int,
+    overlap: int,
+) -> list[dict[str, str]]:
+    # Documents that fit keep their id, so their prompts and checkpoint keys
+    # are the same as without chunking
+    chunks = []
+    for doc in docs:
+        texts = chunk_text(doc["text"], token_spans(doc["text"]), max_tokens, overlap)
+        if len(texts) == 1:
+            chunks.append(doc)
+            continue
+        for index, text in enumerate(texts):
+            chunks.append(
+                {
+                    **doc,
+                    "id": f"{doc['id']}{CHUNK_SEPARATOR}{index}",
+                    "doc_id": doc["id"],
+                    "chunk": index,
+                    "text": text,
+                }
+            )
+    return chunks
+
+
+def merge_entity_lines(contents: list[str]) -> str:
+    # Windows overlap, so the same entity is often extracted twice; keep the
+    # first position and the most detailed line of each entity
+    merged = {}
+    for content in contents:
+        for line in content.splitlines():
+            record = parse_entity_line(line)
+            key = line if record is None else normalize_entity_name(record.name)
+            if key not in merged or len(line) > len(merged[key]):
+                merged[key] = line
+    return "\n".join(merged.values())
+
+
+def merge_chunk_responses(
+    doc_ids: list[str], responses: dict[str, str]
+) -> dict[str, str]:
+    contents = {}
+    for doc_id in doc_ids:
+        if doc_id in responses:
+            contents[doc_id] = responses[doc_id]
+            continue
+        chunk_contents = []
+        while f"{doc_id}{CHUNK_SEPARATOR}{len(chunk_contents)}" in responses:
+            chunk_contents.append(
+                responses[f"{doc_id}{CHUNK_SEPARATOR}{len(chunk_contents)}"]
+            )
+        if not chunk_contents:
+            raise KeyError(f"no response for document {doc_id}")
+        contents[doc_id] = merge_entity_lines(chunk_contents)
+    return contents
@@ -0,0 +1,102 @@
+import functools
+import json
+import mmap
+import os
+from typing import Any, Iterable, Iterator
+
+
+class DocumentStore:
+    # Byte-offset index over a JSONL file of documents with an "id" field. The
+    # index is saved next to the file and rebuilt whenever the file changes
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index_path = path + ".idx"
+        stat = os.stat(path)
+        self.signature = [stat.st_size, stat.st_mtime_ns]
+        index = self.load_index()
+        if index is None:
+            index = self.build_index()
+            self.save_index(index)
+        # Line i spans offsets[i] to offsets[i + 1]
+        self.doc_ids, self.offsets = index
+        self.positions = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self.file = open(path, "rb")
+        # mmap cannot map an empty file
+        self.data = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if stat.st_size
+            else b""
+        )
+
+    def load_index(self) -> tuple[list[str], list[int]] | None:
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get("signature") != self.signature:
+            return None
+        return index["ids"], index["offsets"]
+
+    def build_index(self) -> tuple[list[str], list[int]]:
+        doc_ids = []
+        offsets = []
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    doc_ids.append(json.loads(line)["id"])
+                    offsets.append(offset)
+                offset += len(line)
+        offsets.append(offset)
+        return doc_ids, offsets
+
+    def save_index(self, index: tuple[list[str], list[int]]) -> None:
+        # Read-only data directories just keep the index in memory
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {"signature": self.signature, "ids": index[0], "offsets": index[1]},
+                    f,
+                )
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.positions
+
+    def ids(self) -> list[str]:
+        # In file order
+        return list(self.doc_ids)
+
+    def read(self, position: int) -> dict[str, Any]:
+        return json.loads(
+            self.data[self.offsets[position] : self.offsets[position + 1]]
+        )
+
+    def get(self, doc_id: str) -> dict[str, Any]:
+        return self.read(self.positions[doc_id])
+
+    def get_many(self, doc_ids: Iterable[str]) -> list[dict[str, Any]]:
+        # Known ids in file order, the order the documents were read in before
+        positions = sorted(
+            self.positions[doc_id] for doc_id in doc_ids if doc_id in self.positions
+        )
+        return [self.read(position) for position in positions]
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+@functools.cache
+def open_document_store(path: str) -> DocumentStore:
+    # One store per file and process, shared by every lookup in a run
+    return DocumentStore(path)
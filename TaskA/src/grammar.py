@@ -0,0 +1,227 @@
+from collections import Counter
+
+import torch
+from transformers import AutoTokenizer, LogitsProcessor
+
+WHITESPACE = " \n\t"
+# Longest whitespace run allowed between JSON tokens, enough for indentation
+MAX_WHITESPACE = 16
+
+
+class CharGrammar:
+    # A small DFA over characters. Each state has ordered rules (chars, next state):
+    # the first rule whose chars contain the character wins, "" matches any
+    # character and a next state of None rejects it.
+    def __init__(self, name: str, start: str) -> None:
+        self.name = name
+        self.start = start
+        self.rules = {}
+        self.final = set()
+        self.masks = {}
+        self.token_strings = None
+
+    def add(
+        self, state: str, rules: list[tuple[str, str | None]], ws: bool = False
+    ) -> None:
+        if not ws:
+            self.rules[state] = rules
+            return
+        # Bounded whitespace before the rules apply, so a weak model cannot
+        # spin on blank space forever
+        names = [state] + [f"{state}~{i}" for i in range(1, MAX_WHITESPACE + 1)]
+        for current, following in zip(names, names[1:]):
+            self.rules[current] = rules + [(WHITESPACE, following)]
+        self.rules[names[-1]] = rules
+
+    def literal(self, state: str, text: str, next_state: str, ws: bool = False) -> None:
+        # Chain of states matching text, optionally after leading whitespace
+        for i, ch in enumerate(text):
+            current = state if i == 0 else f"{state}:{i}"
+            following = next_state if i == len(text) - 1 else f"{state}:{i + 1}"
+            self.add(current, [(ch, following)], ws=ws and i == 0)
+
+    def step(self, state: str | None, text: str) -> str | None:
+        for ch in text:
+            if state is None:
+                return None
+            for chars, next_state in self.rules[state]:
+                if chars == "" or ch in chars:
+                    state = next_state
+                    break
+            else:
+                return None
+        return state
+
+    def prepare(self, tokenizer: AutoTokenizer, vocab_size: int) -> None:
+        if self.token_strings is not None and len(self.token_strings) == vocab_size:
+            return
+        special_ids = set(tokenizer.all_special_ids) | set(
+            tokenizer.added_tokens_decoder
+        )
+        self.token_strings = [
+            (
+                tokenizer.decode([token_id])
+                if token_id < len(tokenizer) and token_id not in special_ids
+                else ""
+            )
+            for token_id in range(vocab_size)
+        ]
+        self.masks = {}
+
+    def mask(
+        self, state: str, end_token_ids: set[int], device: torch.device
+    ) -> torch.BoolTensor:
+        # Tokens allowed in a state are computed once and reused
+        if state not in self.masks:
+            allowed = torch.tensor(
+                [
+                    bool(text) and self.step(state, text) is not None
+                    for text in self.token_strings
+                ]
+            )
+            if state in self.final:
+                allowed[list(end_token_ids)] = True
+            self.masks[state] = allowed
+        if self.masks[state].device != device:
+            self.masks[state] = self.masks[state].to(device)
+        return self.masks[state]
+
+
+def entity_lines_grammar() -> CharGrammar:
+    # ("entity"|||<entity_name>|||<entity_type>|||<entity_description>) per line
+    grammar = CharGrammar("ee", "line")
+    grammar.literal("line", '("entity"|||', "name_first")
+    for field, next_field in (("name", "type_first"), ("type", "desc_first")):
+        # Fields are never empty
+        grammar.add(f"{field}_first", [("|\n", None), ("", field)])
+        grammar.add(field, [("|", f"{field}_sep"), ("\n", None), ("", field)])
+        grammar.literal(f"{field}_sep", "||", next_field)
+    grammar.add("desc_first", [("\n", None), ("", "desc")])
+    grammar.add("desc", [(")", "desc_close"), ("\n", None), ("", "desc")])
+    grammar.add("desc_close", [("\n", "next_line"), (")", "desc_close"), ("", "desc")])
+    grammar.literal("next_line", '("entity"|||', "name_first")
+    # A document without entities gets an empty answer
+    grammar.final |= {"line", "desc_close", "next_line"}
+    return grammar
+
+
+def classification_lines_grammar() -> CharGrammar:
+    # <entity_name>|||<entity_classification> per line, term or type
+    grammar = CharGrammar("ec_lines", "line")
+    grammar.add("line", [(WHITESPACE + "|", None), ("", "name")])
+    grammar.add("name", [("|", "sep"), ("\n", None), ("", "name")])
+    grammar.literal("sep", "||", "class")
+    grammar.add("class", [("t", "t")])
+    grammar.add("t", [("e", "te"), ("y", "ty")])
+    grammar.literal("te", "rm", "class_end")
+    grammar.literal("ty", "pe", "class_end")
+    grammar.add("class_end", [("\n", "next_line")])
+    grammar.add("next_line", [("|\n", None), ("", "name")])
+    grammar.final |= {"class_end", "next_line"}
+    return grammar
+
+
+def classification_json_grammar() -> CharGrammar:
+    # [{"entity": "<entity_name>", "classification": "term" | "type"}, ...]
+    grammar = CharGrammar("ec_json", "array")
+    grammar.literal("array", "[", "object", ws=True)
+    grammar.literal("object", "{", "entity_key", ws=True)
+    grammar.literal("entity_key", '"entity"', "entity_colon", ws=True)
+    grammar.literal("entity_colon", ":", "entity_open", ws=True)
+    grammar.literal("entity_open", '"', "entity_first", ws=True)
+    grammar.add("entity_first", [('"\\\n', None), ("", "entity")])
+    grammar.add("entity", [('"', "entity_comma"), ("\\\n", None), ("", "entity")])
+    grammar.literal("entity_comma", ",", "class_key", ws=True)
+    grammar.literal("class_key", '"classification"', "class_colon", ws=True)
+    grammar.literal("class_colon", ":", "class_open", ws=True)
+    grammar.literal("class_open", '"', "class", ws=True)
+    grammar.add("class", [("t", "t")])
+    grammar.add("t", [("e", "te"), ("y", "ty")])
+    grammar.literal("te", "rm", "class_close")
+    grammar.literal("ty", "pe", "class_close")
+    grammar.literal("class_close", '"', "object_close")
+    grammar.literal("object_close", "}", "array_next", ws=True)
+    grammar.add("array_next", [(",", "object"), ("]", "end")], ws=True)
+    grammar.add("end", [])
+    grammar.final.add("end")
+    return grammar
+
+
+GRAMMARS = {
+    "ee": entity_lines_grammar,
+    "ec_lines": classification_lines_grammar,
+    "ec_json": classification_json_grammar,
+}
+_grammar_instances = {}
+
+
+def load_grammar(name: str) -> CharGrammar:
+    # Token masks are expensive to build, so each grammar is built once
+    if name not in _grammar_instances:
+        _grammar_instances[name] = GRAMMARS[name]()
+    return _grammar_instances[name]
+
+
+class GrammarLogitsProcessor(LogitsProcessor):
+    def __init__(
+        self,
+        grammar: CharGrammar,
+        tokenizer: AutoTokenizer,
+        input_length: int,
+        end_token_ids: set[int],
+        enable_thinking: bool,
+        think_end_token_id: int,
+        stats: Counter,
+        row_stats: list[Counter] | None = None,
+    ) -> None:
+        self.grammar = grammar
+        self.tokenizer = tokenizer
+        self.input_length = input_length
+        self.end_token_ids = end_token_ids
+        self.think_end_token_id = think_end_token_id
+        self.stats = stats
+        # The same counts per row, when the caller keeps them per prompt
+        self.row_stats = row_stats
+        # With thinking enabled, the grammar only starts after </think>
+        self.states = None
+        self.thinking = enable_thinking
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        batch_size = input_ids.shape[0]
+        if self.states is None:
+            self.grammar.prepare(self.tokenizer, scores.shape[1])
+            self.states = [None if self.thinking else self.grammar.start] * batch_size
+            self.stats["rows"] += batch_size
+            for stats in self.row_stats or []:
+                stats["rows"] += 1
+        elif input_ids.shape[1] > self.input_length:
+            for row in range(batch_size):
+                token_id = int(input_ids[row, -1])
+                if self.states[row] is None:
+                    if token_id == self.think_end_token_id:
+                        self.states[row] = self.grammar.start
+                    continue
+                if token_id in self.end_token_ids:
+                    continue
+                self.states[row] = self.grammar.step(
+                    self.states[row], self.grammar.token_strings[token_id]
+                )
+                if self.states[row] is None:
+                    # Only possible if a disallowed token slipped through
+                    self.states[row] = self.grammar.start
+
+        for row, state in enumerate(self.states):
+            if state is None:
+                continue
+            allowed = self.grammar.mask(state, self.end_token_ids, scores.device)
+            # Count the steps where the model would have left the grammar
+            if not allowed[scores[row].argmax()]:
+                self.stats["interventions"] += 1
+                if self.row_stats is not None:
+                    self.row_stats[row]["interventions"] += 1
+            scores[row] = scores[row].masked_fill(
+                ~allowed, torch.finfo(scores.dtype).min
+            )
+        return scores
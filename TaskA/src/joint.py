@@ -0,0 +1,249 @@
+from typing import Any, Callable
+
+import torch
+from tqdm import tqdm
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from .cache import ResponseCache
+from .prompts import plain_classification_joint_real_data
+from .stopping import GenerationGuard
+from .telemetry import GenerationTimer, Telemetry, count_new_tokens
+from .utils import (
+    GENERATION_KWARGS,
+    THINK_END_TOKEN_ID,
+    decode_response,
+    ee_content2entities,
+    end_token_ids,
+    render_chat,
+    response_cache_key,
+    split_prompt_template,
+)
+
+# Tokens per forward pass when prefilling a turn on top of a cache
+PREFILL_CHUNK_TOKENS = 1024
+
+
+def joint_classification_prompt(
+    ec_template: str, ec_kwargs: dict[str, str], entities: str
+) -> str:
+    # EC Prompt 2 instructions and examples, pointing at the document already
+    # in the conversation instead of repeating it
+    prefix, _ = split_prompt_template(ec_template)
+    return prefix.format(**ec_kwargs) + plain_classification_joint_real_data.format(
+        entities=entities
+    )
+
+
+def prefill_chunks(
+    model: AutoModelForCausalLM, input_ids: torch.LongTensor, past_key_values: Any
+) -> None:
+    # Attention over a cache goes through an explicit mask instead of the
+    # causal kernel, and one mask for the whole turn is slower than prefilling
+    # the conversation from scratch. The last token is left to generate()
+    end = input_ids.shape[1] - 1
+    with torch.no_grad():
+        for start in range(past_key_values.get_seq_length(), end, PREFILL_CHUNK_TOKENS):
+            model(
+                input_ids=input_ids[:, start : min(start + PREFILL_CHUNK_TOKENS, end)],
+                past_key_values=past_key_values,
+                use_cache=True,
+                # generate() computes the logits of the last token
+                logits_to_keep=1,
+            )
+
+
+def generate_turn(
+    model_inputs: dict[str, Any],
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    enable_thinking: bool,
+    guard: GenerationGuard | None,
+    timer: GenerationTimer | None,
+    generation_kwargs: dict[str, Any],
+) -> tuple[torch.LongTensor, Any]:
+    turn_kwargs = dict(generation_kwargs)
+    if guard is not None:
+        turn_kwargs.update(
+            guard.generate_kwargs(
+                model_inputs,
+                tokenizer,
+                model,
+                enable_thinking,
+                generation_kwargs["max_new_tokens"],
+            )
+        )
+    outputs = model.generate(
+        **model_inputs,
+        **turn_kwargs,
+        return_dict_in_generate=True,
+        streamer=timer,
+    )
+    return outputs.sequences[0], outputs.past_key_values
+
+
+def qwen_gen_joint(
+    docs: list[dict[str, str]],
+    ee_template: str,
+    ee_kwargs: dict[str, str],
+    ec_template: str,
+    ec_kwargs: dict[str, str],
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    enable_thinking: bool = False,
+    desc: str | None = None,
+    response_cache: ResponseCache | None = None,
+    on_output: Callable[[int, str, str], None] | None = None,
+    ee_guard: GenerationGuard | None = None,
+    ec_guard: GenerationGuard | None = None,
+    telemetry: Telemetry | None = None,
+    ee_tags: list[dict[str, Any]] | None = None,
+    ec_tags: list[dict[str, Any]] | None = None,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> tuple[list[str], list[str], list[int]]:
+    # Extraction and then EC Prompt 2 classification as two turns of one
+    # conversation per document. The second turn continues from the KV cache
+    # of the first, so the document is prefilled once. Documents run one at a
+    # time, each holding its cache until its classification is done. Returns
+    # both contents and the prefill tokens saved against a separate EC prompt
+    if generation_kwargs is None:
+        generation_kwargs = GENERATION_KWARGS
+    stop_token_ids = end_token_ids(model)
+    im_end_token_id = tokenizer.convert_tokens_to_ids("<|im_end|>")
+    ee_contents = [None] * len(docs)
+    ec_contents = [None] * len(docs)
+    saved_tokens = [0] * len(docs)
+
+    def classification_turn(ee_text: str, ee_content: str) -> tuple[str, str, str]:
+        # The classification turn depends on the whole conversation so far
+        entities = "\n".join(ee_content2entities(ee_content))
+        ec_text = render_chat(
+            tokenizer,
+            joint_classification_prompt(ec_template, ec_kwargs, entities),
+            enable_thinking,
+        )
+        ec_key = response_cache_key(
+            model,
+            ee_text + ee_content + ec_text,
+            enable_thinking,
+            ec_guard,
+            generation_kwargs,
+        )
+        return entities, ec_text, ec_key
+
+    for i, doc in enumerate(tqdm(docs, desc=desc, disable=desc is None)):
+        ee_text = render_chat(
+            tokenizer,
+            ee_template.format(**ee_kwargs, title=doc["title"], text=doc["text"]),
+            enable_thinking,
+        )
+        if response_cache is not None:
+            ee_key = response_cache_key(
+                model, ee_text, enable_thinking, ee_guard, generation_kwargs
+            )
+            ee_contents[i] = response_cache.get(ee_key)
+            if ee_contents[i] is not None:
+                ec_contents[i] = response_cache.get(
+                    classification_turn(ee_text, ee_contents[i])[2]
+                )
+            if ec_contents[i] is not None:
+                if on_output is not None:
+                    on_output(i, ee_contents[i], ec_contents[i])
+                continue
+
+        ee_inputs = tokenizer([ee_text], return_tensors="pt").to(model.device)
+        timer = GenerationTimer() if telemetry is not None else None
+        sequence, past_key_values = generate_turn(
+            ee_inputs,
+            tokenizer,
+            model,
+            enable_thinking,
+            ee_guard,
+            timer,
+            generation_kwargs,
+        )
+        prompt_length = ee_inputs["input_ids"].shape[1]
+        output_ids = sequence[prompt_length:].tolist()
+        token_counts = count_new_tokens(output_ids, stop_token_ids, THINK_END_TOKEN_ID)
+        ee_contents[i] = decode_response(tokenizer, output_ids)
+        if telemetry is not None:
+            telemetry.record(
+                ee_tags[i] if ee_tags is not None else None,
+                batch=telemetry.next_batch(),
+                batch_size=1,
+                prompt_tokens=prompt_length,
+                **token_counts,
+                **timer.timings(),
+            )
+
+        # The user turn that follows, closing the extraction turn if it was cut
+        # off before <|im_end|>
+        sequence = sequence[: prompt_length + token_counts["new_tokens"]]
+        entities, ec_text, ec_key = classification_turn(ee_text, ee_contents[i])
+        closing = "\n" if sequence[-1] == im_end_token_id else "<|im_end|>\n"
+        turn_ids = tokenizer(
+            closing + ec_text, add_special_tokens=False, return_tensors="pt"
+        ).input_ids.to(model.device)
+        input_ids = torch.cat([sequence[None], turn_ids], dim=1)
+        # generate() leaves the last token of a turn out of the cache, and
+        # anything past the end token is dropped
+        past_key_values.crop(
+            min(past_key_values.get_seq_length(), sequence.shape[0] - 1)
+        )
+        reused_tokens = past_key_values.get_seq_length()
+
+        timer = GenerationTimer() if telemetry is not None else None
+        prefill_chunks(model, input_ids, past_key_values)
+        sequence, past_key_values = generate_turn(
+            {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "past_key_values": past_key_values,
+            },
+            tokenizer,
+            model,
+            enable_thinking,
+            ec_guard,
+            timer,
+            generation_kwargs,
+        )
+        # The document's cache is not needed past its classification
+        del past_key_values
+        output_ids = sequence[input_ids.shape[1] :].tolist()
+        ec_contents[i] = decode_response(tokenizer, output_ids)
+
+        # What the same classification costs as a separate EC Prompt 2
+        standalone_tokens = len(
+            tokenizer(
+                render_chat(
+                    tokenizer,
+                    ec_template.format(
+                        **ec_kwargs,
+                        title=doc["title"],
+                        text=doc["text"],
+                        entities=entities,
+                    ),
+                    enable_thinking,
+                ),
+                add_special_tokens=False,
+            ).input_ids
+        )
+        prefill_tokens = input_ids.shape[1] - reused_tokens
+        saved_tokens[i] = standalone_tokens - prefill_tokens
+        if telemetry is not None:
+            telemetry.record(
+                ec_tags[i] if ec_tags is not None else None,
+                batch=telemetry.next_batch(),
+                batch_size=1,
+                prompt_tokens=prefill_tokens,
+                reused_tokens=reused_tokens,
+                prefill_tokens_saved=saved_tokens[i],
+                **count_new_tokens(output_ids, stop_token_ids, THINK_END_TOKEN_ID),
+                **timer.timings(),
+            )
+        if response_cache is not None:
+            response_cache.put(ee_key, ee_contents[i])
+            response_cache.put(ec_key, ec_contents[i])
+        if on_output is not None:
+            on_output(i, ee_contents[i], ec_contents[i])
+
+    return ee_contents, ec_contents, saved_tokens
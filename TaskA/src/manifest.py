@@ -0,0 +1,81 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING, Any, Iterable
+
+from .checkpoint import JsonlCheckpoint
+
+if TYPE_CHECKING:
+    from .backends import Backend
+    from .stopping import GenerationGuard
+
+MANIFEST_NAME = "manifest.json"
+
+
+def add_manifest_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="reuse the responses of the previous run for prompts whose hash "
+        "is unchanged, and only generate the rest",
+    )
+
+
+def prompt_hash(
+    backend: "Backend", prompt: str, guard: "GenerationGuard | None"
+) -> str:
+    # The rendered prompt covers the title, text, template and examples
+    fields = {
+        "model": backend.model_name,
+        "prompt": prompt,
+        "generation": backend.generation_kwargs,
+        "guard": guard.config() if guard is not None else None,
+    }
+    if backend.quantize is not None:
+        # Only when set, so manifests of unquantized runs keep their hashes
+        fields["quantize"] = backend.quantize
+    payload = json.dumps(
+        fields,
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_manifest(output_dir: str) -> dict[str, dict[str, str]]:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output_dir: str, records: Iterable[dict[str, Any]]) -> None:
+    # Written with the final outputs, so it always describes the last full run
+    manifest = {
+        record["key"]: {"hash": record["hash"], "response": record["response"]}
+        for record in records
+        if "hash" in record
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as fout:
+        json.dump(manifest, fout, indent=2)
+
+
+def reuse_unchanged(
+    manifest: dict[str, dict[str, str]],
+    keys: list[str],
+    hashes: list[str],
+    checkpoint: JsonlCheckpoint,
+) -> list[int]:
+    # Looked up by hash rather than key, so EC Prompt 1 lines are found again
+    # after the entity list shifts; returns the indices still to generate
+    responses = {entry["hash"]: entry["response"] for entry in manifest.values()}
+    pending = []
+    for i, (key, hash) in enumerate(zip(keys, hashes)):
+        if hash in responses:
+            checkpoint.append(key, responses[hash], hash=hash)
+        else:
+            pending.append(i)
+    print(f"Incremental: {len(keys) - len(pending)} reused, {len(pending)} to generate")
+    return pending
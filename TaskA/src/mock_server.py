@@ -0,0 +1,72 @@
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .backends import MockBackend
+
+
+def make_handler(backend: MockBackend) -> type[BaseHTTPRequestHandler]:
+    class ChatCompletionsHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self) -> None:
+            if not self.path.endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if backend.latency:
+                time.sleep(backend.latency)
+            prompt = request["messages"][-1]["content"]
+            content = backend.respond(prompt)
+            body = json.dumps(
+                {
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", backend.model_name),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    # Whitespace-separated words stand in for tokens
+                    "usage": {
+                        "prompt_tokens": len(prompt.split()),
+                        "completion_tokens": len(content.split()),
+                    },
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return ChatCompletionsHandler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="OpenAI-compatible stub server answering with the mock backend"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds to wait per request"
+    )
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(
+        (args.host, args.port), make_handler(MockBackend(latency=args.latency))
+    )
+    print(f"Serving mock chat completions on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Iterator
+
+from .backends import SCHEDULERS, Backend, TransformersBackend
+from .cache import ResponseCache
+from .quantization import add_device_arguments, set_threads
+from .telemetry import Telemetry, TelemetryRelay
+from .utils import (
+    GENERATION_KWARGS,
+    generate_with_cache,
+    render_chat,
+    response_cache_key,
+)
+
+if TYPE_CHECKING:
+    from .stopping import GenerationGuard
+
+# Arguments that rebuild a client's GenerationGuard in the server
+GUARD_FIELDS = (
+    "task",
+    "token_budget",
+    "stop_loops",
+    "max_period",
+    "min_repeats",
+    "min_loop_tokens",
+    "max_thinking_tokens",
+    "think_end_token_id",
+    "grammar",
+)
+
+
+def guard_kwargs(guard: "GenerationGuard | None") -> dict[str, Any] | None:
+    if guard is None:
+        return None
+    return {name: getattr(guard, name) for name in GUARD_FIELDS}
+
+
+def load_guard_kwargs(kwargs: dict[str, Any] | None) -> "GenerationGuard | None":
+    from .stopping import GenerationGuard
+
+    return GenerationGuard(**kwargs) if kwargs is not None else None
+
+
+# One JSON message per line in both directions
+def write_message(file: BinaryIO, message: dict[str, Any]) -> None:
+    file.write((json.dumps(message) + "\n").encode("utf-8"))
+    file.flush()
+
+
+def read_message(file: BinaryIO) -> dict[str, Any]:
+    line = file.readline()
+    if not line:
+        raise ConnectionError("the model server closed the connection")
+    message = json.loads(line)
+    if "error" in message:
+        raise RuntimeError(f"model server: {message['error']}")
+    return message
+
+
+class GenerationRequest:
+    def __init__(self, message: dict[str, Any]) -> None:
+        self.prompts = message["prompts"]
+        self.enable_thinking = message.get("enable_thinking", False)
+        self.batch_size = message.get("batch_size", 1)
+        self.guard = message.get("guard")
+        self.telemetry = message.get("telemetry", False)
+        # Messages for the client, ending with done or error
+        self.outputs = queue.Queue()
+
+    def group(self) -> str:
+        # Only requests that generate the same way share a generate call
+        return json.dumps(
+            [self.enable_thinking, self.batch_size, self.guard], sort_keys=True
+        )
+
+
+class ModelServer:
+    # Loads the model once and merges the generate requests of all clients that
+    # arrive within batch_window into shared generate calls
+    def __init__(self, backend: TransformersBackend, batch_window: float) -> None:
+        from transformers import AutoTokenizer
+
+        self.backend = backend
+        self.batch_window = batch_window
+        self.requests = queue.Queue()
+        # Cache keys and token spans are answered while the generation thread
+        # uses the backend tokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(backend.model_name)
+        self.tokenizer_lock = threading.Lock()
+        self.stats = Counter()
+        self.relay = TelemetryRelay()
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "model": self.backend.model_name,
+            "quantize": self.backend.quantize,
+            "draft_model": self.backend.draft_model_name,
+            "scheduler": self.backend.scheduler,
+            "device": self.backend.device,
+            "generation": self.backend.generation_kwargs,
+            "pid": os.getpid(),
+            **self.stats,
+        }
+
+    def cache_keys(self, message: dict[str, Any]) -> list[str]:
+        guard = load_guard_kwargs(message.get("guard"))
+        enable_thinking = message.get("enable_thinking", False)
+        with self.tokenizer_lock:
+            texts = [
+                render_chat(self.tokenizer, prompt, enable_thinking)
+                for prompt in message["prompts"]
+            ]
+        # The keys of in-process generation, so both share the response cache
+        return [
+            response_cache_key(
+                self.backend.model,
+                text,
+                enable_thinking,
+                guard,
+                self.backend.generation_kwargs,
+            )
+            for text in texts
+        ]
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        with self.tokenizer_lock:
+            return self.tokenizer(
+                text, add_special_tokens=False, return_offsets_mapping=True
+            )["offset_mapping"]
+
+    def serve_generation(self) -> None:
+        while True:
+            requests = [self.requests.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while (timeout := deadline - time.perf_counter()) > 0:
+                try:
+                    requests.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            groups = {}
+            for request in requests:
+                groups.setdefault(request.group(), []).append(request)
+            for group in groups.values():
+                self.generate(group)
+
+    def generate(self, group: list[GenerationRequest]) -> None:
+        rows = [(request, i) for request in group for i in range(len(request.prompts))]
+        guard = load_guard_kwargs(group[0].guard)
+        if guard is not None:
+            # Keyed by row, so every client gets the stats of its own prompts
+            guard.prompt_stats = {}
+        relay = self.relay if any(request.telemetry for request in group) else None
+        if relay is not None:
+            relay.fields = {}
+
+        def send_output(row: int, content: str) -> None:
+            request, i = rows[row]
+            stats = relay.fields.pop(row, {}) if relay is not None else {}
+            if request.telemetry:
+                stats["clients"] = len(group)
+            output = {"index": i, "content": content, "stats": stats}
+            if guard is not None:
+                output["guard_stats"] = guard.prompt_stats.pop(
+                    row, {"early_stops": [], "grammar_stats": {}}
+                )
+            request.outputs.put(output)
+
+        self.stats["calls"] += 1
+        self.stats["requests"] += len(group)
+        self.stats["prompts"] += len(rows)
+        try:
+            self.backend.generate(
+                [request.prompts[i] for request, i in rows],
+                batch_size=group[0].batch_size,
+                enable_thinking=group[0].enable_thinking,
+                on_output=send_output,
+                guard=guard,
+                telemetry=relay,
+                tags=[{"row": row} for row in range(len(rows))],
+            )
+        except Exception as error:
+            for request in group:
+                request.outputs.put({"error": f"{type(error).__name__}: {error}"})
+            return
+        for request in group:
+            request.outputs.put({"done": True, "clients": len(group)})
+
+
+def make_handler(server: ModelServer) -> type[socketserver.StreamRequestHandler]:
+    class ModelServerHandler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            for line in self.rfile:
+                message = json.loads(line)
+                try:
+                    self.reply(message)
+                except Exception as error:
+                    write_message(
+                        self.wfile, {"error": f"{type(error).__name__}: {error}"}
+                    )
+
+        def reply(self, message: dict[str, Any]) -> None:
+            op = message.get("op")
+            if op == "info":
+                write_message(self.wfile, server.info())
+            elif op == "cache_keys":
+                write_message(self.wfile, {"keys": server.cache_keys(message)})
+            elif op == "token_spans":
+                write_message(
+                    self.wfile, {"spans": server.token_spans(message["text"])}
+                )
+            elif op == "generate":
+                request = GenerationRequest(message)
+                server.requests.put(request)
+                while True:
+                    output = request.outputs.get()
+                    write_message(self.wfile, output)
+                    if "index" not in output:
+                        break
+            else:
+                raise ValueError(f"unknown op {op!r}")
+
+    return ModelServerHandler
+
+
+class ModelServerBackend(Backend):
+    # The transformers backend of a model server started with
+    # `python -m src.model_server`, which keeps the model loaded between runs
+    kind = "transformers"
+
+    def __init__(self, path: str, info: dict[str, Any]) -> None:
+        self.path = path
+        self.model_name = info["model"]
+        self.quantize = info["quantize"]
+        self.generation_kwargs = info["generation"]
+        self.connections = queue.LifoQueue()
+
+    @staticmethod
+    def connect(path: str) -> BinaryIO:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        # The file keeps the socket open until it is closed itself
+        file = sock.makefile("rwb")
+        sock.close()
+        return file
+
+    @contextmanager
+    def connection(self) -> Iterator[BinaryIO]:
+        try:
+            file = self.connections.get_nowait()
+        except queue.Empty:
+            file = self.connect(self.path)
+        try:
+            yield file
+        except BaseException:
+            # A reply may still be in flight
+            file.close()
+            raise
+        self.connections.put(file)
+
+    def call(self, message: dict[str, Any]) -> dict[str, Any]:
+        with self.connection() as file:
+            write_message(file, message)
+            return read_message(file)
+
+    def generate(
+        self,
+        prompts: list[str],
+        batch_size: int = 1,
+        enable_thinking: bool = False,
+        desc: str | None = None,
+        done: int = 0,
+        prefix_cache: Any = None,
+        response_cache: ResponseCache | None = None,
+        on_output: Callable[[int, str], None] | None = None,
+        guard: "GenerationGuard | None" = None,
+        telemetry: Telemetry | None = None,
+        tags: list[dict[str, Any]] | None = None,
+    ) -> list[str]:
+        def cache_keys() -> list[str]:
+            return self.call(
+                {
+                    "op": "cache_keys",
+                    "prompts": prompts,
+                    "enable_thinking": enable_thinking,
+                    "guard": guard_kwargs(guard),
+                }
+            )["keys"]
+
+        def run_uncached(
+            pending: list[int], save_output: Callable[[int, str, dict[str, Any]], None]
+        ) -> None:
+            with self.connection() as file:
+                write_message(
+                    file,
+                    {
+                        "op": "generate",
+                        "prompts": [prompts[i] for i in pending],
+                        "enable_thinking": enable_thinking,
+                        "batch_size": batch_size,
+                        "guard": guard_kwargs(guard),
+                        "telemetry": telemetry is not None,
+                    },
+                )
+                while "done" not in (message := read_message(file)):
+                    if guard is not None:
+                        guard_stats = message["guard_stats"]
+                        for reason, num_tokens in guard_stats["early_stops"]:
+                            guard.record(reason, num_tokens)
+                        guard.grammar_stats.update(guard_stats["grammar_stats"])
+                    save_output(
+                        pending[message["index"]],
+                        message["content"],
+                        message["stats"],
+                    )
+
+        return generate_with_cache(
+            len(prompts),
+            cache_keys,
+            run_uncached,
+            desc=desc,
+            done=done,
+            response_cache=response_cache,
+            on_output=on_output,
+            telemetry=telemetry,
+            tags=tags,
+        )
+
+    def token_spans(self, text: str) -> list[tuple[int, int]]:
+        return [
+            tuple(span)
+            for span in self.call({"op": "token_spans", "text": text})["spans"]
+        ]
+
+
+def connect_model_server(args: argparse.Namespace) -> ModelServerBackend | None:
+    # None when the run should load the model itself
+    if args.no_model_server or not os.path.exists(args.model_server):
+        return None
+    # These need the model in the same process
+    for option in ("prefix_cache", "joint", "compare_constrained"):
+        if getattr(args, option, False):
+            print(f"--{option} loads the model in process")
+            return None
+    try:
+        file = ModelServerBackend.connect(args.model_server)
+    except OSError:
+        # A socket left behind by a server that is gone
+        return None
+    with file:
+        write_message(file, {"op": "info"})
+        info = read_message(file)
+    wanted = {
+        "model": args.model,
+        "quantize": None if args.quantize == "none" else args.quantize,
+        "draft_model": args.draft_model,
+        "scheduler": args.scheduler,
+        "device": args.device,
+        "generation": (
+            GENERATION_KWARGS
+            if args.max_new_tokens is None
+            else {**GENERATION_KWARGS, "max_new_tokens": args.max_new_tokens}
+        ),
+    }
+    # Batch size and guard settings, --constrained included, are sent with
+    # every generate request
+    mismatch = [name for name, value in wanted.items() if info.get(name) != value]
+    if mismatch:
+        print(
+            f"The model server at {args.model_server} differs in "
+            f"{', '.join(mismatch)}, loading {args.model} in process"
+        )
+        return None
+    print(f"Using the model server at {args.model_server} (pid {info['pid']})")
+    return ModelServerBackend(args.model_server, info)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="keep a transformers model loaded and serve the generate "
+        "calls of the TaskA scripts over a Unix socket"
+    )
+    parser.add_argument(
+        "--model",
+        "-m",
+        default="Qwen/Qwen3-8B",
+        help="model name or path",
+    )
+    parser.add_argument(
+        "--socket",
+        default="output/model_server.sock",
+        help="path of the Unix socket, the scripts' --model_server",
+    )
+    parser.add_argument(
+        "--batch_window",
+        type=float,
+        default=0.05,
+        help="seconds to wait for other clients before a generate call, whose "
+        "prompts are then generated together",
+    )
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=GENERATION_KWARGS["max_new_tokens"],
+        help="generation cap, which the clients must share",
+    )
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default="static")
+    parser.add_argument("--draft_model", default=None)
+    add_device_arguments(parser)
+    args = parser.parse_args()
+    if args.quantize != "none" and args.device != "cpu":
+        parser.error("--quantize needs --device cpu")
+    if args.draft_model is not None and args.scheduler != "static":
+        parser.error("--draft_model needs --scheduler static")
+
+    if os.path.exists(args.socket):
+        try:
+            ModelServerBackend.connect(args.socket).close()
+        except OSError:
+            os.remove(args.socket)
+        else:
+            parser.error(f"a model server is already listening on {args.socket}")
+    os.makedirs(os.path.dirname(args.socket) or ".", exist_ok=True)
+
+    set_threads(args.threads, args.interop_threads)
+    start_time = time.perf_counter()
+    backend = TransformersBackend(
+        args.model,
+        scheduler=args.scheduler,
+        device=args.device,
+        quantize=args.quantize,
+        quantized_dir=args.quantized_dir,
+        draft_model=args.draft_model,
+        max_new_tokens=args.max_new_tokens,
+    )
+    model_server = ModelServer(backend, args.batch_window)
+    threading.Thread(target=model_server.serve_generation, daemon=True).start()
+
+    server = socketserver.ThreadingUnixStreamServer(
+        args.socket, make_handler(model_server)
+    )
+    server.daemon_threads = True
+    # Removes the socket when stopped with kill as well as with Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print(
+        f"Loaded {args.model} in {time.perf_counter() - start_time:.1f}s, "
+        f"serving on {args.socket}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
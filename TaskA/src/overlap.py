@@ -0,0 +1,222 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+
+from .cache import ResponseCache
+from .stopping import GenerationGuard
+from .telemetry import GenerationTimer, Telemetry, count_new_tokens
+from .utils import (
+    GENERATION_KWARGS,
+    THINK_END_TOKEN_ID,
+    decode_response,
+    end_token_ids,
+    generate_with_cache,
+    prepare_batch_inputs,
+    render_chat,
+    response_cache_key,
+)
+
+STAGES = ("prepare", "generate", "postprocess")
+
+
+class StageStats:
+    # Busy seconds of each stage and the time generation spent waiting on the
+    # others, summed over all calls of a run
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.busy = dict.fromkeys(STAGES, 0.0)
+        self.workers = dict.fromkeys(STAGES, 1)
+        self.waited = {"inputs": 0.0, "postprocess": 0.0}
+        self.seconds = 0.0
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.busy[stage] += seconds
+
+    def report(self) -> str:
+        if not self.seconds:
+            return "No overlapped generation"
+        utilization = ", ".join(
+            f"{stage} {self.busy[stage] / (self.seconds * self.workers[stage]):.0%}"
+            + (f" of {self.workers[stage]} workers" if self.workers[stage] > 1 else "")
+            for stage in STAGES
+        )
+        return (
+            f"Stage utilization over {self.seconds:.1f}s: {utilization}\n"
+            f"Generation waited {self.waited['inputs']:.1f}s for inputs and "
+            f"{self.waited['postprocess']:.1f}s for postprocessing"
+        )
+
+
+def qwen_gen_overlapped(
+    prompts: list[str],
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    batch_size: int = 8,
+    enable_thinking: bool = False,
+    desc: str | None = None,
+    done: int = 0,
+    prefix_cache: tuple[str, list[int], DynamicCache] | None = None,
+    response_cache: ResponseCache | None = None,
+    on_output: Callable[[int, str], None] | None = None,
+    guard: GenerationGuard | None = None,
+    telemetry: Telemetry | None = None,
+    tags: list[dict[str, Any]] | None = None,
+    prefetch: int = 2,
+    workers: int = 2,
+    stats: StageStats | None = None,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> list[str]:
+    # qwen_gen_batch as three stages, so the model does not sit idle during
+    # CPU work. One pool renders and tokenizes the next `prefetch` batches,
+    # this thread only calls generate(), and a second pool decodes outputs and
+    # runs on_output. At most `prefetch` batches wait in either queue, so a
+    # slow stage holds back the stage feeding it
+    if stats is None:
+        stats = StageStats()
+    if generation_kwargs is None:
+        generation_kwargs = GENERATION_KWARGS
+    stats.workers.update(prepare=workers, postprocess=workers)
+    start_time = time.perf_counter()
+
+    # Chat texts are only rendered up front for cache keys, otherwise by the
+    # prepare stage
+    texts = [None] * len(prompts)
+
+    def cache_keys() -> list[str]:
+        texts[:] = [
+            render_chat(tokenizer, prompt, enable_thinking) for prompt in prompts
+        ]
+        return [
+            response_cache_key(model, text, enable_thinking, guard, generation_kwargs)
+            for text in texts
+        ]
+
+    # The fast tokenizer is not safe to encode and decode from several threads
+    tokenizer_lock = threading.Lock()
+    stop_token_ids = end_token_ids(model)
+
+    def prepare(batch: list[int]) -> tuple[dict[str, Any], dict[str, Any]]:
+        stage_start = time.perf_counter()
+        batch_texts = [
+            texts[i] or render_chat(tokenizer, prompts[i], enable_thinking)
+            for i in batch
+        ]
+        batch_kwargs = dict(generation_kwargs)
+        with tokenizer_lock:
+            model_inputs = prepare_batch_inputs(
+                batch_texts, tokenizer, model, prefix_cache
+            )
+            if guard is not None:
+                batch_kwargs.update(
+                    guard.generate_kwargs(
+                        model_inputs,
+                        tokenizer,
+                        model,
+                        enable_thinking,
+                        generation_kwargs["max_new_tokens"],
+                        batch,
+                    )
+                )
+        stats.add("prepare", time.perf_counter() - stage_start)
+        return model_inputs, batch_kwargs
+
+    def postprocess(
+        batch: list[int],
+        generated_ids: torch.LongTensor,
+        model_inputs: dict[str, Any],
+        batch_id: str | None,
+        timings: dict[str, float],
+        save_output: Callable[[int, str, dict[str, Any]], None],
+    ) -> None:
+        stage_start = time.perf_counter()
+        input_length = model_inputs["input_ids"].shape[1]
+        prompt_lengths = model_inputs["attention_mask"].sum(dim=1).tolist()
+        for row, i in enumerate(batch):
+            output_ids = generated_ids[row][input_length:].tolist()
+            with tokenizer_lock:
+                content = decode_response(tokenizer, output_ids)
+            output_stats = count_new_tokens(
+                output_ids, stop_token_ids, THINK_END_TOKEN_ID
+            )
+            if telemetry is not None:
+                output_stats = {
+                    "batch": batch_id,
+                    "batch_size": len(batch),
+                    "prompt_tokens": prompt_lengths[row],
+                    **output_stats,
+                    **timings,
+                }
+            # Saved one at a time, as they would be on a single thread
+            save_output(i, content, output_stats)
+        stats.add("postprocess", time.perf_counter() - stage_start)
+
+    def run_uncached(
+        pending: list[int], save_output: Callable[[int, str, dict[str, Any]], None]
+    ) -> None:
+        # Longest first like qwen_gen_batch, by characters so that nothing is
+        # tokenized before its batch is prepared
+        order = sorted(pending, key=lambda i: len(prompts[i]), reverse=True)
+        batches = [
+            order[start : start + batch_size]
+            for start in range(0, len(order), batch_size)
+        ]
+        with ThreadPoolExecutor(workers) as prepare_pool, ThreadPoolExecutor(
+            workers
+        ) as postprocess_pool:
+            prepared = deque(
+                prepare_pool.submit(prepare, batch) for batch in batches[:prefetch]
+            )
+            postprocessing = deque()
+            for index in range(len(batches)):
+                wait_start = time.perf_counter()
+                model_inputs, batch_kwargs = prepared.popleft().result()
+                stats.waited["inputs"] += time.perf_counter() - wait_start
+                if index + prefetch < len(batches):
+                    prepared.append(
+                        prepare_pool.submit(prepare, batches[index + prefetch])
+                    )
+
+                timer = GenerationTimer() if telemetry is not None else None
+                generate_start = time.perf_counter()
+                generated_ids = model.generate(
+                    **model_inputs, **batch_kwargs, streamer=timer
+                )
+                stats.add("generate", time.perf_counter() - generate_start)
+
+                if len(postprocessing) >= prefetch:
+                    wait_start = time.perf_counter()
+                    postprocessing.popleft().result()
+                    stats.waited["postprocess"] += time.perf_counter() - wait_start
+                postprocessing.append(
+                    postprocess_pool.submit(
+                        postprocess,
+                        batches[index],
+                        generated_ids,
+                        model_inputs,
+                        telemetry.next_batch() if telemetry is not None else None,
+                        timer.timings() if timer is not None else {},
+                        save_output,
+                    )
+                )
+            for future in postprocessing:
+                future.result()
+
+    contents = generate_with_cache(
+        len(prompts),
+        cache_keys,
+        run_uncached,
+        desc=desc,
+        done=done,
+        response_cache=response_cache,
+        on_output=on_output,
+        telemetry=telemetry,
+        tags=tags,
+    )
+    stats.seconds += time.perf_counter() - start_time
+    return contents
@@ -0,0 +1,55 @@
+import json
+import os
+import time
+
+from .utils import (
+    ec_prompt_1_postprocess,
+    ec_prompt_2_postprocess,
+    ee_postprocess,
+    write_lines,
+)
+
+SUBSETS = ("engineering", "scholarly")
+
+
+def saved_responses(task: str, subset_dir: str) -> str | None:
+    # Extraction saves contents.json. Classification saves
+    # classification_responses.json with EC Prompt 1 and contents.json with
+    # EC Prompt 2, the newer one wins if a directory has both
+    names = ["contents.json"]
+    if task == "ec":
+        names.append("classification_responses.json")
+    paths = [
+        os.path.join(subset_dir, name)
+        for name in names
+        if os.path.exists(os.path.join(subset_dir, name))
+    ]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def rebuild_outputs(task: str, output_dir: str) -> None:
+    # terms.txt and types.txt from the responses of an earlier run, without
+    # loading a model
+    for subset in SUBSETS:
+        start_time = time.perf_counter()
+        subset_dir = os.path.join(output_dir, subset)
+        path = saved_responses(task, subset_dir)
+        if path is None:
+            print(f"No saved responses in {subset_dir}")
+            continue
+        with open(path) as f:
+            responses = json.load(f)
+
+        if task == "ee":
+            extracted_terms = extracted_types = ee_postprocess(responses)
+        elif path.endswith("classification_responses.json"):
+            extracted_terms, extracted_types = ec_prompt_1_postprocess(responses)
+        else:
+            extracted_terms, extracted_types = ec_prompt_2_postprocess(responses)
+        write_lines(os.path.join(subset_dir, "terms.txt"), extracted_terms)
+        write_lines(os.path.join(subset_dir, "types.txt"), extracted_types)
+        print(
+            f"Rebuilt {subset} from {os.path.basename(path)}: "
+            f"{len(extracted_terms)} terms, {len(extracted_types)} types "
+            f"({time.perf_counter() - start_time:.2f}s)"
+        )
@@ -1,3 +1,7 @@
+# Marks where the document-specific part of a few-shot prompt begins
+prefix_boundary = "######################\n-Real Data-"
+
+
 entity_extraction_prompt = '''\
 You are assisting in the construction of a domain-specific ontology by extracting meaningful entities from text.
 Each entity should represent a concept relevant to the domain, including both general categories (e.g., "Bean") and specific subtypes (e.g., "Bean (Dried)").
@@ -240,4 +244,18 @@ Input
 #### List of Entities
 {entities}
 ######################
-Output:'''
\ No newline at end of file
+Output:'''
+
+# Replaces the Real Data section of EC Prompt 2 when classification is the
+# second turn of the extraction conversation, which already holds the document
+plain_classification_joint_real_data = '''\
+######################
+-Real Data-
+######################
+Input
+#### Title and Text
+The document of the previous message.
+#### List of Entities
+{entities}
+######################
+Output:'''
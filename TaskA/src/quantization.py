@@ -0,0 +1,143 @@
+import argparse
+import os
+import re
+import warnings
+from typing import TYPE_CHECKING
+
+# torch is imported where a model is loaded, so the CLIs start without it
+if TYPE_CHECKING:
+    import torch
+    from transformers import PreTrainedModel
+
+DEVICES = ("auto", "cpu")
+QUANTIZATIONS = ("none", "int8")
+
+
+def add_device_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--device",
+        choices=DEVICES,
+        default="auto",
+        help="with the transformers backend, place the model with accelerate's "
+        "device map, or load it on the CPU in float32",
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=QUANTIZATIONS,
+        default="none",
+        help="with --device cpu, quantize the linear layers to int8 with dynamic "
+        "activation scales",
+    )
+    parser.add_argument(
+        "--quantized_dir",
+        default="output/quantized",
+        help="path where quantized weights are saved once and reloaded",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch intra-op threads, e.g. the physical cores of the node",
+    )
+    parser.add_argument(
+        "--interop_threads",
+        type=int,
+        default=None,
+        help="torch inter-op threads",
+    )
+
+
+def set_threads(threads: int | None, interop_threads: int | None) -> None:
+    if not threads and not interop_threads:
+        return
+    import torch
+
+    # Inter-op threads can only be set before torch runs any parallel work
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def quantize_int8(model: "PreTrainedModel") -> "PreTrainedModel":
+    import torch
+
+    # Only the decoder layers: lm_head shares its weights with the embeddings
+    # and the output logits are the most sensitive to rounding. One scale per
+    # output channel keeps greedy outputs closer to float32 than one per layer
+    with warnings.catch_warnings():
+        # torch deprecates eager quantization in favour of torchao
+        warnings.simplefilter("ignore")
+        torch.ao.quantization.quantize_dynamic(
+            model.model,
+            {torch.nn.Linear: torch.ao.quantization.per_channel_dynamic_qconfig},
+            inplace=True,
+        )
+    model.quantization = "int8"
+    return model
+
+
+def empty_int8_linears(module: "torch.nn.Module") -> None:
+    import torch
+
+    # Same modules as quantize_int8 produces, without quantizing the weights.
+    # Packing the weights for the int8 kernels is most of the load time, so
+    # they start as 1x1 placeholders and are only packed once, when loaded
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear):
+            linear = torch.ao.nn.quantized.dynamic.Linear(
+                1, 1, bias_=child.bias is not None, dtype=torch.qint8
+            )
+            linear.in_features = child.in_features
+            linear.out_features = child.out_features
+            setattr(module, name, linear)
+        else:
+            empty_int8_linears(child)
+
+
+def quantized_path(model_name: str, quantized_dir: str) -> str:
+    name = re.sub(r"[^\w.-]+", "--", model_name.strip("/"))
+    return os.path.join(quantized_dir, f"{name}-int8.pt")
+
+
+def load_cpu_model(
+    model_name: str, quantize: str = "none", quantized_dir: str = "output/quantized"
+) -> "PreTrainedModel":
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+    from transformers.modeling_utils import no_init_weights
+
+    # float32, which the CPU kernels are fastest at and int8 quantizes from
+    if quantize == "none":
+        return AutoModelForCausalLM.from_pretrained(
+            model_name, torch_dtype=torch.float32
+        )
+
+    path = quantized_path(model_name, quantized_dir)
+    if not os.path.exists(path):
+        model = quantize_int8(
+            AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        )
+        os.makedirs(quantized_dir, exist_ok=True)
+        torch.save(model.state_dict(), path + ".tmp")
+        os.replace(path + ".tmp", path)
+        print(f"Saved int8 weights to {path}")
+        return model
+
+    # Build the quantized module tree without initializing any weights, then
+    # fill it from the saved state dict
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(
+            AutoConfig.from_pretrained(model_name), torch_dtype=torch.float32
+        )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        empty_int8_linears(model.model)
+        model.load_state_dict(torch.load(path, weights_only=True))
+    model.quantization = "int8"
+    model.tie_weights()
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_name)
+    except OSError:
+        pass
+    return model.eval()
@@ -0,0 +1,494 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterable
+
+from .utils import (
+    ec_prompt_1_parse_response,
+    ec_prompt_1_postprocess,
+    ec_prompt_2_postprocess,
+    ee_postprocess,
+    entity_columns,
+    write_lines,
+)
+
+if TYPE_CHECKING:
+    from .backends import Backend
+
+TASKS = ("ee", "ec")
+# Bits of labels.labels
+TERM, TYPE = 1, 2
+LABEL_NAMES = {TERM: "term", TYPE: "type", TERM | TYPE: "term+type"}
+
+# (key, entity, entity_type, description, classification), where the key is
+# the document id, or the checkpoint key of the EC Prompt 1 entity lines
+EntityRow = tuple[str | None, str, str | None, str | None, str | None]
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS runs ("
+    "run_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, variant TEXT, "
+    "model TEXT, backend TEXT, created REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS responses ("
+    "run_id INTEGER NOT NULL, task TEXT NOT NULL, subset TEXT NOT NULL, "
+    "key TEXT NOT NULL, response TEXT NOT NULL, "
+    "PRIMARY KEY (run_id, task, subset, key))",
+    "CREATE TABLE IF NOT EXISTS entities ("
+    "run_id INTEGER NOT NULL, task TEXT NOT NULL, subset TEXT NOT NULL, "
+    "key TEXT, entity TEXT NOT NULL, entity_type TEXT, description TEXT, "
+    "classification TEXT)",
+    "CREATE INDEX IF NOT EXISTS entities_run ON entities (run_id, task, subset)",
+    "CREATE INDEX IF NOT EXISTS entities_entity ON entities (entity)",
+    "CREATE INDEX IF NOT EXISTS entities_key ON entities (key)",
+    # The terms.txt and types.txt of a run, one row per entity with its
+    # position in either file
+    "CREATE TABLE IF NOT EXISTS labels ("
+    "run_id INTEGER NOT NULL, task TEXT NOT NULL, subset TEXT NOT NULL, "
+    "entity TEXT NOT NULL, labels INTEGER NOT NULL, term_position INTEGER, "
+    "type_position INTEGER, PRIMARY KEY (run_id, task, subset, entity)) "
+    "WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS labels_entity ON labels (entity)",
+)
+
+
+def ee_entity_rows(contents: dict[str, str]) -> list[EntityRow]:
+    columns = entity_columns(contents)
+    return [
+        (doc_id, name.lower(), entity_type, description, None)
+        for doc_id, name, entity_type, description in zip(
+            columns["doc_id"], columns["name"], columns["type"], columns["description"]
+        )
+    ]
+
+
+def ec_prompt_1_entity_rows(responses: dict[str, str]) -> list[EntityRow]:
+    # Keys are "position:entity lines", see ec_prompt_1_pack
+    rows = []
+    for key, response in responses.items():
+        line = key.split(":", 1)[-1]
+        for ent_dict in ec_prompt_1_parse_response(line, response) or []:
+            try:
+                entity, classification = ent_dict["entity"], ent_dict["classification"]
+            except:
+                continue
+            if classification in ("term", "type"):
+                rows.append((key, entity, None, None, classification))
+    return rows
+
+
+def ec_prompt_2_entity_rows(contents: dict[str, str]) -> list[EntityRow]:
+    # The lines ec_prompt_2_postprocess accepts
+    rows = []
+    for doc_id, content in contents.items():
+        for line in content.splitlines():
+            fields = line.strip().split("|||")
+            if len(fields) == 2 and fields[1].lower() in ("term", "type"):
+                rows.append((doc_id, fields[0].lower(), None, None, fields[1].lower()))
+    return rows
+
+
+class ResultsStore:
+    # Responses, parsed entities and terms/types of many runs in one sqlite
+    # file, so runs are compared with indexed queries instead of JSON diffs
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        # Shards of a run write to the same file from several processes
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        # Stores created before runs recorded the backend
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(runs)")}
+        if "backend" not in columns:
+            self.conn.execute("ALTER TABLE runs ADD COLUMN backend TEXT")
+        self.conn.commit()
+        self.pending = []
+
+    def start_run(
+        self,
+        name: str,
+        variant: str | None = None,
+        model: str | None = None,
+        backend: str | None = None,
+    ) -> int:
+        # Reruns under the same name replace the subsets they save. A merge
+        # loads no backend and keeps the model its shards recorded
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO runs (name, variant, model, backend, created) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET variant = excluded.variant, "
+                "model = COALESCE(excluded.model, runs.model), "
+                "backend = COALESCE(excluded.backend, runs.backend), "
+                "created = excluded.created",
+                (name, variant, model, backend, time.time()),
+            )
+            self.conn.commit()
+        return self.run_id(name)
+
+    def run_id(self, name: str) -> int:
+        row = self.conn.execute(
+            "SELECT run_id FROM runs WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"no run named {name!r} in {self.path}")
+        return row[0]
+
+    def add_response(
+        self, run_id: int, task: str, subset: str, key: str, response: str
+    ) -> None:
+        # Buffered during generation and written in bulk
+        with self.lock:
+            self.pending.append((run_id, task, subset, key, response))
+            if len(self.pending) >= 256:
+                self._flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self.pending:
+            return
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", self.pending
+        )
+        self.conn.commit()
+        self.pending = []
+
+    def save_subset(
+        self,
+        run_id: int,
+        task: str,
+        subset: str,
+        responses: dict[str, str],
+        rows: Iterable[EntityRow],
+        terms: list[str],
+        types: list[str],
+    ) -> None:
+        # Replaces what the run saved or streamed for the subset before
+        labels = {}
+        for position, entity in enumerate(terms):
+            labels[entity] = [TERM, position, None]
+        for position, entity in enumerate(types):
+            label = labels.setdefault(entity, [0, None, None])
+            label[0] |= TYPE
+            label[2] = position
+        where = (run_id, task, subset)
+        with self.lock:
+            self._flush()
+            with self.conn:
+                for table in ("responses", "entities", "labels"):
+                    self.conn.execute(
+                        f"DELETE FROM {table} WHERE run_id = ? AND task = ? "
+                        "AND subset = ?",
+                        where,
+                    )
+                self.conn.executemany(
+                    "INSERT INTO responses VALUES (?, ?, ?, ?, ?)",
+                    ((*where, key, response) for key, response in responses.items()),
+                )
+                self.conn.executemany(
+                    "INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((*where, *row) for row in rows),
+                )
+                self.conn.executemany(
+                    "INSERT INTO labels VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((*where, entity, *label) for entity, label in labels.items()),
+                )
+
+    def labels(
+        self, run_id: int, task: str, subset: str
+    ) -> tuple[list[str], list[str]]:
+        lists = []
+        for column in ("term_position", "type_position"):
+            lists.append(
+                [
+                    entity
+                    for (entity,) in self.conn.execute(
+                        f"SELECT entity FROM labels WHERE run_id = ? AND task = ? "
+                        f"AND subset = ? AND {column} IS NOT NULL ORDER BY {column}",
+                        (run_id, task, subset),
+                    )
+                ]
+            )
+        return lists[0], lists[1]
+
+    def export(self, run_id: int, task: str, subset: str, output_dir: str) -> None:
+        # terms.txt and types.txt are written from the store
+        terms, types = self.labels(run_id, task, subset)
+        os.makedirs(output_dir, exist_ok=True)
+        write_lines(os.path.join(output_dir, "terms.txt"), terms)
+        write_lines(os.path.join(output_dir, "types.txt"), types)
+
+    def diff(
+        self, run_a: int, run_b: int, task: str = "ec"
+    ) -> list[tuple[str, str, int, int]]:
+        # Entities of both runs with different labels, as (subset, entity,
+        # labels in a, labels in b)
+        return self.conn.execute(
+            "SELECT a.subset, a.entity, a.labels, b.labels FROM labels AS a "
+            "JOIN labels AS b ON b.run_id = ? AND b.task = a.task "
+            "AND b.subset = a.subset AND b.entity = a.entity "
+            "WHERE a.run_id = ? AND a.task = ? AND a.labels != b.labels "
+            "ORDER BY a.subset, a.entity",
+            (run_b, run_a, task),
+        ).fetchall()
+
+    def only_in(
+        self, run_a: int, run_b: int, task: str = "ec"
+    ) -> list[tuple[str, str]]:
+        # Entities of run a that run b does not have
+        return self.conn.execute(
+            "SELECT a.subset, a.entity FROM labels AS a WHERE a.run_id = ? "
+            "AND a.task = ? AND NOT EXISTS (SELECT 1 FROM labels AS b "
+            "WHERE b.run_id = ? AND b.task = a.task AND b.subset = a.subset "
+            "AND b.entity = a.entity) ORDER BY a.subset, a.entity",
+            (run_a, task, run_b),
+        ).fetchall()
+
+    def entity_labels(self, entity: str) -> list[tuple[str, str, str, int]]:
+        return self.conn.execute(
+            "SELECT runs.name, labels.task, labels.subset, labels.labels "
+            "FROM labels JOIN runs USING (run_id) WHERE labels.entity = ? "
+            "ORDER BY runs.name, labels.task, labels.subset",
+            (entity,),
+        ).fetchall()
+
+    def doc_entities(self, key: str) -> list[tuple[str, str, str, str | None]]:
+        return self.conn.execute(
+            "SELECT runs.name, entities.task, entities.entity, "
+            "COALESCE(entities.classification, entities.entity_type) "
+            "FROM entities JOIN runs USING (run_id) WHERE entities.key = ? "
+            "ORDER BY runs.name, entities.task, entities.rowid",
+            (key,),
+        ).fetchall()
+
+    def runs(self) -> list[tuple[Any, ...]]:
+        return self.conn.execute(
+            "SELECT runs.name, runs.variant, runs.backend, runs.model, "
+            "(SELECT COUNT(*) FROM responses WHERE responses.run_id = runs.run_id), "
+            "(SELECT COUNT(*) FROM labels WHERE labels.run_id = runs.run_id) "
+            "FROM runs ORDER BY runs.created"
+        ).fetchall()
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+
+class RunResults:
+    # The store as one script run writes to it
+    def __init__(self, store: ResultsStore, run_id: int, task: str) -> None:
+        self.store = store
+        self.run_id = run_id
+        self.task = task
+
+    def add_response(self, subset: str, key: str, response: str) -> None:
+        self.store.add_response(self.run_id, self.task, subset, key, response)
+
+    def save_subset(
+        self,
+        subset: str,
+        output_dir: str | None,
+        responses: dict[str, str],
+        rows: Iterable[EntityRow],
+        terms: list[str],
+        types: list[str],
+    ) -> None:
+        self.store.save_subset(
+            self.run_id, self.task, subset, responses, rows, terms, types
+        )
+        if output_dir is not None:
+            self.store.export(self.run_id, self.task, subset, output_dir)
+
+
+def add_results_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--results_db",
+        default=None,
+        help="also save responses, parsed entities and terms/types to this "
+        "sqlite results store, from which terms.txt and types.txt are exported",
+    )
+    parser.add_argument(
+        "--run_name",
+        default=None,
+        help="name of the run in the results store, by default the name of "
+        "--output_dir; a rerun under the same name replaces it",
+    )
+
+
+def load_results(
+    args: argparse.Namespace, task: str, variant: str, backend: "Backend | None"
+) -> RunResults | None:
+    # backend is None when a run only merges finished shards
+    if args.results_db is None:
+        return None
+    store = ResultsStore(args.results_db)
+    name = args.run_name or os.path.basename(os.path.normpath(args.output_dir))
+    run_id = store.start_run(
+        name,
+        variant=variant,
+        model=backend.model_name if backend is not None else None,
+        backend=backend.kind if backend is not None else None,
+    )
+    return RunResults(store, run_id, task)
+
+
+def write_outputs(
+    results: RunResults | None,
+    subset: str,
+    output_dir: str,
+    terms: list[str],
+    types: list[str],
+    saved: Callable[[], tuple[dict[str, str], list[EntityRow]]],
+) -> None:
+    # saved returns the responses and entity rows, only parsed for the store
+    if results is None:
+        write_lines(os.path.join(output_dir, "terms.txt"), terms)
+        write_lines(os.path.join(output_dir, "types.txt"), types)
+    else:
+        results.save_subset(subset, output_dir, *saved(), terms, types)
+
+
+def import_outputs(
+    store: ResultsStore, task: str, output_dir: str, name: str, variant: str | None
+) -> None:
+    # Runs written before the store, from their saved responses
+    from .postprocess import SUBSETS, saved_responses
+
+    run_id = store.start_run(name, variant=variant)
+    for subset in SUBSETS:
+        subset_dir = os.path.join(output_dir, subset)
+        path = saved_responses(task, subset_dir)
+        if path is None:
+            print(f"No saved responses in {subset_dir}")
+            continue
+        with open(path) as f:
+            saved = json.load(f)
+        if task == "ee":
+            terms = types = ee_postprocess(saved)
+            responses, rows = saved, ee_entity_rows(saved)
+        elif path.endswith("classification_responses.json"):
+            # Only the parsed classifications are saved, without their responses
+            terms, types = ec_prompt_1_postprocess(saved)
+            responses = {}
+            rows = [
+                (None, ent_dict["entity"], None, None, ent_dict["classification"])
+                for ent_dict in saved
+                if isinstance(ent_dict, dict)
+                and ent_dict.get("classification") in ("term", "type")
+                and "entity" in ent_dict
+            ]
+        else:
+            terms, types = ec_prompt_2_postprocess(saved)
+            responses, rows = saved, ec_prompt_2_entity_rows(saved)
+        store.save_subset(run_id, task, subset, responses, rows, terms, types)
+        print(
+            f"Imported {subset} from {os.path.basename(path)}: {len(responses)} "
+            f"responses, {len(rows)} entity rows, {len(terms)} terms, "
+            f"{len(types)} types"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="query and export the runs in a results store"
+    )
+    parser.add_argument(
+        "--results_db",
+        default="output/results.sqlite",
+        help="path to the sqlite results store",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("runs", help="list the runs")
+    diff_parser = subparsers.add_parser(
+        "diff", help="entities classified differently by two runs"
+    )
+    diff_parser.add_argument("run_a")
+    diff_parser.add_argument("run_b")
+    diff_parser.add_argument("--task", choices=TASKS, default="ec")
+    entity_parser = subparsers.add_parser(
+        "entity", help="the labels of an entity in every run"
+    )
+    entity_parser.add_argument("entity")
+    doc_parser = subparsers.add_parser(
+        "doc", help="the entities of a document in every run"
+    )
+    doc_parser.add_argument("doc_id")
+    export_parser = subparsers.add_parser(
+        "export", help="write terms.txt and types.txt of a run"
+    )
+    export_parser.add_argument("run")
+    export_parser.add_argument("--task", choices=TASKS, default="ec")
+    export_parser.add_argument("--output_dir", "-o", required=True)
+    import_parser = subparsers.add_parser(
+        "import", help="add a run from the output directory of an earlier run"
+    )
+    import_parser.add_argument("task", choices=TASKS)
+    import_parser.add_argument("output_dir")
+    import_parser.add_argument("--run_name", default=None)
+    import_parser.add_argument("--variant", default=None)
+    args = parser.parse_args()
+
+    store = ResultsStore(args.results_db)
+    start_time = time.perf_counter()
+    if args.command == "runs":
+        print(
+            f"{'run':<32} {'variant':<10} {'responses':>10} {'entities':>10}  "
+            f"{'backend':<12} model"
+        )
+        for name, variant, backend, model, responses, labels in store.runs():
+            print(
+                f"{name:<32} {variant or '-':<10} {responses:>10} {labels:>10}  "
+                f"{backend or '-':<12} {model or '-'}"
+            )
+    elif args.command == "diff":
+        try:
+            run_a, run_b = store.run_id(args.run_a), store.run_id(args.run_b)
+        except KeyError as error:
+            sys.exit(error.args[0])
+        rows = store.diff(run_a, run_b, args.task)
+        for subset, entity, labels_a, labels_b in rows:
+            print(
+                f"{subset}\t{entity}\t{LABEL_NAMES[labels_a]}\t{LABEL_NAMES[labels_b]}"
+            )
+        only_a = store.only_in(run_a, run_b, args.task)
+        only_b = store.only_in(run_b, run_a, args.task)
+        print(
+            f"{len(rows)} entities labelled differently, {len(only_a)} only in "
+            f"{args.run_a}, {len(only_b)} only in {args.run_b} "
+            f"({(time.perf_counter() - start_time) * 1000:.1f} ms)"
+        )
+    elif args.command == "entity":
+        for name, task, subset, labels in store.entity_labels(args.entity):
+            print(f"{name}\t{task}\t{subset}\t{LABEL_NAMES[labels]}")
+    elif args.command == "doc":
+        for name, task, entity, label in store.doc_entities(args.doc_id):
+            print(f"{name}\t{task}\t{entity}\t{label or '-'}")
+    elif args.command == "export":
+        from .postprocess import SUBSETS
+
+        try:
+            run_id = store.run_id(args.run)
+        except KeyError as error:
+            sys.exit(error.args[0])
+        for subset in SUBSETS:
+            store.export(
+                run_id, args.task, subset, os.path.join(args.output_dir, subset)
+            )
+        print(f"Exported {args.run} to {args.output_dir}")
+    elif args.command == "import":
+        name = args.run_name or os.path.basename(os.path.normpath(args.output_dir))
+        import_outputs(store, args.task, args.output_dir, name, args.variant)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
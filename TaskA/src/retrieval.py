@@ -0,0 +1,174 @@
+import argparse
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import TYPE_CHECKING, Callable
+
+from .prompts import (
+    entity_extraction_customized_example_string,
+    plain_classification_customized_example_string,
+)
+from .utils import ec_prompt_2_preprocess, ee_prompt_2_preprocess, load_train_docs
+
+if TYPE_CHECKING:
+    from .backends import Backend
+
+
+def add_retrieval_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--few_shot_k",
+        type=int,
+        default=0,
+        help="with Prompt 2, use the k examples most similar to each document "
+        "(BM25) instead of all of them",
+    )
+    parser.add_argument(
+        "--prompt_token_budget",
+        type=int,
+        default=0,
+        help="with Prompt 2, cap the tokens of the examples in each prompt, "
+        "dropping the least similar first",
+    )
+
+
+def bm25_tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(bm25_tokenize(text)) for text in texts]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if texts else 0.0
+        doc_freqs = Counter(term for counts in self.term_counts for term in counts)
+        self.idf = {
+            term: math.log(1 + (len(texts) - freq + 0.5) / (freq + 0.5))
+            for term, freq in doc_freqs.items()
+        }
+
+    def scores(self, query: str) -> list[float]:
+        query_terms = set(bm25_tokenize(query)) & self.idf.keys()
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+            scores.append(
+                sum(
+                    self.idf[term]
+                    * counts[term]
+                    * (self.k1 + 1)
+                    / (counts[term] + norm)
+                    for term in query_terms
+                    if term in counts
+                )
+            )
+        return scores
+
+    def rank(self, query: str) -> list[int]:
+        # Ties keep the order of the examples file, so selections are stable
+        scores = self.scores(query)
+        return sorted(range(len(scores)), key=lambda i: -scores[i])
+
+
+class FewShotSelector:
+    def __init__(
+        self,
+        task: str,
+        subset: str,
+        data_dir: str,
+        example_dir: str,
+        k: int,
+        token_budget: int,
+        count_tokens: Callable[[str], int],
+    ) -> None:
+        self.task = task
+        self.k = k
+        self.token_budget = token_budget
+        if task == "ee":
+            path = f"entity_extraction/{subset}/doc_examples.json"
+        else:
+            path = f"entity_classification/{subset}/example_doc_entities.json"
+        self.example_outputs = json.load(open(os.path.join(example_dir, path)))
+        self.example_docs = load_train_docs(data_dir, subset, self.example_outputs)
+        self.index = BM25Index(
+            [doc["title"] + "\n" + doc["text"] for doc in self.example_docs]
+        )
+        self.example_strings = [self.render([doc]) for doc in self.example_docs]
+        self.example_tokens = [count_tokens(text) for text in self.example_strings]
+        self.separator_tokens = count_tokens("\n\n")
+
+    def render(self, docs: list[dict[str, str]]) -> str:
+        if self.task == "ee":
+            return ee_prompt_2_preprocess(
+                entity_extraction_customized_example_string, self.example_outputs, docs
+            )
+        return ec_prompt_2_preprocess(
+            docs,
+            self.example_outputs,
+            plain_classification_customized_example_string,
+            {},
+        )[0]
+
+    def tokens(self, chosen: list[int]) -> int:
+        return sum(
+            self.example_tokens[i] for i in chosen
+        ) + self.separator_tokens * max(0, len(chosen) - 1)
+
+    def select(self, doc: dict[str, str]) -> list[int]:
+        # Most similar first, skipping examples that no longer fit the budget
+        chosen = []
+        for i in self.index.rank(doc["title"] + "\n" + doc["text"]):
+            if self.k and len(chosen) == self.k:
+                break
+            if self.token_budget and self.tokens(chosen + [i]) > self.token_budget:
+                continue
+            chosen.append(i)
+        return chosen
+
+    def examples_strings(
+        self, docs: list[dict[str, str]], log_path: str, resume: bool
+    ) -> list[str]:
+        # The chosen example ids are logged per document, so a run can be
+        # reproduced or compared against the fixed examples
+        selections = [self.select(doc) for doc in docs]
+        with open(log_path, "a" if resume else "w") as fout:
+            for doc, chosen in zip(docs, selections):
+                example_ids = [self.example_docs[i]["id"] for i in chosen]
+                fout.write(
+                    json.dumps({"key": doc["id"], "examples": example_ids}) + "\n"
+                )
+        if docs:
+            selected_tokens = sum(self.tokens(chosen) for chosen in selections)
+            print(
+                f"Few-shot examples: {selected_tokens / len(docs):.0f} tokens per "
+                f"prompt, {self.tokens(list(range(len(self.example_docs))))} with "
+                f"all {len(self.example_docs)} examples"
+            )
+        return [
+            "\n\n".join(self.example_strings[i] for i in chosen)
+            for chosen in selections
+        ]
+
+
+def few_shot_log_path(checkpoint_path: str) -> str:
+    directory, name = os.path.split(checkpoint_path)
+    return os.path.join(directory, name.replace("responses", "few_shot", 1))
+
+
+def load_selector(
+    args: argparse.Namespace, task: str, subset: str, backend: "Backend"
+) -> FewShotSelector | None:
+    if not (args.few_shot_k or args.prompt_token_budget):
+        return None
+    return FewShotSelector(
+        task,
+        subset,
+        args.data_dir,
+        args.example_dir,
+        args.few_shot_k,
+        args.prompt_token_budget,
+        lambda text: len(backend.token_spans(text)),
+    )
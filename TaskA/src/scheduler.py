@@ -0,0 +1,338 @@
+import time
+from collections import deque
+from typing import Any, Callable, Iterator
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    DynamicCache,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from .cache import ResponseCache
+from .stopping import GenerationGuard
+from .telemetry import Telemetry, count_new_tokens
+from .utils import (
+    GENERATION_KWARGS,
+    THINK_END_TOKEN_ID,
+    decode_response,
+    end_token_ids,
+    generate_with_cache,
+    render_chat,
+    response_cache_key,
+)
+
+
+class Request:
+    def __init__(self, index: int, input_ids: list[int], max_new_tokens: int) -> None:
+        self.index = index
+        self.input_ids = input_ids
+        self.output_ids = []
+        self.max_new_tokens = max_new_tokens
+        self.logits_processor = LogitsProcessorList()
+        self.stopping_criteria = StoppingCriteriaList()
+        self.sequence_ids = None
+        self.start_time = None
+        self.first_token_time = None
+        self.end_time = None
+
+    def allocate(self, device: torch.device) -> None:
+        # Prompt and output for the logits processors and stopping criteria,
+        # preallocated so that every new token is written in place
+        self.sequence_ids = torch.empty(
+            (1, len(self.input_ids) + self.max_new_tokens),
+            dtype=torch.long,
+            device=device,
+        )
+        self.sequence_ids[0, : len(self.input_ids)] = torch.tensor(self.input_ids)
+
+    def sequence(self) -> torch.LongTensor:
+        return self.sequence_ids[:, : len(self.input_ids) + len(self.output_ids)]
+
+    def timings(self) -> dict[str, float]:
+        return {
+            "prefill_seconds": round(self.first_token_time - self.start_time, 4),
+            "decode_seconds": round(self.end_time - self.first_token_time, 4),
+            "seconds": round(self.end_time - self.start_time, 4),
+        }
+
+
+class ContinuousBatchScheduler:
+    # Decodes up to max_batch_size requests together, one token per step. A
+    # request leaves the batch as soon as it ends and the next queued request
+    # is prefilled and joins, so short outputs never wait for long ones.
+    # The running batch shares one KV cache, left-padded to its longest row
+    def __init__(
+        self,
+        tokenizer: AutoTokenizer,
+        model: AutoModelForCausalLM,
+        max_batch_size: int = 8,
+        enable_thinking: bool = False,
+        guard: GenerationGuard | None = None,
+        max_new_tokens: int | None = None,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens or GENERATION_KWARGS["max_new_tokens"]
+        self.enable_thinking = enable_thinking
+        self.guard = guard
+        self.stop_token_ids = end_token_ids(model)
+
+        # The sampling settings generate() would read from the model
+        config = model.generation_config
+        self.do_sample = bool(config.do_sample)
+        self.suppress_tokens = list(config.suppress_tokens or [])
+        self.warpers = LogitsProcessorList()
+        if self.do_sample:
+            if config.temperature is not None and config.temperature != 1.0:
+                self.warpers.append(TemperatureLogitsWarper(config.temperature))
+            if config.top_k:
+                self.warpers.append(TopKLogitsWarper(config.top_k))
+            if config.top_p is not None and config.top_p < 1.0:
+                self.warpers.append(TopPLogitsWarper(config.top_p))
+
+        self.queue = deque()
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+
+    def submit(self, index: int, text: str) -> None:
+        self.queue.append(
+            Request(
+                index,
+                self.tokenizer(text, add_special_tokens=False).input_ids,
+                self.max_new_tokens,
+            )
+        )
+
+    def run(self) -> Iterator[Request]:
+        # Yields requests as they finish, in completion order
+        while self.queue or self.active:
+            while self.queue and len(self.active) < self.max_batch_size:
+                request = self.queue.popleft()
+                if self.prefill(request):
+                    yield request
+            if self.active:
+                yield from self.step()
+
+    def prefill(self, request: Request) -> bool:
+        # Timed from admission, the wait in the queue is not prefill
+        request.start_time = time.perf_counter()
+        device = self.model.device
+        input_ids = torch.tensor([request.input_ids], device=device)
+        if self.guard is not None:
+            generation_kwargs = self.guard.generate_kwargs(
+                {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)},
+                self.tokenizer,
+                self.model,
+                self.enable_thinking,
+                request.max_new_tokens,
+                [request.index],
+            )
+            request.max_new_tokens = generation_kwargs["max_new_tokens"]
+            request.logits_processor = generation_kwargs["logits_processor"]
+            request.stopping_criteria = generation_kwargs["stopping_criteria"]
+            if request.logits_processor or request.stopping_criteria:
+                request.allocate(device)
+
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=input_ids,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                # Only the next token is sampled, from the last position
+                logits_to_keep=1,
+            )
+        request.first_token_time = time.perf_counter()
+        if self.append_tokens([request], outputs.logits[:, -1])[0]:
+            return True
+        self.join(request, outputs.past_key_values)
+        return False
+
+    def join(self, request: Request, cache: DynamicCache) -> None:
+        # Left-pad the shorter side so every row ends at the same cache position
+        length = len(request.input_ids)
+        mask = torch.ones((1, length), dtype=torch.long, device=self.model.device)
+        if self.cache is None:
+            self.cache, self.attention_mask = cache, mask
+            self.active.append(request)
+            return
+        batch_length = self.attention_mask.shape[1]
+        for layer in range(len(cache.key_cache)):
+            keys, values = cache.key_cache[layer], cache.value_cache[layer]
+            batch_keys = self.cache.key_cache[layer]
+            batch_values = self.cache.value_cache[layer]
+            if length < batch_length:
+                keys = F.pad(keys, (0, 0, batch_length - length, 0))
+                values = F.pad(values, (0, 0, batch_length - length, 0))
+            elif length > batch_length:
+                batch_keys = F.pad(batch_keys, (0, 0, length - batch_length, 0))
+                batch_values = F.pad(batch_values, (0, 0, length - batch_length, 0))
+            self.cache.key_cache[layer] = torch.cat([batch_keys, keys])
+            self.cache.value_cache[layer] = torch.cat([batch_values, values])
+        if length < batch_length:
+            mask = F.pad(mask, (batch_length - length, 0))
+        elif length > batch_length:
+            self.attention_mask = F.pad(self.attention_mask, (length - batch_length, 0))
+        self.attention_mask = torch.cat([self.attention_mask, mask])
+        self.active.append(request)
+
+    def step(self) -> list[Request]:
+        device = self.model.device
+        input_ids = torch.tensor(
+            [[request.output_ids[-1]] for request in self.active], device=device
+        )
+        position_ids = torch.tensor(
+            [
+                [len(request.input_ids) + len(request.output_ids) - 1]
+                for request in self.active
+            ],
+            device=device,
+        )
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.cache,
+                use_cache=True,
+            )
+        self.cache = outputs.past_key_values
+        done = self.append_tokens(self.active, outputs.logits[:, -1])
+        finished = [request for request, ended in zip(self.active, done) if ended]
+        if finished:
+            self.evict([row for row, ended in enumerate(done) if not ended])
+        return finished
+
+    def evict(self, keep: list[int]) -> None:
+        self.active = [self.active[row] for row in keep]
+        if not keep:
+            self.cache = self.attention_mask = None
+            return
+        self.cache.batch_select_indices(torch.tensor(keep, device=self.model.device))
+        self.attention_mask = self.attention_mask[keep]
+        # Drop the padding columns the departed rows were the reason for
+        start = int((self.attention_mask.sum(dim=0) > 0).nonzero()[0])
+        if start:
+            self.attention_mask = self.attention_mask[:, start:]
+            for layer in range(len(self.cache.key_cache)):
+                self.cache.key_cache[layer] = self.cache.key_cache[layer][:, :, start:]
+                self.cache.value_cache[layer] = self.cache.value_cache[layer][
+                    :, :, start:
+                ]
+
+    def append_tokens(
+        self, requests: list[Request], logits: torch.FloatTensor
+    ) -> list[bool]:
+        scores = logits.float()
+        if self.suppress_tokens:
+            scores[:, self.suppress_tokens] = -float("inf")
+        for row, request in enumerate(requests):
+            if request.logits_processor:
+                scores[row : row + 1] = request.logits_processor(
+                    request.sequence(), scores[row : row + 1]
+                )
+        if self.do_sample:
+            scores = self.warpers(None, scores)
+            next_tokens = torch.multinomial(scores.softmax(dim=-1), 1).squeeze(1)
+        else:
+            next_tokens = scores.argmax(dim=-1)
+
+        done = []
+        for row, (request, token) in enumerate(zip(requests, next_tokens.tolist())):
+            if request.sequence_ids is not None:
+                position = len(request.input_ids) + len(request.output_ids)
+                request.sequence_ids[0, position] = next_tokens[row]
+            request.output_ids.append(token)
+            ended = (
+                token in self.stop_token_ids
+                or len(request.output_ids) >= request.max_new_tokens
+                or (
+                    bool(request.stopping_criteria)
+                    and bool(
+                        request.stopping_criteria(
+                            request.sequence(), scores[row : row + 1]
+                        ).any()
+                    )
+                )
+            )
+            if ended:
+                request.end_time = time.perf_counter()
+            done.append(ended)
+        return done
+
+
+def qwen_gen_continuous(
+    prompts: list[str],
+    tokenizer: AutoTokenizer,
+    model: AutoModelForCausalLM,
+    batch_size: int = 8,
+    enable_thinking: bool = False,
+    desc: str | None = None,
+    done: int = 0,
+    response_cache: ResponseCache | None = None,
+    on_output: Callable[[int, str], None] | None = None,
+    guard: GenerationGuard | None = None,
+    telemetry: Telemetry | None = None,
+    tags: list[dict[str, Any]] | None = None,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> list[str]:
+    # Same interface and results as qwen_gen_batch, with batch_size bounding
+    # the requests decoded together
+    if generation_kwargs is None:
+        generation_kwargs = GENERATION_KWARGS
+    texts = [render_chat(tokenizer, prompt, enable_thinking) for prompt in prompts]
+
+    def cache_keys() -> list[str]:
+        return [
+            response_cache_key(model, text, enable_thinking, guard, generation_kwargs)
+            for text in texts
+        ]
+
+    def run_uncached(
+        pending: list[int], save_output: Callable[[int, str, dict[str, Any]], None]
+    ) -> None:
+        scheduler = ContinuousBatchScheduler(
+            tokenizer,
+            model,
+            batch_size,
+            enable_thinking,
+            guard,
+            generation_kwargs["max_new_tokens"],
+        )
+        for i in pending:
+            scheduler.submit(i, texts[i])
+        for request in scheduler.run():
+            stats = count_new_tokens(
+                request.output_ids, scheduler.stop_token_ids, THINK_END_TOKEN_ID
+            )
+            if telemetry is not None:
+                stats = {
+                    "batch_size": batch_size,
+                    "prompt_tokens": len(request.input_ids),
+                    **stats,
+                    **request.timings(),
+                }
+            save_output(
+                request.index, decode_response(tokenizer, request.output_ids), stats
+            )
+
+    return generate_with_cache(
+        len(prompts),
+        cache_keys,
+        run_uncached,
+        desc=desc,
+        done=done,
+        response_cache=response_cache,
+        on_output=on_output,
+        telemetry=telemetry,
+        tags=tags,
+    )
@@ -0,0 +1,69 @@
+import argparse
+import os
+from typing import Any
+
+from .checkpoint import JsonlCheckpoint
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n, got {value!r}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {count})")
+    return index, count
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="i/n",
+        help="only generate shard i of n and write its responses under shards/",
+    )
+    group.add_argument(
+        "--merge",
+        type=int,
+        default=None,
+        metavar="n",
+        help="skip generation and write the final output from n finished shards",
+    )
+
+
+def shard_indices(num_items: int, shard: tuple[int, int] | None) -> list[int]:
+    # Round robin, so long and short documents spread evenly over the shards
+    if shard is None:
+        return list(range(num_items))
+    index, count = shard
+    return list(range(index, num_items, count))
+
+
+def shard_items(items: list, shard: tuple[int, int] | None) -> list:
+    return [items[i] for i in shard_indices(len(items), shard)]
+
+
+def checkpoint_path(output_dir: str, shard: tuple[int, int] | None) -> str:
+    if shard is None:
+        return os.path.join(output_dir, "responses.jsonl")
+    index, count = shard
+    return os.path.join(output_dir, "shards", f"responses-{index}-of-{count}.jsonl")
+
+
+def load_shard_records(output_dir: str, count: int) -> list[dict[str, Any]]:
+    records = []
+    for index in range(count):
+        path = checkpoint_path(output_dir, (index, count))
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"shard {index}/{count} has no output at {path}")
+        records.extend(JsonlCheckpoint(path, resume=True).records())
+    return records
+
+
+def load_shard_responses(output_dir: str, count: int) -> dict[str, str]:
+    return {
+        record["key"]: record["response"]
+        for record in load_shard_records(output_dir, count)
+    }
@@ -0,0 +1,156 @@
+from collections import Counter
+from typing import TYPE_CHECKING, Any
+
+from tqdm import tqdm
+
+if TYPE_CHECKING:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# (base, ratio): a task may generate base + ratio * prompt tokens
+TOKEN_BUDGETS = {"ee": (1024, 4.0), "ec": (256, 1.0)}
+
+
+class GenerationGuard:
+    def __init__(
+        self,
+        task: str,
+        token_budget: bool = False,
+        stop_loops: bool = True,
+        max_period: int = 128,
+        min_repeats: int = 4,
+        min_loop_tokens: int = 48,
+        max_thinking_tokens: int | None = None,
+        think_end_token_id: int = 151668,
+        grammar: str | None = None,
+    ) -> None:
+        self.task = task
+        self.token_budget = token_budget
+        self.stop_loops = stop_loops
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_loop_tokens = min_loop_tokens
+        self.max_thinking_tokens = max_thinking_tokens
+        self.think_end_token_id = think_end_token_id
+        self.grammar = grammar
+        self.early_stops = Counter()
+        self.grammar_stats = Counter()
+        # Set to a dict to also collect the early stops and grammar counts of
+        # each prompt index, as the model server does to answer every client
+        # with the stats of its own prompts
+        self.prompt_stats = None
+
+    def row_stats(self, prompt_indices: list[int] | None) -> list[dict] | None:
+        if self.prompt_stats is None or prompt_indices is None:
+            return None
+        return [
+            self.prompt_stats.setdefault(
+                i, {"early_stops": [], "grammar_stats": Counter()}
+            )
+            for i in prompt_indices
+        ]
+
+    def config(self) -> dict[str, Any]:
+        # Anything that can change the generated text belongs in the cache key
+        return {
+            "task": self.task,
+            "token_budget": TOKEN_BUDGETS[self.task] if self.token_budget else None,
+            "stop_loops": (
+                [self.max_period, self.min_repeats, self.min_loop_tokens]
+                if self.stop_loops
+                else None
+            ),
+            "max_thinking_tokens": self.max_thinking_tokens,
+            "grammar": self.grammar,
+        }
+
+    def generate_kwargs(
+        self,
+        model_inputs: dict[str, Any],
+        tokenizer: "AutoTokenizer",
+        model: "AutoModelForCausalLM",
+        enable_thinking: bool,
+        max_new_tokens: int,
+        prompt_indices: list[int] | None = None,
+    ) -> dict[str, Any]:
+        # torch and transformers are only imported once a run generates
+        from transformers import LogitsProcessorList, StoppingCriteriaList
+
+        from .grammar import GrammarLogitsProcessor, load_grammar
+        from .stopping_criteria import (
+            LoopStoppingCriteria,
+            ThinkingBudgetProcessor,
+            TokenBudgetCriteria,
+        )
+
+        # prompt_indices are the prompts of the batch rows, for prompt_stats
+        row_stats = self.row_stats(prompt_indices)
+        input_length = model_inputs["input_ids"].shape[1]
+        eos_token_ids = model.generation_config.eos_token_id
+        if not isinstance(eos_token_ids, list):
+            eos_token_ids = [eos_token_ids]
+        end_token_ids = set(eos_token_ids) | {model.generation_config.pad_token_id}
+        end_token_ids.discard(None)
+
+        stopping_criteria = StoppingCriteriaList()
+        logits_processor = LogitsProcessorList()
+        if self.token_budget:
+            base, ratio = TOKEN_BUDGETS[self.task]
+            prompt_lengths = model_inputs["attention_mask"].sum(dim=1)
+            budgets = (base + ratio * prompt_lengths).long().clamp(max=max_new_tokens)
+            max_new_tokens = int(budgets.max())
+            stopping_criteria.append(
+                TokenBudgetCriteria(
+                    self, input_length, end_token_ids, budgets, row_stats
+                )
+            )
+        if self.stop_loops:
+            stopping_criteria.append(
+                LoopStoppingCriteria(self, input_length, end_token_ids, row_stats)
+            )
+        if enable_thinking and self.max_thinking_tokens is not None:
+            logits_processor.append(
+                ThinkingBudgetProcessor(self, input_length, row_stats)
+            )
+        if self.grammar is not None:
+            logits_processor.append(
+                GrammarLogitsProcessor(
+                    load_grammar(self.grammar),
+                    tokenizer,
+                    input_length,
+                    end_token_ids,
+                    enable_thinking,
+                    self.think_end_token_id,
+                    self.grammar_stats,
+                    (
+                        [stats["grammar_stats"] for stats in row_stats]
+                        if row_stats is not None
+                        else None
+                    ),
+                )
+            )
+
+        return {
+            "max_new_tokens": max_new_tokens,
+            "stopping_criteria": stopping_criteria,
+            "logits_processor": logits_processor,
+        }
+
+    def record(self, reason: str, num_tokens: int, stats: dict | None = None) -> None:
+        self.early_stops[reason] += 1
+        if stats is not None:
+            stats["early_stops"].append([reason, num_tokens])
+        tqdm.write(f"Early stop ({self.task}, {reason}) after {num_tokens} tokens")
+
+    def report(self) -> str:
+        if not self.early_stops:
+            report = f"No early stops in {self.task}"
+        else:
+            report = f"Early stops in {self.task}: " + ", ".join(
+                f"{count} {reason}" for reason, count in self.early_stops.most_common()
+            )
+        if self.grammar is not None:
+            report += (
+                f"\nGrammar {self.grammar}: {self.grammar_stats['interventions']} "
+                f"tokens overridden in {self.grammar_stats['rows']} generations"
+            )
+        return report
@@ -0,0 +1,152 @@
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+from .stopping import GenerationGuard
+
+
+class GuardStoppingCriteria(StoppingCriteria):
+    # Trailing tokens that should_stop reads. They are copied to the host once
+    # per call, since reading a GPU tensor row by row syncs on every read
+    tail_length = 1
+
+    def __init__(
+        self,
+        guard: GenerationGuard,
+        input_length: int,
+        end_token_ids: set[int],
+        row_stats: list[dict] | None = None,
+    ) -> None:
+        self.guard = guard
+        self.input_length = input_length
+        self.end_token_ids = end_token_ids
+        self.row_stats = row_stats
+        self.stopped = set()
+
+    def check(self, num_tokens: int) -> bool:
+        return True
+
+    def should_stop(self, row: int, num_tokens: int, tail: list[int]) -> str | None:
+        raise NotImplementedError
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        is_done = torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )
+        num_tokens = input_ids.shape[1] - self.input_length
+        if num_tokens <= 0 or not self.check(num_tokens):
+            return is_done
+        tails = input_ids[:, -min(self.tail_length, num_tokens) :].tolist()
+        for row, tail in enumerate(tails):
+            # Rows that already emitted EOS keep growing with padding
+            if row in self.stopped or tail[-1] in self.end_token_ids:
+                continue
+            reason = self.should_stop(row, num_tokens, tail)
+            if reason is not None:
+                self.stopped.add(row)
+                self.guard.record(
+                    reason,
+                    num_tokens,
+                    self.row_stats[row] if self.row_stats is not None else None,
+                )
+                is_done[row] = True
+        return is_done
+
+
+class TokenBudgetCriteria(GuardStoppingCriteria):
+    def __init__(
+        self,
+        guard: GenerationGuard,
+        input_length: int,
+        end_token_ids: set[int],
+        budgets: torch.LongTensor,
+        row_stats: list[dict] | None = None,
+    ) -> None:
+        super().__init__(guard, input_length, end_token_ids, row_stats)
+        self.budgets = budgets.tolist()
+        self.min_budget = min(self.budgets)
+
+    def check(self, num_tokens: int) -> bool:
+        # No row can be over its budget before the smallest one is reached
+        return num_tokens >= self.min_budget
+
+    def should_stop(self, row: int, num_tokens: int, tail: list[int]) -> str | None:
+        if num_tokens >= self.budgets[row]:
+            return "token budget"
+        return None
+
+
+class LoopStoppingCriteria(GuardStoppingCriteria):
+    check_every = 8
+
+    def __init__(
+        self,
+        guard: GenerationGuard,
+        input_length: int,
+        end_token_ids: set[int],
+        row_stats: list[dict] | None = None,
+    ) -> None:
+        super().__init__(guard, input_length, end_token_ids, row_stats)
+        # (period, tokens a loop of that period must span)
+        self.windows = [
+            (
+                period,
+                period * max(guard.min_repeats, -(-guard.min_loop_tokens // period)),
+            )
+            for period in range(1, guard.max_period + 1)
+        ]
+        self.tail_length = max(window for _, window in self.windows)
+
+    def check(self, num_tokens: int) -> bool:
+        return num_tokens % self.check_every == 0
+
+    def should_stop(self, row: int, num_tokens: int, tail: list[int]) -> str | None:
+        # A loop is a suffix made of the same period repeated back to back, e.g.
+        # the same ||| line emitted over and over
+        for period, window in self.windows:
+            if window > num_tokens:
+                break
+            if tail[-1] != tail[-1 - period]:
+                continue
+            window_tokens = tail[-window:]
+            if window_tokens[period:] == window_tokens[:-period]:
+                return "repetition loop"
+        return None
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    def __init__(
+        self,
+        guard: GenerationGuard,
+        input_length: int,
+        row_stats: list[dict] | None = None,
+    ) -> None:
+        self.guard = guard
+        self.input_length = input_length
+        self.row_stats = row_stats
+        self.closed = set()
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        generated = input_ids[:, self.input_length :]
+        if generated.shape[1] < self.guard.max_thinking_tokens:
+            return scores
+
+        think_end_token_id = self.guard.think_end_token_id
+        for row in range(input_ids.shape[0]):
+            if row in self.closed:
+                continue
+            self.closed.add(row)
+            if (generated[row] == think_end_token_id).any():
+                continue
+            # Close the thinking block so the answer can start
+            scores[row] = torch.finfo(scores.dtype).min
+            scores[row, think_end_token_id] = 0
+            self.guard.record(
+                "thinking cap",
+                generated.shape[1],
+                self.row_stats[row] if self.row_stats is not None else None,
+            )
+        return scores
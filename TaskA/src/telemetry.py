@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any
+
+
+class Telemetry:
+    def __init__(self, path: str, **tags: Any) -> None:
+        self.path = path
+        # Tags such as subset and prompt variant, added to every record
+        self.tags = tags
+        self.lock = threading.Lock()
+        self.batches = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def next_batch(self) -> str:
+        # Rows generated together share a batch id and the batch timings
+        with self.lock:
+            self.batches += 1
+            return f"{os.getpid()}:{self.batches}"
+
+    def record(self, tags: dict[str, Any] | None = None, **fields: Any) -> None:
+        record = {"time": round(time.time(), 3), **self.tags, **(tags or {}), **fields}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class TelemetryRelay:
+    # Keeps the telemetry fields of each row in memory instead of writing them,
+    # for the model server to send each client its rows and for checks that
+    # count generated tokens. Rows are tagged {"row": i}
+    def __init__(self) -> None:
+        self.batches = 0
+        self.fields = {}
+
+    def next_batch(self) -> str:
+        self.batches += 1
+        return f"{os.getpid()}:{self.batches}"
+
+    def record(self, tags: dict[str, Any] | None = None, **fields: Any) -> None:
+        self.fields[tags["row"]] = fields
+
+
+class GenerationTimer:
+    # A streamer for generate(), which puts the prompt first and then one token
+    # per decoding step, so the second put marks the end of the prefill
+    def __init__(self) -> None:
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self.puts = 0
+
+    def put(self, value: Any) -> None:
+        self.puts += 1
+        if self.puts == 2:
+            self.first_token_time = time.perf_counter()
+
+    def end(self) -> None:
+        self.end_time = time.perf_counter()
+
+    def timings(self) -> dict[str, float]:
+        end_time = self.end_time or time.perf_counter()
+        first_token_time = self.first_token_time or end_time
+        return {
+            "prefill_seconds": round(first_token_time - self.start_time, 4),
+            "decode_seconds": round(end_time - first_token_time, 4),
+            "seconds": round(end_time - self.start_time, 4),
+        }
+
+
+class DraftCounter:
+    # Counts forward passes during assisted generation. Every pass of the target
+    # model verifies the drafted tokens and adds one token of its own, so the
+    # new tokens it did not add itself are accepted drafts. Counts nothing
+    # without a draft model
+    def __init__(self, model: Any, draft_model: Any | None) -> None:
+        self.target_calls = 0
+        self.draft_calls = 0
+        self.hooks = []
+        if draft_model is not None:
+            self.hooks = [
+                model.register_forward_hook(lambda *args: self.count("target_calls")),
+                draft_model.register_forward_hook(
+                    lambda *args: self.count("draft_calls")
+                ),
+            ]
+
+    def count(self, name: str) -> None:
+        setattr(self, name, getattr(self, name) + 1)
+
+    def __enter__(self) -> "DraftCounter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        for hook in self.hooks:
+            hook.remove()
+
+    def stats(self, new_tokens: int) -> dict[str, Any]:
+        if not self.hooks:
+            return {}
+        accepted_tokens = min(max(new_tokens - self.target_calls, 0), self.draft_calls)
+        return {
+            "draft_tokens": self.draft_calls,
+            "accepted_tokens": accepted_tokens,
+            "acceptance_rate": (
+                round(accepted_tokens / self.draft_calls, 4)
+                if self.draft_calls
+                else 0.0
+            ),
+        }
+
+
+def count_new_tokens(
+    output_ids: list[int], end_token_ids: set[int], think_end_token_id: int
+) -> dict[str, int]:
+    new_tokens = len(output_ids)
+    for index, token_id in enumerate(output_ids):
+        if token_id in end_token_ids:
+            new_tokens = index + 1
+            break
+    try:
+        thinking_tokens = output_ids[:new_tokens].index(think_end_token_id) + 1
+    except ValueError:
+        thinking_tokens = 0
+    return {"new_tokens": new_tokens, "thinking_tokens": thinking_tokens}
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def report(path: str, top: int = 10) -> None:
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    if not records:
+        print(f"No records in {path}")
+        return
+
+    groups = defaultdict(list)
+    for record in records:
+        groups[(record.get("subset", "-"), record.get("variant", "-"))].append(record)
+
+    print(
+        f"{'subset':<12} {'variant':<8} {'calls':>6} {'prompt':>9} {'new':>8} "
+        f"{'think':>8} {'prefill s':>10} {'decode s':>10} {'tok/s':>8} "
+        f"{'p50 s':>7} {'p95 s':>7}"
+    )
+    for (subset, variant), group in sorted(groups.items()):
+        seconds = [record.get("seconds", 0.0) for record in group]
+        new_tokens = sum(record.get("new_tokens", 0) for record in group)
+        batches = {record.get("batch", i): record for i, record in enumerate(group)}
+        prefill_seconds = sum(r.get("prefill_seconds", 0.0) for r in batches.values())
+        # Server backends only time whole requests, counted as decoding
+        decode_seconds = sum(
+            r.get("decode_seconds", r.get("seconds", 0.0)) for r in batches.values()
+        )
+        tokens_per_sec = new_tokens / decode_seconds if decode_seconds else 0.0
+        print(
+            f"{subset:<12} {variant:<8} {len(group):>6} "
+            f"{sum(record.get('prompt_tokens', 0) for record in group):>9} "
+            f"{new_tokens:>8} "
+            f"{sum(record.get('thinking_tokens', 0) for record in group):>8} "
+            f"{prefill_seconds:>10.1f} {decode_seconds:>10.1f} {tokens_per_sec:>8.1f} "
+            f"{percentile(seconds, 0.5):>7.2f} {percentile(seconds, 0.95):>7.2f}"
+        )
+
+    for (subset, variant), group in sorted(groups.items()):
+        draft_tokens = sum(record.get("draft_tokens", 0) for record in group)
+        if draft_tokens:
+            accepted_tokens = sum(record.get("accepted_tokens", 0) for record in group)
+            print(
+                f"Draft acceptance in {subset} {variant}: {accepted_tokens} of "
+                f"{draft_tokens} tokens ({accepted_tokens / draft_tokens:.1%})"
+            )
+
+    for title, field in (("Slowest", "seconds"), ("Longest", "new_tokens")):
+        print(f"\n{title} documents by {field}:")
+        ranked = sorted(records, key=lambda record: record.get(field, 0), reverse=True)
+        for record in ranked[:top]:
+            print(
+                f"  {record.get(field, 0):>10} {record.get('subset', '-')} "
+                f"{record.get('variant', '-')} "
+                f"{record.get('doc_id', record.get('entity', '-'))}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="print aggregates and the slowest documents of a metrics file"
+    )
+    parser.add_argument("metrics", help="path to the JSONL metrics file")
+    parser.add_argument(
+        "--top", type=int, default=10, help="number of documents listed per ranking"
+    )
+    args = parser.parse_args()
+    report(args.metrics, args.top)
+
+
+if __name__ == "__main__":
+    main()
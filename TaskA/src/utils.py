@@ -1,20 +1,54 @@
+import copy
 import json
+import os
 import random
 import re
-from typing import Any
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, NamedTuple
 
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
 
+from .cache import ResponseCache
+from .checkpoint import JsonlCheckpoint
+from .docstore import DocumentStore, open_document_store
+from .manifest import prompt_hash, reuse_unchanged
+from .prompts import (
+    entity_extraction_customized_example_string,
+    entity_extraction_customized_examples_prompt,
+    entity_extraction_prompt,
+    plain_classification_customized_example_string,
+    plain_classification_engineering_customized_examples_prompt,
+    plain_classification_prompt_engineering,
+    plain_classification_prompt_scholarly,
+    plain_classification_scholarly_customized_examples_prompt,
+    prefix_boundary,
+)
+from .sharding import shard_indices
+from .telemetry import (
+    DraftCounter,
+    GenerationTimer,
+    Telemetry,
+    TelemetryRelay,
+    count_new_tokens,
+)
 
-def qwen_gen(
-    prompt_template: str,
-    tokenizer: AutoTokenizer,
-    model: AutoModelForCausalLM,
-    enable_thinking: bool = False,
-    **prompt_template_kwargs,
+if TYPE_CHECKING:
+    from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+
+    from .backends import Backend
+    from .stopping import GenerationGuard
+
+THINK_END_TOKEN_ID = 151668  # </think>
+GENERATION_KWARGS = {"max_new_tokens": 32768}
+# Overrides the sampling defaults of Qwen3's generation_config, for checks that
+# compare two runs token for token
+GREEDY_KWARGS = {"do_sample": False, "temperature": None, "top_p": None, "top_k": None}
+
+
+def render_chat(
+    tokenizer: "AutoTokenizer", prompt: str, enable_thinking: bool = False
 ) -> str:
-    prompt = prompt_template.format(**prompt_template_kwargs)
     messages = [{"role": "user", "content": prompt}]
     text = tokenizer.apply_chat_template(
         messages,
@@ -22,15 +56,14 @@ def qwen_gen(
         add_generation_prompt=True,
         enable_thinking=enable_thinking,
     )
-    model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+    return text
 
-    generated_ids = model.generate(**model_inputs, max_new_tokens=32768)
-    output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
 
+def decode_response(tokenizer: "AutoTokenizer", output_ids: list[int]) -> str:
     # parsing thinking content
     try:
         # rindex finding 151668 (</think>)
-        index = len(output_ids) - output_ids[::-1].index(151668)
+        index = len(output_ids) - output_ids[::-1].index(THINK_END_TOKEN_ID)
     except ValueError:
         index = 0
 
@@ -38,25 +71,556 @@ def qwen_gen(
     return content
 
 
-def raw_ee_line2entity(entity_line: str, lower: bool = True) -> str:
-    if lower:
-        return entity_line.strip().split("|||")[1].lower()
-    else:
-        return entity_line.strip().split("|||")[1]
+def end_token_ids(model: "AutoModelForCausalLM") -> set[int]:
+    eos_token_ids = model.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids]
+    token_ids = set(eos_token_ids) | {model.generation_config.pad_token_id}
+    token_ids.discard(None)
+    return token_ids
+
+
+def response_cache_key(
+    model: "AutoModelForCausalLM",
+    text: str,
+    enable_thinking: bool,
+    guard: "GenerationGuard | None" = None,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> str:
+    key_kwargs = model.generation_config.to_diff_dict()
+    key_kwargs.pop("transformers_version", None)
+    key_kwargs.update(generation_kwargs or GENERATION_KWARGS)
+    if getattr(model, "quantization", None) is not None:
+        key_kwargs["quantization"] = model.quantization
+    if guard is not None:
+        key_kwargs["guard"] = guard.config()
+    return ResponseCache.key(model.name_or_path, text, enable_thinking, key_kwargs)
+
+
+def qwen_gen(
+    prompt_template: str,
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    enable_thinking: bool = False,
+    response_cache: ResponseCache | None = None,
+    telemetry: Telemetry | None = None,
+    tags: dict[str, Any] | None = None,
+    assistant_model: "AutoModelForCausalLM | None" = None,
+    **prompt_template_kwargs,
+) -> str:
+    prompt = prompt_template.format(**prompt_template_kwargs)
+    text = render_chat(tokenizer, prompt, enable_thinking)
+    if response_cache is not None:
+        key = response_cache_key(model, text, enable_thinking)
+        content = response_cache.get(key)
+        if content is not None:
+            return content
+
+    model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+
+    timer = GenerationTimer() if telemetry is not None else None
+    with DraftCounter(model, assistant_model) as draft_counter:
+        generated_ids = model.generate(
+            **model_inputs,
+            **GENERATION_KWARGS,
+            assistant_model=assistant_model,
+            streamer=timer,
+        )
+    output_ids = generated_ids[0][len(model_inputs.input_ids[0]) :].tolist()
+
+    content = decode_response(tokenizer, output_ids)
+    if telemetry is not None:
+        token_counts = count_new_tokens(
+            output_ids, end_token_ids(model), THINK_END_TOKEN_ID
+        )
+        telemetry.record(
+            tags,
+            batch=telemetry.next_batch(),
+            batch_size=1,
+            prompt_tokens=len(model_inputs.input_ids[0]),
+            **token_counts,
+            **draft_counter.stats(token_counts["new_tokens"]),
+            **timer.timings(),
+        )
+    if response_cache is not None:
+        response_cache.put(key, content)
+    return content
+
+
+def split_prompt_template(prompt_template: str) -> tuple[str, str]:
+    # Everything before the real data section is shared by all documents
+    index = prompt_template.index(prefix_boundary)
+    return prompt_template[:index], prompt_template[index:]
+
+
+def build_prefix_cache(
+    prefix_prompt: str,
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    enable_thinking: bool = False,
+) -> "tuple[str, list[int], DynamicCache]":
+    import torch
+    from transformers import DynamicCache
+
+    text = render_chat(tokenizer, prefix_prompt, enable_thinking)
+    prefix_text = text[: text.index(prefix_prompt) + len(prefix_prompt)]
+    prefix_ids = tokenizer(prefix_text, add_special_tokens=False).input_ids
+
+    # Only the cache is kept. logits_to_keep=1 skips the vocabulary-wide
+    # logits of every prefix token, gigabytes for a long Prompt 2 prefix
+    with torch.no_grad():
+        outputs = model(
+            torch.tensor([prefix_ids], device=model.device),
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+    return prefix_text, prefix_ids, outputs.past_key_values
+
+
+def tokenize_prompts(
+    texts: list[str],
+    tokenizer: "AutoTokenizer",
+    prefix_cache: "tuple[str, list[int], DynamicCache] | None" = None,
+) -> list[list[int]]:
+    if prefix_cache is None:
+        return tokenizer(texts).input_ids
+
+    # Only the document-specific tails, the shared prefix is already cached
+    prefix_text = prefix_cache[0]
+    for text in texts:
+        if not text.startswith(prefix_text):
+            raise ValueError("prompt does not start with the cached prefix")
+    return tokenizer(
+        [text[len(prefix_text) :] for text in texts], add_special_tokens=False
+    ).input_ids
+
+
+def pad_batch_inputs(
+    token_ids: list[list[int]],
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    prefix_cache: "tuple[str, list[int], DynamicCache] | None" = None,
+) -> dict[str, Any]:
+    import torch
+
+    # Left padding, between the shared prefix and the tail with a prefix cache,
+    # so the cached prefix stays aligned for every row
+    prefix_ids = prefix_cache[1] if prefix_cache is not None else []
+    max_length = max(len(ids) for ids in token_ids)
+    input_ids = []
+    attention_mask = []
+    for ids in token_ids:
+        padding = max_length - len(ids)
+        input_ids.append(prefix_ids + [tokenizer.pad_token_id] * padding + ids)
+        attention_mask.append([1] * len(prefix_ids) + [0] * padding + [1] * len(ids))
+
+    model_inputs = {
+        "input_ids": torch.tensor(input_ids, device=model.device),
+        "attention_mask": torch.tensor(attention_mask, device=model.device),
+    }
+    if prefix_cache is not None:
+        # generate() extends the cache in place, so every batch gets its own copy
+        past_key_values = copy.deepcopy(prefix_cache[2])
+        past_key_values.batch_repeat_interleave(len(token_ids))
+        model_inputs["past_key_values"] = past_key_values
+    return model_inputs
+
+
+def prepare_batch_inputs(
+    texts: list[str],
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    prefix_cache: "tuple[str, list[int], DynamicCache] | None" = None,
+) -> dict[str, Any]:
+    return pad_batch_inputs(
+        tokenize_prompts(texts, tokenizer, prefix_cache),
+        tokenizer,
+        model,
+        prefix_cache,
+    )
+
+
+def generate_with_cache(
+    num_prompts: int,
+    cache_keys: Callable[[], list[str]],
+    run_uncached: Callable[
+        [list[int], Callable[[int, str, dict[str, Any]], None]], None
+    ],
+    desc: str | None = None,
+    done: int = 0,
+    response_cache: ResponseCache | None = None,
+    on_output: Callable[[int, str], None] | None = None,
+    telemetry: Telemetry | None = None,
+    tags: list[dict[str, Any]] | None = None,
+) -> list[str]:
+    # The part every generation path shares: answers from the response cache,
+    # then run_uncached(pending, save_output) generates the rest and calls
+    # save_output(i, content, stats) per prompt, where stats are its telemetry
+    # fields. Outputs are cached, recorded and passed to on_output one at a
+    # time, even when several threads save them. done counts the prompts of the
+    # run finished before this call, e.g. from a checkpoint, so a resumed
+    # progress bar starts there
+    contents = [None] * num_prompts
+    pending = list(range(num_prompts))
+    if response_cache is not None and pending:
+        keys = cache_keys()
+        for i, key in enumerate(keys):
+            contents[i] = response_cache.get(key)
+            if contents[i] is not None and on_output is not None:
+                on_output(i, contents[i])
+        pending = [i for i in pending if contents[i] is None]
+    if not pending:
+        return contents
+
+    lock = threading.Lock()
+    new_tokens = 0
+    start_time = time.perf_counter()
+    with tqdm(
+        total=done + num_prompts,
+        initial=done + num_prompts - len(pending),
+        desc=desc,
+        disable=desc is None,
+    ) as pbar:
+
+        def save_output(i: int, content: str, stats: dict[str, Any]) -> None:
+            nonlocal new_tokens
+            with lock:
+                contents[i] = content
+                if telemetry is not None:
+                    telemetry.record(tags[i] if tags is not None else None, **stats)
+                if response_cache is not None:
+                    response_cache.put(keys[i], content)
+                if on_output is not None:
+                    on_output(i, content)
+                if "new_tokens" in stats:
+                    new_tokens += stats["new_tokens"]
+                    pbar.set_postfix_str(
+                        f"{new_tokens / (time.perf_counter() - start_time):.1f} tok/s"
+                    )
+                pbar.update(1)
+
+        run_uncached(pending, save_output)
+    return contents
+
+
+def qwen_gen_batch(
+    prompts: list[str],
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    batch_size: int = 8,
+    enable_thinking: bool = False,
+    desc: str | None = None,
+    done: int = 0,
+    prefix_cache: "tuple[str, list[int], DynamicCache] | None" = None,
+    response_cache: ResponseCache | None = None,
+    on_output: Callable[[int, str], None] | None = None,
+    guard: "GenerationGuard | None" = None,
+    telemetry: Telemetry | None = None,
+    tags: list[dict[str, Any]] | None = None,
+    assistant_model: "AutoModelForCausalLM | None" = None,
+    greedy: bool = False,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> list[str]:
+    if generation_kwargs is None:
+        generation_kwargs = GENERATION_KWARGS
+    texts = [render_chat(tokenizer, prompt, enable_thinking) for prompt in prompts]
+    if assistant_model is not None:
+        # transformers drafts for a single sequence only
+        batch_size = 1
+
+    def cache_keys() -> list[str]:
+        return [
+            response_cache_key(model, text, enable_thinking, guard, generation_kwargs)
+            for text in texts
+        ]
+
+    def run_uncached(
+        pending: list[int], save_output: Callable[[int, str, dict[str, Any]], None]
+    ) -> None:
+        # Bucket prompts of similar length together to minimize padding,
+        # longest first so that out-of-memory errors surface on the first
+        # batch. Cache hits are never tokenized, the rest only once
+        token_ids = dict(
+            zip(
+                pending,
+                tokenize_prompts([texts[i] for i in pending], tokenizer, prefix_cache),
+            )
+        )
+        order = sorted(pending, key=lambda i: len(token_ids[i]), reverse=True)
+        stop_token_ids = end_token_ids(model)
+        for start in range(0, len(order), batch_size):
+            batch = order[start : start + batch_size]
+            model_inputs = pad_batch_inputs(
+                [token_ids[i] for i in batch], tokenizer, model, prefix_cache
+            )
+
+            batch_kwargs = dict(generation_kwargs)
+            if greedy:
+                batch_kwargs.update(GREEDY_KWARGS)
+            if guard is not None:
+                batch_kwargs.update(
+                    guard.generate_kwargs(
+                        model_inputs,
+                        tokenizer,
+                        model,
+                        enable_thinking,
+                        generation_kwargs["max_new_tokens"],
+                        batch,
+                    )
+                )
+            timer = GenerationTimer() if telemetry is not None else None
+            with DraftCounter(model, assistant_model) as draft_counter:
+                generated_ids = model.generate(
+                    **model_inputs,
+                    **batch_kwargs,
+                    assistant_model=assistant_model,
+                    streamer=timer,
+                )
+            input_length = model_inputs["input_ids"].shape[1]
+            if telemetry is not None:
+                batch_id = telemetry.next_batch()
+                prompt_lengths = model_inputs["attention_mask"].sum(dim=1).tolist()
+                timings = timer.timings()
+            for row, i in enumerate(batch):
+                output_ids = generated_ids[row][input_length:].tolist()
+                stats = count_new_tokens(output_ids, stop_token_ids, THINK_END_TOKEN_ID)
+                if telemetry is not None:
+                    stats = {
+                        "batch": batch_id,
+                        "batch_size": len(batch),
+                        "prompt_tokens": prompt_lengths[row],
+                        **stats,
+                        **draft_counter.stats(stats["new_tokens"]),
+                        **timings,
+                    }
+                save_output(i, decode_response(tokenizer, output_ids), stats)
+
+    return generate_with_cache(
+        len(prompts),
+        cache_keys,
+        run_uncached,
+        desc=desc,
+        done=done,
+        response_cache=response_cache,
+        on_output=on_output,
+        telemetry=telemetry,
+        tags=tags,
+    )
+
+
+def check_prefix_cache(
+    prompts: list[str],
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    prefix_cache: "tuple[str, list[int], DynamicCache]",
+    enable_thinking: bool = False,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> None:
+    # Greedy decoding must not change when the shared prefix is served from cache
+    uncached = qwen_gen_batch(
+        prompts,
+        tokenizer,
+        model,
+        batch_size=1,
+        enable_thinking=enable_thinking,
+        greedy=True,
+        generation_kwargs=generation_kwargs,
+    )
+    cached = qwen_gen_batch(
+        prompts,
+        tokenizer,
+        model,
+        batch_size=1,
+        enable_thinking=enable_thinking,
+        prefix_cache=prefix_cache,
+        greedy=True,
+        generation_kwargs=generation_kwargs,
+    )
+    for prompt_index, (expected, actual) in enumerate(zip(uncached, cached)):
+        if expected != actual:
+            raise RuntimeError(
+                f"prefix cache changed the output of prompt {prompt_index}"
+            )
+
+
+def compare_constrained(
+    prompts: list[str],
+    tokenizer: "AutoTokenizer",
+    model: "AutoModelForCausalLM",
+    guard: "GenerationGuard",
+    enable_thinking: bool = False,
+    generation_kwargs: dict[str, Any] | None = None,
+) -> list[tuple[int, int]]:
+    # Generated tokens per prompt without and with the grammar of the guard,
+    # thinking and end tokens included, both greedy so that the difference is
+    # not sampling noise
+    unconstrained_guard = copy.copy(guard)
+    unconstrained_guard.grammar = None
+    token_counts = []
+    for generation_guard in (unconstrained_guard, guard):
+        relay = TelemetryRelay()
+        qwen_gen_batch(
+            prompts,
+            tokenizer,
+            model,
+            batch_size=1,
+            enable_thinking=enable_thinking,
+            guard=generation_guard,
+            telemetry=relay,
+            tags=[{"row": i} for i in range(len(prompts))],
+            greedy=True,
+            generation_kwargs=generation_kwargs,
+        )
+        token_counts.append(
+            [relay.fields[i]["new_tokens"] for i in range(len(prompts))]
+        )
+    return list(zip(*token_counts))
+
+
+def open_test_docs(data_dir: str, subset: str) -> DocumentStore:
+    return open_document_store(
+        os.path.join(data_dir, f"{subset}/test/text2onto_{subset}_test_documents.jsonl")
+    )
+
+
+def load_test_docs(data_dir: str, subset: str) -> list[dict[str, str]]:
+    return list(open_test_docs(data_dir, subset))
+
+
+def load_train_docs(
+    data_dir: str, subset: str, doc_ids: dict[str, Any]
+) -> list[dict[str, str]]:
+    # Looked up through the offset index instead of parsing the whole split
+    return open_document_store(
+        os.path.join(data_dir, f"{subset}/train/documents.jsonl")
+    ).get_many(doc_ids)
+
+
+def ee_prompt_setup(
+    prompt: str, subset: str, data_dir: str, example_dir: str
+) -> tuple[str, dict[str, str]]:
+    if prompt == "1":
+        return entity_extraction_prompt, {}
+
+    example_outputs = json.load(
+        open(os.path.join(example_dir, f"entity_extraction/{subset}/doc_examples.json"))
+    )
+    train_example_docs = load_train_docs(data_dir, subset, example_outputs)
+    examples_string = ee_prompt_2_preprocess(
+        entity_extraction_customized_example_string,
+        example_outputs,
+        train_example_docs,
+    )
+    return entity_extraction_customized_examples_prompt, {
+        "examples_string": examples_string
+    }
+
+
+def ec_prompt_setup(
+    prompt: str, subset: str, data_dir: str, example_dir: str
+) -> tuple[str, dict[str, str]]:
+    if prompt == "1":
+        if subset == "engineering":
+            return plain_classification_prompt_engineering, {}
+        elif subset == "scholarly":
+            return plain_classification_prompt_scholarly, {}
+
+    if subset == "engineering":
+        prompt_template = plain_classification_engineering_customized_examples_prompt
+    elif subset == "scholarly":
+        prompt_template = plain_classification_scholarly_customized_examples_prompt
+
+    example_doc_entities = json.load(
+        open(
+            os.path.join(
+                example_dir,
+                f"entity_classification/{subset}/example_doc_entities.json",
+            )
+        )
+    )
+    example_train_docs = load_train_docs(data_dir, subset, example_doc_entities)
+    examples_string, _ = ec_prompt_2_preprocess(
+        example_train_docs,
+        example_doc_entities,
+        plain_classification_customized_example_string,
+        {},
+    )
+    return prompt_template, {"examples_string": examples_string}
+
+
+def write_lines(path: str, lines: list[str]) -> None:
+    with open(path, "w") as fout:
+        for line in lines:
+            fout.write(line + "\n")
+
 
+class EntityRecord(NamedTuple):
+    name: str
+    type: str
+    # None when the line has no description field
+    description: str | None
 
-def raw_ee_line2cat(entity_line: str, lower: bool = True) -> str:
-    if lower:
-        return entity_line.strip().split("|||")[2].lower()
-    else:
-        return entity_line.strip().split("|||")[2]
 
+def parse_entity_line(entity_line: str) -> EntityRecord | None:
+    # ("entity"|||name|||type|||description), split once. Lines without a
+    # name field are not entity records
+    fields = entity_line.strip().split("|||", 4)
+    if len(fields) > 3:
+        return EntityRecord(fields[1], fields[2], fields[3].strip())
+    if len(fields) == 3:
+        return EntityRecord(fields[1], fields[2], None)
+    if len(fields) == 2:
+        return EntityRecord(fields[1], "", None)
+    return None
 
-def raw_ee_line2des(entity_line: str, lower: bool = True) -> str:
-    if lower:
-        return entity_line.strip().split("|||")[3].strip().lower()
-    else:
-        return entity_line.strip().split("|||")[3].strip()
+
+def parse_entity_lines(content: str) -> Iterator[EntityRecord]:
+    for entity_line in content.splitlines():
+        record = parse_entity_line(entity_line)
+        if record is not None:
+            yield record
+
+
+# The postprocessors below read whole runs without building a record per
+# entity: millions of small tracked objects make the garbage collector the
+# bottleneck, and passes that only need names stop splitting after the name
+def entity_names(contents: Iterable[str]) -> Iterator[str]:
+    return (
+        fields[1]
+        for content in contents
+        for entity_line in content.splitlines()
+        if len(fields := entity_line.strip().split("|||", 2)) > 1
+    )
+
+
+def entity_columns(contents: dict[str, str]) -> dict[str, list]:
+    # One list per field, with a missing type or description as "" or None
+    doc_ids, names, types, descriptions = [], [], [], []
+    for doc_id, content in contents.items():
+        for entity_line in content.splitlines():
+            fields = entity_line.strip().split("|||", 4)
+            if len(fields) < 2:
+                continue
+            doc_ids.append(doc_id)
+            names.append(fields[1])
+            types.append(fields[2] if len(fields) > 2 else "")
+            descriptions.append(fields[3].strip() if len(fields) > 3 else None)
+    return {
+        "doc_id": doc_ids,
+        "name": names,
+        "type": types,
+        "description": descriptions,
+    }
+
+
+def ee_content2entities(content: str) -> list[str]:
+    return [name.lower() for name in entity_names([content])]
+
+
+def ee_postprocess(contents: dict[str, str]) -> list[str]:
+    # Deduplicate in first-seen order so reruns and merged shards write the same files
+    return list(dict.fromkeys(name.lower() for name in entity_names(contents.values())))
 
 
 def ee_prompt_2_preprocess(
@@ -77,48 +641,194 @@ def ee_prompt_2_preprocess(
     return examples_string
 
 
-def ec_prompt_1_preprocess(ee_contents: dict[str, Any]) -> str:
-    list_of_entities_with_description = ""
-    for doc_id, content in ee_contents.items():
-        for entity_line in content.splitlines():
-            entity_name = raw_ee_line2entity(entity_line)
-            try:
-                entity_desc = raw_ee_line2des(entity_line, lower=False)
-            except:
-                entity_desc = raw_ee_line2cat(entity_line, lower=False)
-            list_of_entities_with_description += f"{entity_name}: {entity_desc}\n"
-    return list_of_entities_with_description
+def normalize_entity_name(entity_name: str) -> str:
+    return " ".join(entity_name.lower().split())
+
+
+def ec_prompt_1_preprocess(ee_contents: dict[str, Any], dedup: bool = False) -> str:
+    columns = entity_columns(ee_contents)
+    # Entities without a description are described by their type
+    entities = (
+        (name.lower(), entity_type if description is None else description)
+        for name, entity_type, description in zip(
+            columns["name"], columns["type"], columns["description"]
+        )
+    )
+    if not dedup:
+        return "".join(
+            f"{entity_name}: {entity_desc}\n" for entity_name, entity_desc in entities
+        )
+
+    unique_entities = {}
+    for entity_name, entity_desc in entities:
+        # Keep the most detailed description of each entity
+        key = normalize_entity_name(entity_name)
+        if key not in unique_entities or len(entity_desc) > len(
+            unique_entities[key][1]
+        ):
+            unique_entities[key] = (entity_name, entity_desc)
+    return "".join(
+        f"{entity_name}: {entity_desc}\n"
+        for entity_name, entity_desc in unique_entities.values()
+    )
+
+
+def ec_prompt_1_pack(
+    list_of_entities_with_description: str, entities_per_prompt: int = 1
+) -> tuple[list[str], list[str]]:
+    entity_lines = list_of_entities_with_description.splitlines()
+    lines = [
+        "\n".join(entity_lines[start : start + entities_per_prompt])
+        for start in range(0, len(entity_lines), entities_per_prompt)
+    ]
+    # Entity lines repeat across documents, so checkpoint keys include the position
+    line_keys = [f"{i}:{line}" for i, line in enumerate(lines)]
+    return lines, line_keys
+
+
+def ec_prompt_1_entity_names(line: str) -> str:
+    # The entity names of a packed prompt. Entity lines come from all documents,
+    # so telemetry tags EC Prompt 1 calls by entity instead of doc_id
+    return ", ".join(entity_line.split(": ", 1)[0] for entity_line in line.splitlines())
 
 
 def ec_prompt_1_generate(
     subset: str,
     list_of_entities_with_description: str,
-    **qwen_gen_kwargs: dict[str, Any],
+    prompt_template: str,
+    backend: "Backend",
+    batch_size: int = 1,
+    enable_thinking: bool = False,
+    response_cache: ResponseCache | None = None,
+    checkpoint: JsonlCheckpoint | None = None,
+    entities_per_prompt: int = 1,
+    guard: "GenerationGuard | None" = None,
+    shard: tuple[int, int] | None = None,
+    telemetry: Telemetry | None = None,
+    manifest: dict[str, dict[str, str]] | None = None,
+    on_output: Callable[[str, str], None] | None = None,
 ) -> tuple[list[dict[str, str]], list[str]]:
-    all_class_responses = []
-    unreadable_responses = []
-    for line in tqdm(
-        list_of_entities_with_description.splitlines(), desc=f"Processing {subset}"
-    ):
-        class_response = qwen_gen(
-            **qwen_gen_kwargs, list_of_entities_with_description=line
+    lines, line_keys = ec_prompt_1_pack(
+        list_of_entities_with_description, entities_per_prompt
+    )
+    selected = shard_indices(len(lines), shard)
+    done = checkpoint.keys() if checkpoint is not None else set()
+    pending = [i for i in selected if line_keys[i] not in done]
+
+    prompts = [
+        prompt_template.format(list_of_entities_with_description=lines[i])
+        for i in pending
+    ]
+    hashes = [prompt_hash(backend, prompt, guard) for prompt in prompts]
+    if manifest is not None and checkpoint is not None:
+        keep = reuse_unchanged(
+            manifest, [line_keys[i] for i in pending], hashes, checkpoint
         )
-        # Process raw response into JSON format
+        pending = [pending[i] for i in keep]
+        prompts = [prompts[i] for i in keep]
+        hashes = [hashes[i] for i in keep]
+
+    # Responses are parsed as they arrive, on the decoding thread with
+    # --scheduler overlapped instead of after the last generation
+    parsed = {}
+
+    def save_response(pending_index: int, class_response: str) -> None:
+        i = pending[pending_index]
+        parsed[i] = ec_prompt_1_parse_response(lines[i], class_response)
+        if checkpoint is not None:
+            checkpoint.append(line_keys[i], class_response, hash=hashes[pending_index])
+        if on_output is not None:
+            on_output(line_keys[i], class_response)
+
+    class_responses = backend.generate(
+        prompts,
+        batch_size=batch_size,
+        enable_thinking=enable_thinking,
+        desc=f"Processing {subset}",
+        done=len(selected) - len(pending),
+        response_cache=response_cache,
+        on_output=save_response,
+        guard=guard,
+        telemetry=telemetry,
+        tags=[{"entity": ec_prompt_1_entity_names(lines[i])} for i in pending],
+    )
+    if checkpoint is not None:
+        saved_responses = checkpoint.load()
+        class_responses = [saved_responses[line_keys[i]] for i in selected]
+
+    return ec_prompt_1_parse(
+        [lines[i] for i in selected],
+        class_responses,
+        {index: parsed[i] for index, i in enumerate(selected) if i in parsed},
+    )
+
+
+def ec_prompt_1_parse_response(
+    line: str, class_response: str
+) -> list[dict[str, str]] | None:
+    # Process raw response into JSON format, None if it cannot be read
+    try:
+        return list(json.loads(class_response))
+    except:
         try:
-            all_class_responses += json.loads(class_response)
+            return list(
+                json.loads(
+                    re.findall(r"\[\s*{.*?}\s*\]", class_response, re.DOTALL)[0]
+                )[: len(line.splitlines())]
+            )
         except:
-            try:
-                all_class_responses.append(
-                    json.loads(
-                        re.findall(r"\[\s*{.*?}\s*\]", class_response, re.DOTALL)[0]
-                    )[0]
-                )
-            except:
-                unreadable_responses.append(class_response)
+            return None
+
+
+def ec_prompt_1_parse(
+    lines: list[str],
+    class_responses: list[str],
+    parsed: dict[int, list[dict[str, str]] | None] | None = None,
+) -> tuple[list[dict[str, str]], list[str]]:
+    # Responses already parsed as they were generated are looked up by index
+    all_class_responses = []
+    unreadable_responses = []
+    for i, (line, class_response) in enumerate(zip(lines, class_responses)):
+        if parsed is not None and i in parsed:
+            class_response_dicts = parsed[i]
+        else:
+            class_response_dicts = ec_prompt_1_parse_response(line, class_response)
+        if class_response_dicts is None:
+            unreadable_responses.append(class_response)
+        else:
+            all_class_responses += class_response_dicts
 
     return all_class_responses, unreadable_responses
 
 
+def ec_prompt_1_fan_out(
+    all_class_responses: list[dict[str, str]],
+    ee_contents: dict[str, Any],
+) -> tuple[list[dict[str, str]], list[str]]:
+    # Repeat the classification of a deduplicated entity for every entity line, in
+    # document order, so the output lines up with a run without deduplication.
+    # Classifications of a name that was not asked about are returned as errors
+    names = [
+        normalize_entity_name(name) for name in entity_columns(ee_contents)["name"]
+    ]
+    asked = set(names)
+    classifications = {}
+    mismatched_responses = []
+    for ent_dict in all_class_responses:
+        try:
+            key = normalize_entity_name(ent_dict["entity"])
+        except:
+            key = None
+        if key in asked:
+            classifications.setdefault(key, ent_dict)
+        else:
+            mismatched_responses.append(json.dumps(ent_dict))
+    fanned_out_responses = [
+        classifications[name] for name in names if name in classifications
+    ]
+    return fanned_out_responses, mismatched_responses
+
+
 def ec_prompt_1_postprocess(
     all_class_responses: list[dict[str, str]],
 ) -> tuple[list[str], list[str]]:
@@ -133,8 +843,8 @@ def ec_prompt_1_postprocess(
             extracted_terms.append(ent_dict["entity"])
         elif ent_dict["classification"] == "type":
             extracted_types.append(ent_dict["entity"])
-    extracted_terms = list(set(extracted_terms))
-    extracted_types = list(set(extracted_types))
+    extracted_terms = list(dict.fromkeys(extracted_terms))
+    extracted_types = list(dict.fromkeys(extracted_types))
 
     return extracted_terms, extracted_types
 
@@ -152,7 +862,8 @@ def ec_prompt_2_preprocess(
             example_doc_entities[doc_id]["terms"]
             + example_doc_entities[doc_id]["types"]
         )
-        random.shuffle(entity_list)
+        # Seeded per example, so every process and rerun builds the same prompt
+        random.Random(doc_id).shuffle(entity_list)
         example_output_list = []
         for entity in entity_list:
             if entity in example_doc_entities[doc_id]["terms"]:
@@ -172,10 +883,7 @@ def ec_prompt_2_preprocess(
 
     extracted_entities = {}
     for doc_id in ee_contents:
-        extracted_entities[doc_id] = []
-        content = ee_contents[doc_id]
-        for entity_line in content.splitlines():
-            extracted_entities[doc_id].append(raw_ee_line2entity(entity_line))
+        extracted_entities[doc_id] = ee_content2entities(ee_contents[doc_id])
 
     return examples_string, extracted_entities
 
@@ -195,6 +903,6 @@ def ec_prompt_2_postprocess(contents: dict[str, str]) -> tuple[list[str], list[s
             except:
                 print(line)
                 continue
-    extracted_terms = list(set(extracted_terms))
-    extracted_types = list(set(extracted_types))
+    extracted_terms = list(dict.fromkeys(extracted_terms))
+    extracted_types = list(dict.fromkeys(extracted_types))
     return extracted_terms, extracted_types
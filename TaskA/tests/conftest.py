@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+TASK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_DIR = os.path.join(TASK_DIR, "data", "few_shot_examples")
+# Enough for outputs to differ, the tiny model never ends a generation early
+MAX_NEW_TOKENS = 8
+
+sys.path.insert(0, TASK_DIR)
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory: pytest.TempPathFactory) -> str:
+    # A randomly initialized Qwen3 model with its own tokenizer, see
+    # benchmarks/tiny.py
+    pytest.importorskip("transformers")
+    from benchmarks.tiny import build_tiny_model
+
+    path = str(tmp_path_factory.mktemp("model"))
+    build_tiny_model(path, EXAMPLE_DIR)
+    return path
+
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory: pytest.TempPathFactory) -> str:
+    pytest.importorskip("transformers")
+    from benchmarks.tiny import build_corpus
+
+    path = str(tmp_path_factory.mktemp("data"))
+    build_corpus(path, EXAMPLE_DIR, num_docs=6, doc_words=60)
+    return path
@@ -0,0 +1,31 @@
+from src.utils import ec_prompt_1_fan_out
+
+EE_CONTENTS = {
+    "doc1": '("entity"|||Soybean|||crop|||a legume)\n'
+    '("entity"|||yield|||measure|||harvest per hectare)',
+    "doc2": '("entity"|||soybean|||crop|||grown for oil)',
+}
+
+
+def classified(entity: str, classification: str) -> dict[str, str]:
+    return {"entity": entity, "classification": classification}
+
+
+def test_fan_out_follows_document_order() -> None:
+    responses, mismatched = ec_prompt_1_fan_out(
+        [classified("yield", "type"), classified("soybean", "term")], EE_CONTENTS
+    )
+    assert [response["entity"] for response in responses] == [
+        "soybean",
+        "yield",
+        "soybean",
+    ]
+    assert mismatched == []
+
+
+def test_renamed_entity_is_an_error() -> None:
+    responses, mismatched = ec_prompt_1_fan_out(
+        [classified("soybeans", "term"), classified("yield", "type")], EE_CONTENTS
+    )
+    assert [response["entity"] for response in responses] == ["yield"]
+    assert mismatched == ['{"entity": "soybeans", "classification": "term"}']
@@ -0,0 +1,44 @@
+from collections import Counter
+from typing import Any
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from src.grammar import GrammarLogitsProcessor, entity_lines_grammar  # noqa: E402
+
+LINE = '("entity"|||soybean|||legume|||a plant)\n'
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tiny_model: str) -> Any:
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(tiny_model)
+
+
+@pytest.mark.parametrize(
+    "text, can_end",
+    [("", True), (LINE, True), (LINE + '("entity"|||', False), (LINE[:20], False)],
+)
+def test_entity_lines_end(tokenizer: Any, text: str, can_end: bool) -> None:
+    grammar = entity_lines_grammar()
+    grammar.prepare(tokenizer, len(tokenizer))
+    state = grammar.step(grammar.start, text)
+    eos_token_id = tokenizer.eos_token_id
+    assert grammar.mask(state, {eos_token_id}, "cpu")[eos_token_id] == can_end
+
+
+def test_empty_completion_is_not_overridden(tokenizer: Any) -> None:
+    # A model that ends its answer right away keeps the end token
+    grammar = entity_lines_grammar()
+    eos_token_id = tokenizer.eos_token_id
+    stats = Counter()
+    processor = GrammarLogitsProcessor(
+        grammar, tokenizer, 4, {eos_token_id}, False, -1, stats
+    )
+    scores = torch.zeros(1, len(tokenizer))
+    scores[0, eos_token_id] = 1.0
+    scores = processor(torch.zeros(1, 4, dtype=torch.long), scores)
+    assert int(scores[0].argmax()) == eos_token_id
+    assert stats == {"rows": 1}
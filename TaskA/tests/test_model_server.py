@@ -0,0 +1,124 @@
+import argparse
+import os
+import socketserver
+import threading
+from typing import Any
+
+import pytest
+from conftest import MAX_NEW_TOKENS
+from src.backends import TransformersBackend, add_backend_arguments
+from src.model_server import ModelServer, connect_model_server, make_handler
+from src.stopping import GenerationGuard
+
+PROMPTS = [
+    "List the entities in: soybean is a legume",
+    "Classify: kelvin",
+    "What is a morpheme?",
+    "Name a unit of energy and a unit of length",
+]
+
+
+@pytest.fixture(scope="module")
+def backend(tiny_model: str) -> TransformersBackend:
+    return TransformersBackend(tiny_model, device="cpu", max_new_tokens=MAX_NEW_TOKENS)
+
+
+@pytest.fixture(scope="module")
+def socket_path(
+    backend: TransformersBackend, tmp_path_factory: pytest.TempPathFactory
+) -> str:
+    # The server shares the in-process backend, so both see the same weights
+    path = str(tmp_path_factory.mktemp("server") / "model_server.sock")
+    model_server = ModelServer(backend, batch_window=0.05)
+    threading.Thread(target=model_server.serve_generation, daemon=True).start()
+    server = socketserver.ThreadingUnixStreamServer(path, make_handler(model_server))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield path
+    server.shutdown()
+    server.server_close()
+    os.remove(path)
+
+
+def client_args(tiny_model: str, socket_path: str) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    add_backend_arguments(parser)
+    return parser.parse_args(
+        [
+            "-m",
+            tiny_model,
+            "--device",
+            "cpu",
+            "--max_new_tokens",
+            str(MAX_NEW_TOKENS),
+            "--model_server",
+            socket_path,
+        ]
+    )
+
+
+@pytest.mark.parametrize("constrained", [False, True])
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_server_matches_in_process(
+    backend: TransformersBackend,
+    tiny_model: str,
+    socket_path: str,
+    batch_size: int,
+    constrained: bool,
+) -> None:
+    server_backend = connect_model_server(client_args(tiny_model, socket_path))
+    assert server_backend is not None
+
+    def guard() -> GenerationGuard:
+        return GenerationGuard("ee", grammar="ee" if constrained else None)
+
+    expected = backend.generate(PROMPTS, batch_size=batch_size, guard=guard())
+    assert server_backend.generate(PROMPTS, batch_size=batch_size, guard=guard()) == (
+        expected
+    )
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"scheduler": "continuous"},
+        {"max_new_tokens": MAX_NEW_TOKENS + 1},
+        {"prefix_cache": True},
+    ],
+)
+def test_different_settings_load_in_process(
+    tiny_model: str, socket_path: str, overrides: dict[str, Any]
+) -> None:
+    args = client_args(tiny_model, socket_path)
+    vars(args).update(overrides)
+    assert connect_model_server(args) is None
+
+
+def test_merged_clients_get_their_own_guard_stats(
+    backend: TransformersBackend, tiny_model: str, socket_path: str
+) -> None:
+    server_backend = connect_model_server(client_args(tiny_model, socket_path))
+    requests = [PROMPTS[:3], PROMPTS[3:]]
+    expected = []
+    for prompts in requests:
+        guard = GenerationGuard("ee", grammar="ee")
+        backend.generate(prompts, guard=guard)
+        expected.append(guard.grammar_stats)
+
+    # Both requests arrive within the batch window and share a generate call
+    info = server_backend.call({"op": "info"})
+    guards = [GenerationGuard("ee", grammar="ee") for _ in requests]
+    threads = [
+        threading.Thread(
+            target=server_backend.generate, args=(prompts,), kwargs={"guard": guard}
+        )
+        for prompts, guard in zip(requests, guards)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    merged_info = server_backend.call({"op": "info"})
+    assert merged_info["calls"] == info["calls"] + 1
+    assert merged_info["requests"] == info["requests"] + 2
+    assert [guard.grammar_stats for guard in guards] == expected
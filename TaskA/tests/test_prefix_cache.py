@@ -0,0 +1,81 @@
+import pytest
+from conftest import EXAMPLE_DIR, MAX_NEW_TOKENS
+from src.backends import TransformersBackend
+from src.utils import (
+    build_prefix_cache,
+    check_prefix_cache,
+    ee_prompt_setup,
+    open_test_docs,
+    qwen_gen_batch,
+    split_prompt_template,
+)
+
+GENERATION_KWARGS = {"max_new_tokens": MAX_NEW_TOKENS}
+
+
+@pytest.fixture(scope="module")
+def backend(tiny_model: str) -> TransformersBackend:
+    backend = TransformersBackend(
+        tiny_model, device="cpu", max_new_tokens=MAX_NEW_TOKENS
+    )
+    # Sampling defaults like those of Qwen3, which greedy checks must override
+    backend.model.generation_config.update(
+        do_sample=True, temperature=0.6, top_k=20, top_p=0.95
+    )
+    return backend
+
+
+@pytest.fixture(scope="module")
+def prompts_and_prefix(
+    backend: TransformersBackend, corpus: str
+) -> tuple[list[str], tuple]:
+    prompt_template, prompt_template_kwargs = ee_prompt_setup(
+        "2", "engineering", corpus, EXAMPLE_DIR
+    )
+    prefix_prompt = split_prompt_template(prompt_template)[0].format(
+        **prompt_template_kwargs
+    )
+    test_docs = open_test_docs(corpus, "engineering")
+    prompts = [
+        prompt_template.format(
+            **prompt_template_kwargs, title=doc["title"], text=doc["text"]
+        )
+        for doc in map(test_docs.get, test_docs.ids())
+    ]
+    prefix_cache = build_prefix_cache(prefix_prompt, backend.tokenizer, backend.model)
+    return prompts, prefix_cache
+
+
+def test_check_prefix_cache(
+    backend: TransformersBackend, prompts_and_prefix: tuple[list[str], tuple]
+) -> None:
+    prompts, prefix_cache = prompts_and_prefix
+    check_prefix_cache(
+        prompts[:2],
+        backend.tokenizer,
+        backend.model,
+        prefix_cache,
+        generation_kwargs=GENERATION_KWARGS,
+    )
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_prefix_cache_keeps_greedy_output(
+    backend: TransformersBackend,
+    prompts_and_prefix: tuple[list[str], tuple],
+    batch_size: int,
+) -> None:
+    prompts, prefix_cache = prompts_and_prefix
+    outputs = [
+        qwen_gen_batch(
+            prompts,
+            backend.tokenizer,
+            backend.model,
+            batch_size=batch_size,
+            prefix_cache=cache,
+            greedy=True,
+            generation_kwargs=GENERATION_KWARGS,
+        )
+        for cache in (None, prefix_cache)
+    ]
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,64 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from conftest import TASK_DIR
+from src.postprocess import SUBSETS
+
+OUTPUT_FILES = ["contents.json", "terms.txt", "types.txt"]
+
+
+def run(*args: str) -> None:
+    subprocess.run([sys.executable, *args], cwd=TASK_DIR, check=True)
+
+
+def read_outputs(output_dir: str) -> dict[tuple[str, str], str]:
+    outputs = {}
+    for subset in SUBSETS:
+        for name in OUTPUT_FILES:
+            with open(os.path.join(output_dir, subset, name)) as f:
+                outputs[subset, name] = f.read()
+    return outputs
+
+
+@pytest.fixture(scope="module")
+def ee_output_dir(corpus: str, tmp_path_factory: pytest.TempPathFactory) -> str:
+    path = str(tmp_path_factory.mktemp("ee"))
+    run(
+        *("entity_extraction.py", "1", "--backend", "mock", "-d", corpus),
+        *("--no_cache", "-o", path),
+    )
+    return path
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def test_sharded_extraction_matches_single_process(
+    corpus: str, ee_output_dir: str, tmp_path: Path, workers: int
+) -> None:
+    output_dir = str(tmp_path / "sharded")
+    run(
+        *("launch.py", "--workers", str(workers), "--log_dir", str(tmp_path / "logs")),
+        *("entity_extraction.py", "1", "--backend", "mock", "-d", corpus),
+        *("--no_cache", "-o", output_dir),
+    )
+    assert read_outputs(output_dir) == read_outputs(ee_output_dir)
+
+
+def test_sharded_classification_matches_single_process(
+    corpus: str, ee_output_dir: str, tmp_path: Path
+) -> None:
+    script_args = [
+        *("entity_classification.py", "2", "--backend", "mock", "-d", corpus),
+        *("--ee_output_dir", ee_output_dir, "--no_cache"),
+    ]
+    single_dir = str(tmp_path / "single")
+    sharded_dir = str(tmp_path / "sharded")
+    run(*script_args, "-o", single_dir)
+    run(
+        *("launch.py", "--workers", "2", "--log_dir", str(tmp_path / "logs")),
+        *script_args,
+        *("-o", sharded_dir),
+    )
+    assert read_outputs(sharded_dir) == read_outputs(single_dir)